@@ -2,16 +2,19 @@ import os
 import hmac
 import shutil
 import json
+import threading
 from pathlib import Path
 
 import streamlit as st
 from streamlit_extras.switch_page_button import switch_page
 from streamlit.source_util import _on_pages_changed, get_pages
 
-from utilities import utils
+from utilities import chat_history, utils
+from utilities.storage import get_storage_backend
+from utilities.manifest import get_manifest
+from utilities.reference_documents import get_reference_documents
 
 DEFAULT_PAGE = "Transaction_Monitoring.py"
-MEMORY_DB_PATH = "memory.db"
 GRAPHS_DIR = "tmp/graphs/"
 
 def get_all_pages():
@@ -53,6 +56,32 @@ def show_all_pages():
 
 clear_all_but_first_page()
 
+@st.cache_resource
+def warm_up_reference_documents() -> threading.Thread:
+    """Preload the reference documents in the background, once per server process (before the first login)."""
+    storage = get_storage_backend()
+    reference_documents = get_reference_documents(storage, get_manifest(storage))
+    thread = threading.Thread(target=reference_documents.warm_up, name="reference-documents-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+warm_up_reference_documents()
+
+@st.cache_resource
+def reset_chat_history() -> bool:
+    """
+    Start each server process with an empty chat history database, before any session opens it. Logins do not
+    delete it: the database is shared by the pooled connections of every session (see utilities.chat_history).
+    """
+    chat_history.reset_database()
+    return True
+
+try:
+    reset_chat_history()
+except Exception as e:
+    st.error(f"An error occurred while resetting the chat history database: {e}")
+    st.stop()
+
 def check_password():
     """Check if the user's entered password matches the environment key."""
     # If password already known to be correct, just proceed
@@ -81,14 +110,6 @@ if not check_password():
 
 show_all_pages()
 
-# Delete memory.db if exists
-try:
-    if os.path.exists(MEMORY_DB_PATH):
-        os.remove(MEMORY_DB_PATH)
-except Exception as e:
-    st.error(f"An error occurred while deleting {MEMORY_DB_PATH}: {e}")
-    st.stop()
-
 # Delete tmp/graphs/ directory if exists
 try:
     if os.path.exists(GRAPHS_DIR):
@@ -1,59 +1,20 @@
 import os
 import traceback
-import re
 import time
 
-from typing import Dict
 from datetime import datetime
-import pandas as pd
 import streamlit as st
 from streamlit_extras.switch_page_button import switch_page
 
 from utilities import utils
 from utilities.enums import QuestionsTypes
 from utilities.llm import ReportGenerator
-from utilities.prompts import Prompts
-
-
-def add_currency_symbol(df: pd.DataFrame, keyword_column: str = "importe", symbol: str = "€") -> pd.DataFrame:
-    """
-    Add currency symbol to a DataFrame column
-    """
-    # Find the column with the keyword
-    df_copy = df.copy()
-    currency_columns = [col for col in df_copy.columns if keyword_column in col.lower()]
-    if currency_columns:
-        for col in currency_columns:
-            df_copy[col] = df_copy[col].apply(lambda x: f"{x:,.2f} {symbol}")
-    return df_copy
-
-
-def get_specific_table(keyword: str, format_table: bool = True) -> pd.DataFrame:
-    sheets = st.session_state['excel_data'].keys()
-    numero_cuenta = st.session_state['numero_cuenta']
-    tables = [t for t in sheets if keyword in t.lower()]
-    selected_table = None
-    
-    # If more than one table matches, try to find a match with 'numero_cuenta'
-    if len(tables) > 1:
-        for table in tables:
-            nums = re.findall(r'\d+', table)  # Extract numbers from table name
-            for num in nums:
-                if num in numero_cuenta:
-                    selected_table = table
-                    break  # Stop after finding the first match
-    
-    # If no table was selected by 'numero_cuenta' match or only one table matches
-    if not selected_table and tables:
-        selected_table = tables[0]
-    
-    # If a table has been selected, format it if required, and return
-    if selected_table:
-        table_content = st.session_state['excel_data'][selected_table]['content']
-        return add_currency_symbol(table_content) if format_table else table_content
-    
-    # Return an empty DataFrame if no tables match
-    return pd.DataFrame()
+from utilities.prenarrative import build_section_plan
+from utilities.case_processing import build_prenarrative, get_prenarrative_prompts, get_report_generator
+
+
+# Sections of the pre-narrative asked to the LLM at the same time
+PRENARRATIVE_CONCURRENCY = int(os.getenv("PRENARRATIVE_CONCURRENCY", 4))
 
 
 def display_narrative():
@@ -68,6 +29,10 @@ def display_narrative():
         answers = [q["answer"] for q in st.session_state['prenarrative_answers'][st.session_state['selected_case']].values()]
         st.session_state['full_prenarrative'] = header + "\n\n".join(answers)
 
+        cached = st.session_state['prenarrative_cached'].get(st.session_state['selected_case'], set())
+        if cached:
+            st.caption(f"⚡ {len(cached)} section(s) served from the response cache: {', '.join(q.value for q in cached)}")
+
         with placeholder_narrative.container(border=True):
             for answer in answers:
                 if utils.render_graph(answer, case=st.session_state['selected_case']):
@@ -90,15 +55,16 @@ def display_narrative():
     else:
         st.warning('There is no pre-narrative generated for this case. Click "Generate new narrative" to create one.')
 
-def update_progress_bar(progress_bar, progress, total, question, idx):
+def update_progress_bar(progress_bar, progress, total, question):
     progress_bar.progress(
         progress / total,
-        text=f'Asking AI about "{question}"... ({idx}/{total})'
+        text=f'AI answered "{question}" ({progress}/{total})'
     )
 
 def generate_narrative():
     st.session_state['auto_generate_answers'] = False
     st.session_state['prenarrative_answers'][st.session_state['selected_case']] = {}
+    st.session_state['prenarrative_cached'][st.session_state['selected_case']] = set()
     st.session_state['full_prenarrative'] = ""
 
     with col2:
@@ -107,43 +73,45 @@ def generate_narrative():
 
     st.toast("Generating narrative with AI...", icon="🤖")
 
-    model = os.getenv("OPENAI_MODEL_NAME", ReportGenerator.DEFAULT_MODEL)
-    temperature = float(os.getenv("OPENAI_MODEL_TEMPERATURE", 0.0))
-    report_generator = ReportGenerator(prompt=st.session_state['base_prompt'], model=model, temperature=temperature, session_id=st.session_state['selected_case'])
-    report_generator.clear_session(st.session_state['selected_case'])
+    report_generator = get_report_generator(st.session_state['base_prompt'], st.session_state['selected_case'], queue_key=utils.get_session_key())
 
     questions_dict = st.session_state['questions_dict']
-    filtered_question_dict = {k: v for k, v in questions_dict.items() if k in st.session_state['questions_to_ask']}
+    prompts = {question: value["prompt"] for question, value in questions_dict.items() if question in st.session_state['questions_to_ask']}
+    # Independent sections are asked concurrently, the rest wait for the sections they depend on
+    sections = build_section_plan(prompts)
 
     with placeholder_progress_bar.container(border=False):
-        progress_bar = st.progress(0)
-        total_questions = len(filtered_question_dict.keys())
-    
-    # Generate the narrative
+        progress_bar = st.progress(0, text=f"Asking AI about {len(sections)} sections...")
+        total_questions = len(sections)
+        report_generator.on_admission_wait = utils.show_admission_status(st.empty())
+
+    # Generate the narrative, streaming each section into its own placeholder (in order)
     with placeholder_narrative.container(border=True):
-        for idx, question in enumerate(filtered_question_dict.keys(), start=1):
-            update_progress_bar(
-                progress_bar,
-                progress=idx - 1,
-                total=total_questions,
-                question=list(filtered_question_dict.keys())[idx - 1].value,
-                idx=idx
-            )
-            prompt = filtered_question_dict[question]["prompt"]
-            
-            if question == QuestionsTypes.GRAFO_INTERVINIENTES:
-                response = report_generator.ask_question(prompt)
-                _ = utils.render_graph(response, case=st.session_state['selected_case'])
-            else:
-                response = report_generator.ask_question_stream(prompt)
-                response = st.write_stream(response)
+        section_placeholders = {section.question: st.empty() for section in sections}
 
-            # Save answer to the session state, and update pre-narrative answers to questions_dict
-            st.session_state['questions_dict'][question]["answer"] = response
-            st.session_state['prenarrative_answers'][st.session_state['selected_case']] = st.session_state['questions_dict']
-            st.session_state['prenarrative_timestamp'] = datetime.now()
+    def on_chunk(question: QuestionsTypes, text: str):
+        section_placeholders[question].markdown(text)
 
-        progress_bar.progress(1.0, text="Narrative generated successfully! ✅")
+    def on_done(question: QuestionsTypes, response: str):
+        if question == QuestionsTypes.GRAFO_INTERVINIENTES:
+            with section_placeholders[question].container():
+                _ = utils.render_graph(response, case=st.session_state['selected_case'])
+        else:
+            section_placeholders[question].markdown(response)
+
+        # Save answer to the session state, and update pre-narrative answers to questions_dict
+        st.session_state['questions_dict'][question]["answer"] = response
+        if report_generator.is_cached(st.session_state['questions_dict'][question]["prompt"]):
+            st.session_state['prenarrative_cached'][st.session_state['selected_case']].add(question)
+        st.session_state['prenarrative_answers'][st.session_state['selected_case']] = st.session_state['questions_dict']
+        st.session_state['prenarrative_timestamp'] = datetime.now()
+        answered = sum(1 for section in sections if st.session_state['questions_dict'][section.question]["answer"])
+        update_progress_bar(progress_bar, progress=answered, total=total_questions, question=question.value)
+
+    for section in sections:
+        st.session_state['questions_dict'][section.question]["answer"] = ""
+    build_prenarrative(st.session_state['case_data'], prompts=prompts, report_generator=report_generator, on_chunk=on_chunk, on_done=on_done, max_concurrency=PRENARRATIVE_CONCURRENCY)
+    progress_bar.progress(1.0, text="Narrative generated successfully! ✅")
 
     placeholder_narrative.empty()
     st.toast("Pre-Narrative generated successfully!", icon="✅")
@@ -170,6 +138,8 @@ try:
         st.session_state['auto_generate_answers'] = False
     if 'prenarrative_answers' not in st.session_state:
         st.session_state['prenarrative_answers'] = {}
+    if 'prenarrative_cached' not in st.session_state:
+        st.session_state['prenarrative_cached'] = {}
     if 'full_prenarrative' not in st.session_state:
         st.session_state['full_prenarrative'] = ""
     if 'prenarrative_timestamp' not in st.session_state:
@@ -177,17 +147,7 @@ try:
 
     st.markdown(f'## Pre-narrative for case `{st.session_state["selected_case"]}`')
 
-    st.session_state['tabla_abonos'] = get_specific_table(keyword="abono").to_markdown(index=False, floatfmt=",.2f")
-    st.session_state['tabla_cargos'] = get_specific_table(keyword="cargos").to_markdown(index=False, floatfmt=",.2f")
-
-    default_questions = {
-        QuestionsTypes.NATURALEZA_ALERTA: Prompts.naturaleza_alerta(),
-        QuestionsTypes.PRINCIPAL_IMPLICADO: Prompts.principal_implicado(),
-        QuestionsTypes.CONTEXTO_HISTORICO: Prompts.contexto_historico(),
-        QuestionsTypes.ANALISIS_OPERATIVA: Prompts.analisis_operativa(st.session_state['tabla_abonos'], st.session_state['tabla_cargos']),
-        QuestionsTypes.GRAFO_INTERVINIENTES: Prompts.grafo_intervinientes(),
-        QuestionsTypes.RECOMENDACION_INICIAL: Prompts.recomendacion_prenarrativa(),
-    }
+    default_questions = get_prenarrative_prompts(st.session_state['case_data'])
 
     with st.expander("Select parts of the pre-narrative to generate"):
         # questions_options = [k.value for k in default_questions.keys()]
@@ -1,19 +1,12 @@
-import json
-import os
 import traceback
-import openai
-import time
 
 from datetime import datetime
-from typing import List, Optional, Dict
 
-import pandas as pd
 import streamlit as st
 
 from utilities import utils
 from utilities.enums import QuestionsTypes
-from utilities.llm import ReportGenerator
-from utilities.prompts import Prompts
+from utilities.case_processing import build_narrative, get_narrative_prompts, get_narrative_questions, get_report_generator
 
 
 def display_narrative():
@@ -22,6 +15,10 @@ def display_narrative():
         answers = st.session_state['narrative_answers'][st.session_state['selected_case']]
         st.session_state['full_narrative'] = "\n".join([str(answer) if answer is not None else "" for answer in answers])
 
+        cached = st.session_state['narrative_cached'].get(st.session_state['selected_case'], 0)
+        if cached:
+            st.caption(f"⚡ {cached} answer(s) served from the response cache")
+
         with placeholder_narrative.container(border=True):
             for answer in answers:
                 if utils.render_graph(answer, case=st.session_state['selected_case']):
@@ -42,43 +39,6 @@ def display_narrative():
     else:
         st.warning('There is no narrative generated for this case. Click "Generate new narrative" to create one.')
 
-def generate_conclusion_final(report_generator, prompt, max_retries=10):
-    try:
-        if not prompt:
-            st.error("Error: El prompt para la Conclusión Final es nulo o inválido.")
-            return "Prompt inválido para Conclusión Final."
-
-        response_content = ""
-        retries = 0
-
-        while retries < max_retries:
-            try:
-                for r in report_generator.ask_question_stream(prompt):
-                    response_content += r
-                # Si obtenemos una respuesta válida, salimos del ciclo
-                if response_content:
-                    break
-            except openai.error.OpenAIError as e:
-                st.error(f"OpenAI API error: {e}")
-                retries += 1
-                st.write(f"Retrying... Attempt {retries}/{max_retries}")
-                time.sleep(2)  # Esperamos 2 segundos antes de reintentar
-            except Exception as e:
-                st.error(f"Error during streaming response: {e}")
-                retries += 1
-                st.write(f"Retrying... Attempt {retries}/{max_retries}")
-                time.sleep(2)
-
-        # Si después de los reintentos no hay respuesta, mostramos un error
-        if not response_content:
-            return "No response generated from the API after multiple attempts."
-
-        return response_content
-
-    except Exception as e:
-        st.error(f"Critical error generating conclusion final: {e}")
-        return "Critical error generating the conclusion final."
-
 try:
 
     st.set_page_config(
@@ -101,6 +61,8 @@ try:
         st.session_state['json_interviniente_cliente'] = ""        
     if 'narrative_answers' not in st.session_state:
         st.session_state['narrative_answers'] = {}
+    if 'narrative_cached' not in st.session_state:
+        st.session_state['narrative_cached'] = {}
     if 'selected_case' not in st.session_state or st.session_state['selected_case'] is None:
         utils.alert_and_redirect()
 
@@ -124,57 +86,28 @@ try:
     col1, col2, col3 = st.columns(3)
     placeholder_narrative = st.empty()
 
-    default_questions = {
-        QuestionsTypes.NATURALEZA_ALERTA: None,
-        QuestionsTypes.PRINCIPAL_IMPLICADO: Prompts.principal_implicado(
-            informacion_externa=st.session_state['additional_documentation_principal_implicado']),
-        QuestionsTypes.CONTEXTO_HISTORICO: None,
-        QuestionsTypes.ANALISIS_OPERATIVA: None,
-        QuestionsTypes.GRAFO_INTERVINIENTES: None,
-        QuestionsTypes.DOCUMENTACION_ADICIONAL: Prompts.documentacion_adicional(
-            documentacion_adicional=st.session_state['additional_documentation']
-        ),
-        QuestionsTypes.INTERVINIENTES_ADICIONALES: Prompts.intervinientes_adicionales(
-            json_interviniente_cliente=st.session_state['json_interviniente_cliente'],
-            transactions_interviniente_df=st.session_state['additional_transactions_df']
-        ),
-        QuestionsTypes.CONCLUSION_FINAL: Prompts.conclusion_final(),
-    }
-    questions_dict = st.session_state['questions_dict']
-    new_questions_dict = {}
-    for question in default_questions.keys():
-        if question == QuestionsTypes.CONCLUSION_FINAL or question not in questions_dict or default_questions[question] is not None:
-            new_questions_dict[question] = {"prompt": default_questions[question], "answer": ""}
-        else:
-            new_questions_dict[question] = questions_dict[question]
-    st.session_state['narrative_questions_dict'] = new_questions_dict
-
-    model = os.getenv("OPENAI_MODEL_NAME", ReportGenerator.DEFAULT_MODEL)
-    temperature = float(os.getenv("OPENAI_MODEL_TEMPERATURE", 0.0))
-    report_generator = ReportGenerator(prompt=st.session_state['base_prompt'], model=model, temperature=temperature, session_id=st.session_state['selected_case'])
+    default_questions = get_narrative_prompts(st.session_state['case_data'], st.session_state.get('selected_additional_sheet_names'))
+    prenarrative = {question: details["answer"] for question, details in st.session_state['questions_dict'].items()}
+    st.session_state['narrative_questions_dict'] = get_narrative_questions(default_questions, prenarrative)
+
+    report_generator = get_report_generator(st.session_state['base_prompt'], st.session_state['selected_case'], queue_key=utils.get_session_key())
 
     if col3.button("📄 Generate new narrative", type="primary", use_container_width=True):
 
         st.session_state['narrative_answers'][st.session_state['selected_case']] = []
 
-        new_questions_dict = st.session_state['narrative_questions_dict']
-
+        report_generator.on_admission_wait = utils.show_admission_status(st.empty())
         with placeholder_narrative.container(border=True):
-            for question, details in new_questions_dict.items():
-                prompt = details["prompt"]
-                if prompt is not None and not details["answer"]:
-                    if question == QuestionsTypes.CONCLUSION_FINAL:
-                        response = generate_conclusion_final(report_generator, prompt)
-                    else:
-                        response = ""
-                        for fragment in report_generator.ask_question_stream(prompt):
-                            response += fragment 
-                    st.write(response) 
-                    st.session_state['narrative_answers'][st.session_state['selected_case']].append(response)
-                else:
-                    response = details["answer"]
-                    st.session_state['narrative_answers'][st.session_state['selected_case']].append(response)
+            def on_section(question: QuestionsTypes, response: str):
+                if st.session_state['narrative_questions_dict'][question]["prompt"] is not None:
+                    st.write(response)
+                st.session_state['narrative_answers'][st.session_state['selected_case']].append(response)
+
+            # Each section is asked with only the sections it depends on
+            build_narrative(st.session_state['case_data'], questions=st.session_state['narrative_questions_dict'], report_generator=report_generator, on_section=on_section,
+                            on_error=lambda question, e: st.error(f"Critical error generating conclusion final: {e}"))
             st.session_state['narrative_timestamp'] = datetime.now()
+            st.session_state['narrative_cached'][st.session_state['selected_case']] = sum(report_generator.cached_answers.values())
             st.write("Narrative Answers:", st.session_state['narrative_answers'])
 
         placeholder_narrative.empty()
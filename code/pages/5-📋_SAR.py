@@ -7,37 +7,15 @@ from typing import Dict
 import streamlit as st
 
 from utilities import utils
-from utilities.enums import QuestionsTypesSAR, TemplateNameSAR
-from utilities.llm import ReportGenerator
-from utilities.prompts import Prompts
-from utilities.azureblobstorage import AzureBlobStorageClient
+from utilities.enums import QuestionsTypesSAR
+from utilities.storage import get_storage_backend
+from utilities.manifest import get_manifest
+from utilities.case_processing import ALERT_KEYWORDS, CUSTOMER_KEYWORDS, build_sar, build_sar_prompt, get_report_generator, get_sar_folder_type, get_sar_prompts, is_persona_fisica
 
 
 @st.cache_data
-def read_docx_template(name: TemplateNameSAR) -> str:
-            # Get all .docx files in the folder
-            for file in sar_templates:
-                if name.value in file:
-                    return utils.get_docx_text(blob_client.get_file(file))
-            return ""
-        
-
-@st.cache_data
-def get_default_questions() -> Dict[QuestionsTypesSAR, str]:
-    return {
-        QuestionsTypesSAR.RESUMEN_EJECUTIVO: Prompts.resumen_ejecutivo(
-            template=read_docx_template(TemplateNameSAR.RESUMEN_EJECUTIVO)),
-        QuestionsTypesSAR.IDENTIFICACION_INTERVINIENTE: Prompts.identificacion_interviniente(
-            template=read_docx_template(TemplateNameSAR.IDENTIFICACION_INTERVINIENTE)),
-        QuestionsTypesSAR.DESCRIPCION_OPERACIONES: Prompts.descripcion_operaciones(
-            template=read_docx_template(TemplateNameSAR.DESCRIPCION_OPERACIONES)),
-        QuestionsTypesSAR.INDICIO_BLANQUEO: Prompts.indicios_blanqueo(
-            template=read_docx_template(TemplateNameSAR.INDICIO_BLANQUEO)),
-        QuestionsTypesSAR.GESTIONES_COMPROBACIONES: Prompts.gestiones_comprobaciones(
-            template=read_docx_template(TemplateNameSAR.GESTIONES_COMPROBACIONES)),
-        QuestionsTypesSAR.DOCUMENTACION_REMITIDA: Prompts.documentacion_remitida(
-            template=read_docx_template(TemplateNameSAR.DOCUMENTACION_REMITIDA)),
-    }
+def get_default_questions(sar_folder_type: str) -> Dict[QuestionsTypesSAR, str]:
+    return get_sar_prompts(sar_folder_type)
 
 
 try:
@@ -57,14 +35,16 @@ try:
     }
 
     sar_data_path = os.getenv("SAR_DATA_FOLDER", "")
-    sar_templates_path = os.getenv("SAR_TEMPLATES_FOLDER", "")
 
-    blob_client = AzureBlobStorageClient()
+    blob_client = get_storage_backend()
+    manifest = get_manifest(blob_client)
 
     if 'narrative_answers' not in st.session_state:
         st.session_state['narrative_answers'] = {}
     if 'sar_answers' not in st.session_state:
         st.session_state['sar_answers'] = {}
+    if 'sar_cached' not in st.session_state:
+        st.session_state['sar_cached'] = {}
     if 'selected_case' not in st.session_state or st.session_state['selected_case'] is None:
         utils.alert_and_redirect()
 
@@ -83,14 +63,14 @@ try:
 
     with st.status("Preparing data for SAR generation...", expanded=False):
 
-        files = blob_client.get_container_files(folder_name=os.path.join(sar_data_path, st.session_state['selected_case']), full_path=False)
+        files = manifest.files(folder_name=os.path.join(sar_data_path, st.session_state['selected_case']), full_path=False)
 
         col1, col2 = st.columns(2)
 
         with col1:
             alert_data = utils.load_json(
                     case=st.session_state['selected_case'],
-                    keywords=["Alerta", "alerta", "Alert", "alert"],
+                    keywords=ALERT_KEYWORDS,
                     files=files,
                     folder=sar_data_path,
                     _blob_client=blob_client
@@ -100,27 +80,25 @@ try:
         with col2:
             customer_data = utils.load_json(
                     case=st.session_state['selected_case'],
-                    keywords=["Cliente", "cliente", "Customer", "customer"],
+                    keywords=CUSTOMER_KEYWORDS,
                     files=files,
                     folder=sar_data_path,
                     _blob_client=blob_client
                 )
             st.session_state['customer_data_SAR'] = customer_data
-            if customer_data:
-                tipo_documento = customer_data[0].get("identificacion", {}).get("tipo_documento", "")
-            st.session_state['persona_fisica'] = False if tipo_documento in ["CIF"] else True
+            st.session_state['persona_fisica'] = is_persona_fisica(customer_data)
 
-        sar_folder_type = "Persona Fisica" if st.session_state['persona_fisica'] else "Persona Juridica"
-        sar_templates = blob_client.get_container_files(folder_name=os.path.join(sar_templates_path, sar_folder_type), full_path=True)
+        sar_folder_type = get_sar_folder_type(customer_data)
 
-        default_questions: Dict[QuestionsTypesSAR, str] = get_default_questions()
+        default_questions: Dict[QuestionsTypesSAR, str] = get_default_questions(sar_folder_type)
 
         ## Base prompt SAR
-        st.session_state['base_prompt_SAR'] = Prompts.base_prompt_SAR(
+        st.session_state['base_prompt_SAR'] = build_sar_prompt(
+            st.session_state['case_data'],
+            narrative_output=full_response,
             alert_data=st.session_state['alert_data_SAR'],
             customer_data=st.session_state['customer_data_SAR'],
-            transactions_df=st.session_state['transactions_df'],
-            narrative_output=full_response,
+            sheet_names=st.session_state.get('selected_sheet_names'),
         )
 
         st.header("Templates")
@@ -135,9 +113,7 @@ try:
                     st.subheader(question_name.value)
                     st.write(question)
 
-    model = os.getenv("OPENAI_MODEL_NAME", ReportGenerator.DEFAULT_MODEL)
-    temperature = float(os.getenv("OPENAI_MODEL_TEMPERATURE", 0.0))
-    report_generator = ReportGenerator(prompt=st.session_state['base_prompt_SAR'], model=model, temperature=temperature, session_id=st.session_state['selected_case'])
+    report_generator = get_report_generator(st.session_state['base_prompt_SAR'], st.session_state['selected_case'], queue_key=utils.get_session_key())
 
     col1, col2, col3 = st.columns(3)
     placeholder_narrative = st.empty()
@@ -146,16 +122,19 @@ try:
         
         st.session_state['sar_answers'][st.session_state['selected_case']] = []
 
+        report_generator.on_admission_wait = utils.show_admission_status(st.empty())
         with placeholder_narrative.container(border=True):
-            for question_type, question in default_questions.items():
-                if question_type.value == QuestionsTypesSAR.INDICIO_BLANQUEO.value:
-                    response = report_generator.ask_question(question)
-                    st.write(response)
-                else:
-                    response = report_generator.ask_question_stream(question)
-                    response = st.write_stream(response)
-                st.session_state['sar_answers'][st.session_state['selected_case']].append(response)
-                st.session_state['sar_timestamp'] = datetime.now()
+            sar = build_sar(
+                st.session_state['case_data'],
+                prompts=default_questions,
+                report_generator=report_generator,
+                stream=lambda question_type, chunks: st.write_stream(chunks),
+                # The money laundering indicators are not streamed
+                on_section=lambda question_type, response: st.write(response) if question_type == QuestionsTypesSAR.INDICIO_BLANQUEO else None,
+            )
+            st.session_state['sar_answers'][st.session_state['selected_case']] = list(sar.values())
+            st.session_state['sar_timestamp'] = datetime.now()
+        st.session_state['sar_cached'][st.session_state['selected_case']] = sum(report_generator.cached_answers.values())
         placeholder_narrative.empty()
         st.rerun()
 
@@ -164,6 +143,10 @@ try:
         answers = st.session_state['sar_answers'][st.session_state['selected_case']]
         st.session_state['full_SAR'] = "\n".join(answers)
 
+        cached = st.session_state['sar_cached'].get(st.session_state['selected_case'], 0)
+        if cached:
+            st.caption(f"⚡ {cached} answer(s) served from the response cache")
+
         with placeholder_narrative.container(border=True):
             for answer in answers:
                 st.write(answer)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The pages import the utilities package from the code folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
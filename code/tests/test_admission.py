@@ -0,0 +1,113 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from utilities import admission
+from utilities.admission import AdmissionController, AdmissionStatus, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(admission.time, "monotonic", clock)
+    return clock
+
+
+def test_token_bucket_refills_at_its_rate(clock):
+    bucket = TokenBucket(600, per_seconds=60)
+    bucket.available = 0
+    assert bucket.wait_for(100) == pytest.approx(10)
+    clock.now += 5
+    bucket.refill()
+    assert bucket.available == pytest.approx(50)
+    assert bucket.wait_for(20) == 0
+    clock.now += 3600
+    bucket.refill()
+    assert bucket.available == 600
+
+
+def test_disabled_controller_admits_at_once():
+    controller = AdmissionController()
+    assert not controller.enabled
+    assert controller.acquire("analyst", 10 ** 9).admitted
+    assert asyncio.run(controller.aacquire("analyst", 10 ** 9)).admitted
+
+
+def test_calls_within_the_quota_do_not_wait(clock):
+    controller = AdmissionController(tpm_limit=1000, rpm_limit=10)
+    statuses = []
+    for _ in range(3):
+        controller.acquire("analyst", 300, on_wait=statuses.append)
+    assert statuses == []
+    assert controller.tokens.available == pytest.approx(100)
+    assert controller.requests.available == pytest.approx(7)
+
+
+def test_settle_corrects_the_estimate(clock):
+    controller = AdmissionController(tpm_limit=1000)
+    ticket = controller.acquire("analyst", 400)
+    controller.settle(ticket, 150)
+    assert controller.tokens.available == pytest.approx(850)
+    # Calls larger than the whole quota reserve the whole quota
+    ticket = controller.acquire("analyst", 5000)
+    assert controller.tokens.available == pytest.approx(-150)
+    controller.settle(ticket, 1000)
+    assert controller.tokens.available == pytest.approx(-150)
+
+
+def test_waiting_tickets_are_ordered_round_robin_between_queues():
+    controller = AdmissionController(rpm_limit=60)
+    for queue in ["A", "A", "A", "B", "C", "C"]:
+        controller._enqueue(queue, 1)
+    assert [ticket.queue for ticket in controller._waiting()] == ["A", "B", "C", "A", "C", "A"]
+
+
+def test_sessions_are_admitted_round_robin():
+    controller = AdmissionController(rpm_limit=600)  # One request every 0.1 s once the bucket is empty
+    controller.requests.available = 0
+    admitted = []
+    threads = []
+    for name, queue in [("A1", "A"), ("A2", "A"), ("A3", "A"), ("B1", "B"), ("C1", "C"), ("C2", "C")]:
+        queued = sum(len(tickets) for tickets in controller._queues.values())
+        thread = threading.Thread(target=lambda name=name, queue=queue: admitted.append(name) if controller.acquire(queue, 1) else None)
+        thread.start()
+        threads.append(thread)
+        # Enqueue the calls in order
+        while sum(len(tickets) for tickets in controller._queues.values()) == queued:
+            time.sleep(0.001)
+    for thread in threads:
+        thread.join(timeout=10)
+    assert admitted == ["A1", "B1", "C1", "A2", "C2", "A3"]
+
+
+def test_waiting_calls_get_their_status():
+    controller = AdmissionController(rpm_limit=600)
+    controller.requests.available = 0
+    statuses = []
+    ticket = asyncio.run(controller.aacquire("analyst", 1, on_wait=statuses.append))
+    assert ticket.admitted
+    assert statuses[0] == AdmissionStatus(position=1, queued=1, wait=pytest.approx(0.1, abs=0.02))
+    # None once admitted
+    assert statuses[-1] is None
+
+
+def test_cancelled_calls_leave_the_queue():
+    controller = AdmissionController(rpm_limit=1)
+    controller.requests.available = 0
+
+    async def wait_briefly():
+        await asyncio.wait_for(controller.aacquire("analyst", 1), timeout=0.05)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(wait_briefly())
+    assert controller._waiting() == []
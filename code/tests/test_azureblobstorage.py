@@ -0,0 +1,97 @@
+import os
+
+import pytest
+
+pytest.importorskip("azure.storage.blob")
+pytest.importorskip("dotenv")
+
+from azure.storage.blob import BlobPrefix, BlobProperties
+
+from utilities.azureblobstorage import AzureBlobStorageClient
+
+BLOBS = [
+    "pre/C0 - Información Común/readme.txt",
+    "pre/C1 - TRF/alert.json",
+    "pre/C1 - TRF/Tabla Resumen.xlsx",
+    "pre/C2 - EFE/alert.json",
+    "pre/C3 - TRF/alert.json",
+    "pre/index.json",
+    "sar/C1 - TRF/sar.json",
+]
+
+
+class FakePaged:
+    def __init__(self, items, results_per_page):
+        self.items = items
+        self.results_per_page = results_per_page or 5000
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def by_page(self):
+        return (self.items[i:i + self.results_per_page] for i in range(0, len(self.items), self.results_per_page))
+
+
+class FakeContainerClient:
+    """The listing calls of a ContainerClient over BLOBS, recording the calls."""
+
+    def __init__(self):
+        self.calls = []
+
+    def list_blobs(self, name_starts_with=None, include=None):
+        self.calls.append(("list_blobs", name_starts_with))
+        return [BlobProperties(name=name, size=len(name)) for name in BLOBS if name.startswith(name_starts_with or "")]
+
+    def walk_blobs(self, name_starts_with=None, delimiter="/", results_per_page=None):
+        self.calls.append(("walk_blobs", name_starts_with))
+        prefix = name_starts_with or ""
+        items, folders = [], []
+        for name in BLOBS:
+            if not name.startswith(prefix):
+                continue
+            rest = name[len(prefix):]
+            if delimiter in rest:
+                folder = prefix + rest.split(delimiter)[0] + delimiter
+                if folder not in folders:
+                    folders.append(folder)
+                    items.append(BlobPrefix(prefix=folder))
+            else:
+                items.append(BlobProperties(name=name, size=len(name)))
+        return FakePaged(items, results_per_page)
+
+
+class FakeServiceClient:
+    def __init__(self):
+        self.container_client = FakeContainerClient()
+
+    def get_container_client(self, container_name):
+        return self.container_client
+
+
+@pytest.fixture
+def client():
+    client = AzureBlobStorageClient.__new__(AzureBlobStorageClient)
+    client.container_name = "container"
+    client.blob_service_client = FakeServiceClient()
+    return client
+
+
+def test_iter_folders_lists_folder_prefixes_only(client):
+    assert list(client.iter_folders("pre", results_per_page=2)) == ["C0 - Información Común", "C1 - TRF", "C2 - EFE", "C3 - TRF"]
+    assert list(client.iter_folders("")) == ["pre", "sar"]
+    assert [call for call, _ in client.blob_service_client.container_client.calls] == ["walk_blobs", "walk_blobs"]
+
+
+def test_list_cases_matches_the_flat_listing(client):
+    for filter_by_word in ["ALL", "TRF", "EFE", "XYZ"]:
+        for full_path in [True, False]:
+            hierarchical = client.list_cases("pre", filter_by_word, full_path=full_path)
+            flat = client.list_cases("pre", filter_by_word, full_path=full_path, hierarchical=False)
+            assert hierarchical == flat
+    assert client.list_cases("pre", "TRF") == [os.path.join("pre", "C1 - TRF"), os.path.join("pre", "C3 - TRF")]
+    assert client.list_cases("pre", "ALL", full_path=False, remove_items=[]) == ["C0 - Información Común", "C1 - TRF", "C2 - EFE", "C3 - TRF"]
+
+
+def test_list_entries(client):
+    assert [entry.name for entry in client.list_entries("pre/C1 - TRF/")] == ["pre/C1 - TRF/alert.json", "pre/C1 - TRF/Tabla Resumen.xlsx"]
+    assert [entry.name for entry in client.list_entries("pre/", recursive=False)] == ["pre/index.json"]
@@ -0,0 +1,78 @@
+import os
+import time
+
+from utilities import blobcache
+from utilities.blobcache import BlobContentCache
+
+
+def age(path: str, seconds: float):
+    when = time.time() - seconds
+    os.utime(path, (when, when))
+
+
+def test_put_get_and_delete(tmp_path):
+    cache = BlobContentCache(str(tmp_path))
+    assert cache.get("container", "a.docx") is None
+    cache.put("container", "a.docx", '"0x1"', b"body")
+    assert cache.get("container", "a.docx") == ('"0x1"', b"body")
+    assert cache.get("other", "a.docx") is None
+    cache.put("container", "a.docx", '"0x2"', b"new body")
+    assert cache.get("container", "a.docx") == ('"0x2"', b"new body")
+    cache.delete("container", "a.docx")
+    assert cache.get("container", "a.docx") is None
+    # Without an etag the body cannot be revalidated, so it is not stored
+    cache.put("container", "b.docx", "", b"body")
+    assert cache.get("container", "b.docx") is None
+
+
+def test_evicts_least_recently_used_entries(tmp_path):
+    cache = BlobContentCache(str(tmp_path), max_entries=3)
+    for i in range(3):
+        cache.put("container", f"{i}.docx", f'"{i}"', b"x")
+        age(cache._entry_path("container", f"{i}.docx"), 100 - i)
+    # Reading an entry makes it the most recently used
+    cache.get("container", "0.docx")
+    cache.put("container", "3.docx", '"3"', b"x")
+    assert cache.get("container", "1.docx") is None
+    assert [cache.get("container", f"{i}.docx") is not None for i in (0, 2, 3)] == [True, True, True]
+
+
+def test_evicts_by_size(tmp_path):
+    cache = BlobContentCache(str(tmp_path), max_bytes=100)
+    cache.put("container", "a", '"a"', b"x" * 60)
+    age(cache._entry_path("container", "a"), 10)
+    cache.put("container", "b", '"b"', b"x" * 60)
+    assert cache.get("container", "a") is None
+    assert cache.get("container", "b") is not None
+    # Larger than the whole cache: not stored
+    cache.put("container", "c", '"c"', b"x" * 101)
+    assert cache.get("container", "c") is None
+
+
+def test_lists_the_directory_only_when_a_limit_is_crossed(tmp_path, monkeypatch):
+    scans = []
+    scandir = os.scandir
+    monkeypatch.setattr(blobcache.os, "scandir", lambda path: scans.append(path) or scandir(path))
+    cache = BlobContentCache(str(tmp_path), max_entries=5)
+    for i in range(5):
+        cache.put("container", f"{i}", f'"{i}"', b"x")
+    # The first put lists the directory to learn its size, the following ones keep a running total
+    assert len(scans) == 1
+    cache.put("container", "0", '"0b"', b"x")
+    assert len(scans) == 1
+    cache.put("container", "5", '"5"', b"x")
+    assert len(scans) == 2
+    assert len([name for name in os.listdir(tmp_path) if name.endswith(".blob")]) == 5
+
+
+def test_sweeps_stale_temporary_files(tmp_path):
+    cache = BlobContentCache(str(tmp_path))
+    stale = tmp_path / "stale.tmp"
+    recent = tmp_path / "recent.tmp"
+    stale.write_bytes(b"partial")
+    recent.write_bytes(b"partial")
+    age(str(stale), BlobContentCache.STALE_TMP_SECONDS + 1)
+    cache.evict()
+    assert not stale.exists()
+    # A recent one may be a write in progress in another process
+    assert recent.exists()
@@ -0,0 +1,77 @@
+import os
+import threading
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("langchain_community")
+
+from langchain_core.messages import AIMessage, HumanMessage
+from sqlalchemy import text
+
+from utilities import chat_history
+
+
+@pytest.fixture
+def database_url(tmp_path):
+    database_url = f"sqlite:///{tmp_path / 'memory.db'}"
+    yield database_url
+    chat_history.reset_database(database_url)
+
+
+def test_one_engine_and_history_per_session(database_url):
+    assert chat_history.get_engine(database_url) is chat_history.get_engine(database_url)
+    history = chat_history.get_session_history("C1", database_url)
+    assert chat_history.get_session_history("C1", database_url) is history
+    assert chat_history.get_session_history("C2", database_url) is not history
+    assert history.engine is chat_history.get_engine(database_url)
+
+
+def test_sqlite_databases_use_wal(database_url):
+    with chat_history.get_engine(database_url).connect() as connection:
+        assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+
+
+def test_histories_are_bounded(database_url, monkeypatch):
+    monkeypatch.setenv("CHAT_HISTORY_CACHE_SIZE", "2")
+    first = chat_history.get_session_history("C1", database_url)
+    chat_history.get_session_history("C2", database_url)
+    chat_history.get_session_history("C3", database_url)
+    assert (database_url, "C1") not in chat_history._histories
+    # An evicted history is built again over the same engine, with the same messages
+    first.add_messages([HumanMessage(content="pregunta")])
+    assert chat_history.get_session_history("C1", database_url) is not first
+    assert [m.content for m in chat_history.get_session_history("C1", database_url).messages] == ["pregunta"]
+
+
+def test_clearing_a_session_keeps_the_others(database_url):
+    chat_history.get_session_history("C1", database_url).add_messages([HumanMessage(content="a"), AIMessage(content="b")])
+    chat_history.get_session_history("C2", database_url).add_messages([HumanMessage(content="c")])
+    chat_history.get_session_history("C1", database_url).clear()
+    assert chat_history.get_session_history("C1", database_url).messages == []
+    assert [m.content for m in chat_history.get_session_history("C2", database_url).messages] == ["c"]
+
+
+def test_concurrent_sessions_write_to_the_shared_engine(database_url):
+    def write(session_id):
+        history = chat_history.get_session_history(session_id, database_url)
+        for i in range(10):
+            history.add_messages([HumanMessage(content=f"{session_id}-{i}")])
+
+    threads = [threading.Thread(target=write, args=(f"C{i}",)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for i in range(8):
+        assert len(chat_history.get_session_history(f"C{i}", database_url).messages) == 10
+
+
+def test_reset_database(database_url, tmp_path):
+    chat_history.get_session_history("C1", database_url).add_messages([HumanMessage(content="a")])
+    engine = chat_history.get_engine(database_url)
+    assert os.path.exists(tmp_path / "memory.db")
+    chat_history.reset_database(database_url)
+    assert not any(name.startswith("memory.db") for name in os.listdir(tmp_path))
+    assert chat_history.get_engine(database_url) is not engine
+    assert chat_history.get_session_history("C1", database_url).messages == []
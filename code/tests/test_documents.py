@@ -0,0 +1,108 @@
+import io
+import os
+
+import pytest
+
+docx = pytest.importorskip("docx")
+pytest.importorskip("fitz")
+
+from utilities import documents
+from utilities.documents import extract_documents, get_docx_text, get_docx_text_object_model, get_docx_text_streaming
+
+
+def save(document) -> bytes:
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+
+def assert_same_text(content: bytes):
+    expected = get_docx_text_object_model(content)
+    assert get_docx_text_streaming(content) == expected
+    assert get_docx_text(content) == expected
+
+
+def test_paragraphs():
+    document = docx.Document()
+    document.add_heading("Informe", level=1)
+    document.add_paragraph("Primer párrafo")
+    paragraph = document.add_paragraph("Con ")
+    paragraph.add_run("varias ").bold = True
+    run = paragraph.add_run("líneas")
+    run.add_break()
+    run.add_tab()
+    run.add_text("y tabulador")
+    document.add_paragraph("")
+    document.add_paragraph("Último")
+    assert_same_text(save(document))
+
+
+def test_table_with_merged_cells():
+    document = docx.Document()
+    document.add_paragraph("Antes")
+    table = document.add_table(rows=4, cols=3)
+    for i, row in enumerate(table.rows):
+        for j, cell in enumerate(row.cells):
+            cell.text = f"c{i}{j}"
+    # Horizontal merge (gridSpan) in the header, vertical merge (vMerge) in the first column
+    table.cell(0, 0).merge(table.cell(0, 1))
+    table.cell(1, 0).merge(table.cell(3, 0))
+    # Both at once
+    table.cell(2, 1).merge(table.cell(3, 2))
+    document.add_paragraph("Después")
+    xml = table._tbl.xml
+    assert "w:gridSpan" in xml and "w:vMerge" in xml
+    content = save(document)
+    assert_same_text(content)
+    # A merged cell is repeated once per grid column and row it spans
+    text = get_docx_text_streaming(content)
+    assert "| c00\nc01 | c00\nc01 | c02 |" in text
+    assert "| c10\nc20\nc30 | c21\nc22\nc31\nc32 | c21\nc22\nc31\nc32 |" in text
+
+
+def test_nested_tables():
+    document = docx.Document()
+    table = document.add_table(rows=2, cols=2)
+    table.cell(0, 0).text = "Cabecera"
+    table.cell(0, 1).text = "Detalle"
+    table.cell(1, 0).text = "Fuera"
+    nested = table.cell(1, 1).add_table(rows=2, cols=2)
+    for i, row in enumerate(nested.rows):
+        for j, cell in enumerate(row.cells):
+            cell.text = f"n{i}{j}"
+    document.add_paragraph("Fin")
+    content = save(document)
+    assert_same_text(content)
+    # The nested table is rendered with its container, not as a block of the body
+    assert "n00" not in get_docx_text_streaming(content)
+
+
+def test_extract_documents_keeps_order():
+    # A case with 100 attachments, extracted across the worker processes
+    contents = {}
+    for i in range(100):
+        document = docx.Document()
+        document.add_paragraph(f"Documento {i}")
+        table = document.add_table(rows=2, cols=2)
+        table.cell(1, 1).text = str(i)
+        contents[f"Correos/{99 - i:03d}.docx"] = save(document)
+    timings = {}
+    texts = extract_documents(contents, timings=timings)
+    assert list(texts) == list(contents)
+    assert texts == {filename: get_docx_text(content) for filename, content in contents.items()}
+    assert set(timings) == set(contents)
+
+
+def die_once(marker: str, value: int) -> int:
+    """Kill the worker process the first time it is called (as if it ran out of memory)."""
+    if not os.path.exists(marker):
+        open(marker, "w").close()
+        os._exit(1)
+    return value * 2
+
+
+def test_broken_process_pool_is_replaced(tmp_path):
+    marker = str(tmp_path / "died")
+    pool = documents.get_process_pool()
+    assert documents.map_in_process_pool(die_once, [marker] * 3, [1, 2, 3]) == [2, 4, 6]
+    assert documents.get_process_pool() is not pool
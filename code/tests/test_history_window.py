@@ -0,0 +1,120 @@
+import pytest
+
+pytest.importorskip("langchain_core")
+pytest.importorskip("tiktoken")
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from utilities import history_window
+from utilities.enums import HistoryStrategies
+from utilities.history_window import HistoryWindow, clear_summaries, get_section, split_turns, tag_section
+
+
+def conversation(sections, tagged=True):
+    messages = []
+    for section in sections:
+        messages.append(tag_section(HumanMessage(content=f"pregunta {section}"), section if tagged else None))
+        messages.append(AIMessage(content=f"respuesta {section}"))
+    return messages
+
+
+@pytest.fixture(autouse=True)
+def word_counts(monkeypatch):
+    # One token per word (the tiktoken encodings are downloaded on first use)
+    monkeypatch.setattr(history_window, "count_tokens_batch", lambda texts: [len(t.split()) for t in texts])
+    history_window._summaries.clear()
+
+
+def test_split_turns():
+    messages = [SystemMessage(content="resumen")] + conversation(["A", "B"])
+    turns = split_turns(messages)
+    assert [len(turn) for turn in turns] == [1, 2, 2]
+    assert get_section(turns[1][0]) == "A"
+
+
+def test_full_strategy_keeps_the_whole_conversation():
+    messages = conversation(["A", "B", "C"])
+    assert HistoryWindow().apply(messages) == messages
+
+
+def test_last_n():
+    messages = conversation(["A", "B", "C"])
+    assert HistoryWindow(HistoryStrategies.LAST_N, last_n=2).apply(messages) == messages[2:]
+    assert HistoryWindow(HistoryStrategies.LAST_N, last_n=0).apply(messages) == []
+
+
+def test_sections_select_the_latest_turn_of_each_dependency():
+    messages = conversation(["A", "B", "A", "C"])
+    window = HistoryWindow()
+    assert window.apply(messages, sections=["A", "C"]) == messages[4:8]
+    assert window.apply(messages, sections=["B"]) == messages[2:4]
+    # An empty selection sends no history, None sends the whole window
+    assert window.apply(messages, sections=[]) == []
+    assert window.apply(messages, sections=None) == messages
+
+
+def test_untagged_history_is_sent_whole():
+    messages = conversation(["A", "B"], tagged=False)
+    assert HistoryWindow().apply(messages, sections=["A"]) == messages
+
+
+def test_summary_replaces_the_older_turns():
+    summarised = []
+
+    def summarizer(messages):
+        summarised.append(messages)
+        return "resumen"
+
+    messages = conversation(["A", "B", "C"])
+    # Each turn is 4 tokens: the last two fit in 8
+    window = HistoryWindow(HistoryStrategies.SUMMARY, max_tokens=8, summarizer=summarizer)
+    result = window.apply(messages, session_id="C1")
+    assert isinstance(result[0], SystemMessage) and "resumen" in result[0].content
+    assert result[1:] == messages[2:]
+    assert summarised == [messages[:2]]
+    # Everything fits: no summary
+    assert HistoryWindow(HistoryStrategies.SUMMARY, max_tokens=100, summarizer=summarizer).apply(messages) == messages
+    assert len(summarised) == 1
+
+
+def test_summaries_are_shared_by_session_and_length():
+    calls = []
+
+    def summarizer(messages):
+        calls.append(messages)
+        return f"resumen {len(calls)}"
+
+    messages = conversation(["A", "B", "C"])
+    first = HistoryWindow(HistoryStrategies.SUMMARY, max_tokens=4, summarizer=summarizer)
+    second = HistoryWindow(HistoryStrategies.SUMMARY, max_tokens=4, summarizer=summarizer)
+    assert first.apply(messages, session_id="C1") == second.apply(messages, session_id="C1")
+    assert len(calls) == 1
+    # A longer history, another session or no session are summarised again
+    second.apply(messages + conversation(["D"]), session_id="C1")
+    second.apply(messages, session_id="C2")
+    second.apply(messages)
+    assert len(calls) == 4
+    clear_summaries("C1")
+    first.apply(messages, session_id="C1")
+    assert len(calls) == 5
+
+
+def test_summary_strategy_needs_a_summarizer():
+    with pytest.raises(ValueError):
+        HistoryWindow(HistoryStrategies.SUMMARY)
+
+
+def test_from_env(monkeypatch):
+    monkeypatch.setenv("HISTORY_STRATEGY", "LAST_N")
+    monkeypatch.setenv("HISTORY_LAST_N", "3")
+    window = HistoryWindow.from_env()
+    assert window.strategy == HistoryStrategies.LAST_N and window.last_n == 3
+
+
+def test_section_dependencies():
+    from utilities.enums import QuestionsTypes
+    from utilities.prenarrative import get_section_dependencies
+
+    # Sections without declared dependencies are asked with the whole window
+    assert get_section_dependencies(QuestionsTypes.PRINCIPAL_IMPLICADO) is None
+    assert get_section_dependencies(QuestionsTypes.DOCUMENTACION_ADICIONAL) == ["NATURALEZA_ALERTA", "ANALISIS_OPERATIVA"]
@@ -0,0 +1,107 @@
+import os
+import time
+
+import pytest
+
+pytest.importorskip("dotenv")
+
+from utilities.manifest import CaseManifest
+from utilities.storage import LocalStorageBackend
+
+
+class CountingStorage(LocalStorageBackend):
+    """Local storage that records the listings it serves."""
+
+    def __init__(self, root_path: str):
+        super().__init__(root_path)
+        self.listings = []
+
+    def list_entries(self, prefix: str = '', recursive: bool = True, container_name=None):
+        self.listings.append(("entries", prefix, recursive))
+        return super().list_entries(prefix, recursive=recursive)
+
+    def iter_folders(self, path: str, container_name=None, results_per_page=None):
+        self.listings.append(("folders", path))
+        return super().iter_folders(path)
+
+
+def write(root, path: str, content: bytes = b"{}"):
+    full_path = os.path.join(root, *path.split("/"))
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, "wb") as f:
+        f.write(content)
+
+
+@pytest.fixture
+def storage(tmp_path):
+    for path in ["pre/C1 - A/alert.json", "pre/C1 - A/sub/x.xlsx", "pre/C2 - B/alert.json", "pre/readme.txt",
+                 "templates/sar.docx", "other/folder/file.txt"]:
+        write(tmp_path, path)
+    return CountingStorage(str(tmp_path))
+
+
+def test_queries_match_the_storage(storage):
+    manifest = CaseManifest(storage, roots=["pre", "templates"])
+    assert manifest.cases("pre", "ALL", full_path=False) == storage.list_cases("pre", "ALL", full_path=False)
+    assert manifest.cases("pre", "B") == [os.path.join("pre", "C2 - B")]
+    assert manifest.files("pre/C1 - A") == ["pre/C1 - A/alert.json", "pre/C1 - A/sub/x.xlsx"]
+    assert manifest.files("pre/C1 - A/sub", full_path=False) == ["x.xlsx"]
+    assert manifest.files("pre") == ["pre/C1 - A/alert.json", "pre/C1 - A/sub/x.xlsx", "pre/C2 - B/alert.json", "pre/readme.txt"]
+    assert manifest.files("") == manifest.files("pre") + ["templates/sar.docx"]
+    assert manifest.files("other") == ["other/folder/file.txt"]
+    assert manifest.entry("pre/C2 - B/alert.json").size == 2
+    assert manifest.entry("pre/C2 - B/missing.json") is None
+
+
+def test_queries_are_served_from_the_index(storage):
+    manifest = CaseManifest(storage, roots=["pre", "templates"])
+    manifest.files("")
+    manifest.files("other")
+    listings = len(storage.listings)
+    # One listing per root and per folder outside the roots
+    assert listings == 3
+    for _ in range(3):
+        manifest.files("")
+        manifest.files("pre")
+        manifest.files("pre/C1 - A")
+        manifest.files("templates")
+        manifest.files("other")
+        manifest.cases("pre", "ALL")
+    assert len(storage.listings) == listings
+
+
+def test_stale_folders_are_listed_again(storage, tmp_path):
+    manifest = CaseManifest(storage, roots=["pre"], max_age=0.05)
+    assert manifest.files("pre/C1 - A", full_path=False) == ["alert.json", "x.xlsx"]
+    write(tmp_path, "pre/C1 - A/new.json")
+    # Within max_age the index is served as it is
+    assert "new.json" not in manifest.files("pre/C1 - A", full_path=False)
+    time.sleep(0.1)
+    assert "new.json" in manifest.files("pre/C1 - A", full_path=False)
+
+
+def test_invalidate(storage, tmp_path):
+    manifest = CaseManifest(storage, roots=["pre"], max_age=3600)
+    assert manifest.cases("pre", "ALL", full_path=False) == ["C1 - A", "C2 - B"]
+    manifest.files("pre/C1 - A")
+    manifest.files("other")
+    write(tmp_path, "pre/C3 - C/alert.json")
+    write(tmp_path, "pre/C1 - A/new.json")
+    write(tmp_path, "other/folder/new.txt")
+    assert manifest.cases("pre", "ALL", full_path=False) == ["C1 - A", "C2 - B"]
+    manifest.invalidate("pre/C3 - C/alert.json")
+    manifest.invalidate("pre/C1 - A/new.json")
+    manifest.invalidate("other/folder/new.txt")
+    assert manifest.cases("pre", "ALL", full_path=False) == ["C1 - A", "C2 - B", "C3 - C"]
+    assert manifest.entry("pre/C1 - A/new.json") is not None
+    assert "other/folder/new.txt" in manifest.files("other")
+
+
+def test_refresh_drops_removed_cases(storage, tmp_path):
+    manifest = CaseManifest(storage, roots=["pre"])
+    manifest.build()
+    os.remove(os.path.join(tmp_path, "pre", "C2 - B", "alert.json"))
+    os.rmdir(os.path.join(tmp_path, "pre", "C2 - B"))
+    manifest.refresh(force=True)
+    assert manifest.cases("pre", "ALL", full_path=False) == ["C1 - A"]
+    assert manifest.files("pre") == ["pre/C1 - A/alert.json", "pre/C1 - A/sub/x.xlsx", "pre/readme.txt"]
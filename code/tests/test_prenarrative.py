@@ -0,0 +1,101 @@
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip("langchain_core")
+pytest.importorskip("langchain_openai")
+
+from utilities.enums import QuestionsTypes
+from utilities.history_window import get_section
+from utilities.prenarrative import ask_section_plan, build_section_plan, run_section_plan
+
+Q = QuestionsTypes
+
+
+class FakeReportGenerator:
+    """Answers each prompt after a short wait, recording the history it was asked with and the concurrency."""
+
+    def __init__(self, fail=None):
+        self.histories = {}
+        self.running = 0
+        self.max_running = 0
+        self.fail = fail
+        self.on_admission_wait = None
+
+    async def _answer(self, question, history):
+        self.histories[question] = history
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(0.05)
+            if question == self.fail:
+                raise RuntimeError("rate limited")
+        finally:
+            self.running -= 1
+        return f"respuesta a {question}"
+
+    async def astream_with_history(self, question, history):
+        answer = await self._answer(question, history)
+        for word in answer.split(" "):
+            yield word + " "
+
+    async def ainvoke_with_history(self, question, history):
+        return await self._answer(question, history)
+
+
+def prompts(*questions):
+    return {question: question.name for question in questions}
+
+
+def test_build_section_plan_keeps_the_dependencies_in_the_plan():
+    plan = build_section_plan(prompts(Q.NATURALEZA_ALERTA, Q.ANALISIS_OPERATIVA, Q.DOCUMENTACION_ADICIONAL, Q.RECOMENDACION_INICIAL, Q.GRAFO_INTERVINIENTES))
+    sections = {section.question: section for section in plan}
+    assert [section.question for section in plan] == [Q.NATURALEZA_ALERTA, Q.ANALISIS_OPERATIVA, Q.DOCUMENTACION_ADICIONAL, Q.RECOMENDACION_INICIAL, Q.GRAFO_INTERVINIENTES]
+    assert sections[Q.NATURALEZA_ALERTA].depends_on == ()
+    assert sections[Q.DOCUMENTACION_ADICIONAL].depends_on == (Q.NATURALEZA_ALERTA, Q.ANALISIS_OPERATIVA)
+    # PRINCIPAL_IMPLICADO and CONTEXTO_HISTORICO are not part of the plan
+    assert sections[Q.RECOMENDACION_INICIAL].depends_on == (Q.NATURALEZA_ALERTA, Q.ANALISIS_OPERATIVA)
+    assert not sections[Q.GRAFO_INTERVINIENTES].stream
+    assert sections[Q.NATURALEZA_ALERTA].stream
+
+
+def test_run_section_plan():
+    plan = build_section_plan(prompts(Q.NATURALEZA_ALERTA, Q.PRINCIPAL_IMPLICADO, Q.CONTEXTO_HISTORICO, Q.ANALISIS_OPERATIVA,
+                                      Q.RECOMENDACION_INICIAL, Q.GRAFO_INTERVINIENTES))
+    generator = FakeReportGenerator()
+    done = []
+    answers = asyncio.run(run_section_plan(generator, plan, on_done=lambda question, answer: done.append(question), max_concurrency=3))
+    assert list(answers) == [section.question for section in plan]
+    assert answers[Q.GRAFO_INTERVINIENTES] == "respuesta a GRAFO_INTERVINIENTES"
+    assert answers[Q.NATURALEZA_ALERTA].strip() == "respuesta a NATURALEZA_ALERTA"
+    # Independent sections run concurrently, up to max_concurrency, each one without history
+    assert generator.max_running == 3
+    assert generator.histories["NATURALEZA_ALERTA"] == []
+    # The dependent section is asked last, with the turns of its dependencies in plan order
+    assert done[-1] == Q.RECOMENDACION_INICIAL
+    history = generator.histories["RECOMENDACION_INICIAL"]
+    assert [get_section(message) for message in history[::2]] == ["NATURALEZA_ALERTA", "PRINCIPAL_IMPLICADO", "CONTEXTO_HISTORICO", "ANALISIS_OPERATIVA"]
+    assert history[1].content == answers[Q.NATURALEZA_ALERTA]
+
+
+def test_a_failed_section_cancels_the_others():
+    plan = build_section_plan(prompts(Q.NATURALEZA_ALERTA, Q.PRINCIPAL_IMPLICADO, Q.RECOMENDACION_INICIAL))
+    generator = FakeReportGenerator(fail="NATURALEZA_ALERTA")
+    with pytest.raises(RuntimeError):
+        asyncio.run(run_section_plan(generator, plan))
+    assert generator.running == 0
+    assert "RECOMENDACION_INICIAL" not in generator.histories
+
+
+def test_ask_section_plan_calls_back_from_the_calling_thread():
+    plan = build_section_plan(prompts(Q.NATURALEZA_ALERTA, Q.PRINCIPAL_IMPLICADO))
+    generator = FakeReportGenerator()
+    generator.on_admission_wait = original = lambda status: None
+    threads = set()
+    answers = ask_section_plan(generator, plan,
+                               on_chunk=lambda question, text: threads.add(threading.get_ident()),
+                               on_done=lambda question, answer: threads.add(threading.get_ident()))
+    assert threads == {threading.get_ident()}
+    assert list(answers) == [Q.NATURALEZA_ALERTA, Q.PRINCIPAL_IMPLICADO]
+    assert generator.on_admission_wait is original
@@ -0,0 +1,144 @@
+import asyncio
+import email.utils
+import time
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+openai = pytest.importorskip("openai")
+
+from utilities import retry
+from utilities.retry import RetryPolicy, astream_with_retry, call_with_retry, get_retry_after, is_retryable, parse_duration, stream_with_retry
+
+
+def status_error(status_code: int, headers=None) -> openai.APIStatusError:
+    request = httpx.Request("POST", "https://example.openai.azure.com/chat/completions")
+    response = httpx.Response(status_code, headers=headers or {}, request=request)
+    error_class = openai.RateLimitError if status_code == 429 else openai.APIStatusError
+    return error_class("error", response=response, body=None)
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(retry.time, "sleep", sleeps.append)
+
+    async def asleep(delay):
+        sleeps.append(delay)
+    monkeypatch.setattr(retry.asyncio, "sleep", asleep)
+    return sleeps
+
+
+def test_parse_duration():
+    assert parse_duration("20ms") == pytest.approx(0.02)
+    assert parse_duration("1.5s") == 1.5
+    assert parse_duration("6m0s") == 360
+    assert parse_duration("1h2m3s") == 3723
+    assert parse_duration("2") == 2
+    assert parse_duration("soon") is None
+
+
+def test_get_retry_after():
+    assert get_retry_after(None) is None
+    assert get_retry_after(httpx.Headers({})) is None
+    assert get_retry_after(httpx.Headers({"retry-after-ms": "1500", "retry-after": "9"})) == 1.5
+    assert get_retry_after(httpx.Headers({"retry-after": "7"})) == 7
+    http_date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 28 <= get_retry_after(httpx.Headers({"retry-after": http_date})) <= 30
+    past_date = email.utils.formatdate(time.time() - 30, usegmt=True)
+    assert get_retry_after(httpx.Headers({"retry-after": past_date})) == 0
+    assert get_retry_after(httpx.Headers({"retry-after": "not a date"})) is None
+    # Only the resets of the exhausted limits count
+    assert get_retry_after(httpx.Headers({
+        "x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "2s",
+        "x-ratelimit-remaining-tokens": "0", "x-ratelimit-reset-tokens": "1m",
+    })) == 60
+    assert get_retry_after(httpx.Headers({
+        "x-ratelimit-remaining-requests": "3", "x-ratelimit-reset-requests": "2s",
+        "x-ratelimit-remaining-tokens": "0", "x-ratelimit-reset-tokens": "500ms",
+    })) == 0.5
+    assert get_retry_after(httpx.Headers({"x-ratelimit-remaining-tokens": "10", "x-ratelimit-reset-tokens": "1s"})) is None
+
+
+def test_is_retryable():
+    assert is_retryable(status_error(429))
+    assert is_retryable(status_error(503))
+    assert not is_retryable(status_error(400))
+    assert not is_retryable(status_error(401))
+    assert is_retryable(openai.APITimeoutError(request=httpx.Request("POST", "https://example.com")))
+    assert is_retryable(httpx.ReadError("connection reset"))
+    assert not is_retryable(ValueError("bad prompt"))
+
+
+def test_delay_uses_retry_after_capped_by_max_delay():
+    policy = RetryPolicy(base_delay=1.0, max_delay=10.0)
+    assert 3 <= policy.delay(status_error(429, {"retry-after": "3"}), attempt=0) <= 3.1
+    assert 10 <= policy.delay(status_error(429, {"retry-after": "300"}), attempt=0) <= 10.1
+    # Without headers: full jitter over the exponential backoff, capped
+    for attempt in range(8):
+        assert 0 <= policy.delay(status_error(503), attempt) <= min(10.0, 2 ** attempt)
+
+
+def test_call_with_retry(no_sleep):
+    errors = [status_error(429, {"retry-after-ms": "250"}), status_error(503)]
+
+    def call():
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    assert call_with_retry(call, RetryPolicy(max_retries=2)) == "ok"
+    assert len(no_sleep) == 2 and 0.25 <= no_sleep[0] <= 0.35
+
+
+def test_call_with_retry_gives_up(no_sleep):
+    calls = []
+
+    def call():
+        calls.append(1)
+        raise status_error(429)
+
+    with pytest.raises(openai.RateLimitError):
+        call_with_retry(call, RetryPolicy(max_retries=3))
+    assert len(calls) == 4
+    calls.clear()
+
+    def bad_request():
+        calls.append(1)
+        raise status_error(400)
+
+    with pytest.raises(openai.APIStatusError):
+        call_with_retry(bad_request, RetryPolicy(max_retries=3))
+    assert len(calls) == 1
+
+
+def test_stream_is_resumed_from_the_partial_answer():
+    starts = []
+
+    def start(partial):
+        # The model is asked to continue the partial answer
+        starts.append(partial)
+        if not partial:
+            yield "Hola, "
+            raise httpx.ReadError("connection reset")
+        yield "mundo"
+
+    assert "".join(stream_with_retry(start, RetryPolicy())) == "Hola, mundo"
+    assert starts == ["", "Hola, "]
+
+
+def test_async_stream_is_resumed_from_the_partial_answer():
+    starts = []
+
+    async def start(partial):
+        starts.append(partial)
+        if not partial:
+            yield "uno "
+            raise status_error(503)
+        yield "dos"
+
+    async def consume():
+        return "".join([chunk async for chunk in astream_with_retry(start, RetryPolicy())])
+
+    assert asyncio.run(consume()) == "uno dos"
+    assert starts == ["", "uno "]
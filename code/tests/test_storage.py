@@ -0,0 +1,132 @@
+import io
+import random
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("dotenv")
+
+from utilities.storage import LocalStorageBackend, MemoryViewIO
+
+
+def test_memory_view_io_reads_and_seeks_without_copying():
+    buffer = bytearray(b"0123456789")
+    stream = MemoryViewIO(buffer)
+    assert stream.read(3) == b"012"
+    assert stream.seek(-2, io.SEEK_END) == 8
+    assert stream.read() == b"89"
+    assert stream.read(5) == b""
+    stream.seek(2)
+    chunk = bytearray(4)
+    assert stream.readinto(chunk) == 4 and chunk == b"2345"
+    assert stream.getbuffer().obj is buffer
+    with pytest.raises(ValueError):
+        stream.seek(-1)
+
+
+def test_memory_view_io_writes_into_a_preallocated_buffer():
+    buffer = bytearray(6)
+    stream = MemoryViewIO(buffer)
+    stream.seek(3)
+    stream.write(b"def")
+    stream.seek(0)
+    stream.write(memoryview(b"abc"))
+    assert buffer == b"abcdef"
+    # It never grows the buffer
+    stream.seek(0, io.SEEK_END)
+    with pytest.raises(ValueError):
+        stream.write(b"g")
+    assert not MemoryViewIO(b"read only").writable()
+
+
+def test_memory_view_io_is_a_file_for_readers():
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zip_file:
+        zip_file.writestr("word/document.xml", "<xml/>")
+    closed = []
+    with MemoryViewIO(archive.getvalue(), on_close=lambda: closed.append(True)) as stream:
+        with zipfile.ZipFile(stream) as zip_file:
+            assert zip_file.read("word/document.xml") == b"<xml/>"
+    assert closed == [True]
+
+
+def test_local_open_file_memory_maps_large_files(tmp_path):
+    content = bytes(random.Random(0).getrandbits(8) for _ in range(10000))
+    (tmp_path / "case").mkdir()
+    (tmp_path / "case" / "large.xlsx").write_bytes(content)
+    (tmp_path / "case" / "small.json").write_bytes(b"{}")
+    storage = LocalStorageBackend(str(tmp_path), mmap_threshold=1024)
+    with storage.open_file("case/large.xlsx") as stream:
+        assert isinstance(stream, MemoryViewIO)
+        assert stream.read() == content
+    with storage.open_file("case/small.json") as stream:
+        assert stream.read() == b"{}"
+
+
+azure = pytest.importorskip("azure.storage.blob")
+
+from azure.core.exceptions import ResourceNotModifiedError  # noqa: E402
+
+from utilities.azureblobstorage import AzureBlobStorageClient  # noqa: E402
+from utilities.blobcache import BlobContentCache  # noqa: E402
+
+
+class FakeDownloader:
+    """A StorageStreamDownloader that writes its ranges into the stream from several threads, out of order."""
+
+    def __init__(self, content: bytes, etag: str, chunk_size: int, max_concurrency: int):
+        self.content = content
+        self.size = len(content)
+        self.properties = type("Properties", (), {"etag": etag})()
+        self.chunk_size = chunk_size
+        self.max_concurrency = max_concurrency
+
+    def readinto(self, stream) -> int:
+        lock = threading.Lock()
+        offsets = list(range(0, self.size, self.chunk_size))
+        random.Random(1).shuffle(offsets)
+
+        def write_range(offset):
+            with lock:
+                stream.seek(offset)
+                stream.write(self.content[offset:offset + self.chunk_size])
+
+        with ThreadPoolExecutor(self.max_concurrency) as executor:
+            list(executor.map(write_range, offsets))
+        return self.size
+
+    def readall(self) -> bytes:
+        return self.content
+
+
+class FakeBlobClient:
+    def __init__(self, content: bytes, etag: str):
+        self.content = content
+        self.etag = etag
+        self.downloads = 0
+
+    def download_blob(self, max_concurrency=1, etag=None, match_condition=None, raw_request_hook=None):
+        self.downloads += 1
+        if etag == self.etag:
+            raise ResourceNotModifiedError("Not modified")
+        return FakeDownloader(self.content, self.etag, chunk_size=1000, max_concurrency=max_concurrency)
+
+
+def test_open_file_downloads_ranges_into_one_buffer(tmp_path):
+    content = bytes(random.Random(2).getrandbits(8) for _ in range(10500))
+    blob_client = FakeBlobClient(content, '"0x1"')
+    client = AzureBlobStorageClient.__new__(AzureBlobStorageClient)
+    client.container_name = "container"
+    client.max_concurrency = 4
+    client.cache = BlobContentCache(str(tmp_path))
+    client.blob_service_client = type("Service", (), {"get_blob_client": lambda self, container, blob: blob_client})()
+
+    with client.open_file("case/Tabla Resumen.xlsx") as stream:
+        assert isinstance(stream.getbuffer().obj, bytearray)
+        assert stream.read() == content
+    assert client.cache.get("container", "case/Tabla Resumen.xlsx") == ('"0x1"', content)
+    # Revalidated with the cached etag: served from the cache
+    assert client.get_file("case/Tabla Resumen.xlsx") == content
+    assert blob_client.downloads == 2
@@ -0,0 +1,95 @@
+import datetime
+import io
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+openpyxl = pytest.importorskip("openpyxl")
+
+from utilities.tables import read_excel_sheet, read_excel_sheet_two_pass, read_excel_with_dynamic_headers
+
+
+def workbook(*sheets) -> bytes:
+    """Workbook with a sheet per (name, rows, merged ranges) tuple."""
+    book = openpyxl.Workbook()
+    book.remove(book.active)
+    for name, rows, merged in sheets:
+        worksheet = book.create_sheet(name)
+        for row_number, row in enumerate(rows, start=1):
+            for column_number, value in enumerate(row, start=1):
+                if value is not None:
+                    worksheet.cell(row=row_number, column=column_number, value=value)
+        for cell_range in merged:
+            worksheet.merge_cells(cell_range)
+    buffer = io.BytesIO()
+    book.save(buffer)
+    return buffer.getvalue()
+
+
+def assert_same_result(content: bytes, sheet=None):
+    df, header_row = read_excel_sheet(io.BytesIO(content), sheet=sheet)
+    expected, expected_header_row = read_excel_sheet_two_pass(io.BytesIO(content), sheet=sheet)
+    assert header_row == expected_header_row
+    pd.testing.assert_frame_equal(df, expected)
+    pd.testing.assert_frame_equal(read_excel_with_dynamic_headers(io.BytesIO(content), sheet=sheet), expected)
+    return df, header_row
+
+
+def test_offset_header():
+    content = workbook(("Tabla", [
+        ["Informe de alertas"],
+        ["Generado", "2024-01-31"],
+        ["Cliente", "Importe", "Fecha", "País"],
+        ["A", 10, datetime.datetime(2024, 1, 1), "ES"],
+        ["B", 20.5, datetime.datetime(2024, 1, 2), "FR"],
+    ], []))
+    df, header_row = assert_same_result(content)
+    assert header_row == 2
+    assert list(df.columns) == ["Cliente", "Importe", "Fecha", "País"]
+
+
+def test_blank_leading_rows():
+    content = workbook(("Tabla", [
+        [],
+        [],
+        [None, "Cliente", "Importe"],
+        [None, "A", 1],
+        [None, None, None],
+        [None, "B", 2],
+    ], []))
+    _, header_row = assert_same_result(content)
+    assert header_row == 2
+
+
+def test_merged_header_cells():
+    content = workbook(("Tabla", [
+        ["Titular", None, "Operativa", None],
+        ["Nombre", "Documento", "Entradas", "Salidas"],
+        ["A", "X1", 100, 50],
+        ["B", "X2", 200, None],
+    ], ["A1:B1", "C1:D1"]))
+    df, header_row = assert_same_result(content)
+    assert header_row == 1
+
+
+def test_mixed_dtypes():
+    content = workbook(("Tabla", [
+        ["Clave", "Valor", "Fecha", "Activo"],
+        ["A", 1, datetime.datetime(2024, 1, 1), True],
+        ["B", 2.5, "sin fecha", False],
+        ["C", "n/a", None, None],
+        [3, None, datetime.datetime(2024, 3, 1, 12, 30), True],
+        ["D", "=1/0", None, "sí"],
+    ], []))
+    assert_same_result(content)
+
+
+def test_sheet_by_name_and_no_header():
+    content = workbook(
+        ("Primera", [["x"]], []),
+        ("Segunda", [["Cliente", "Importe"], ["A", 1]], []),
+        ("Vacía", [], []),
+    )
+    df, header_row = assert_same_result(content, sheet="Segunda")
+    assert header_row == 0 and list(df.columns) == ["Cliente", "Importe"]
+    assert_same_result(content, sheet="Vacía")
@@ -0,0 +1,45 @@
+import pytest
+
+tiktoken = pytest.importorskip("tiktoken")
+pytest.importorskip("streamlit")
+
+from utilities import tokenizer, utils
+
+TEXTS = [
+    "",
+    "Transferencia recibida de 1.250,00 € desde ES91 2100 0418 4502 0005 1332",
+    "| Fecha | Importe |\n| --- | --- |\n| 2024-01-01 | 10 |",
+    "<|endoftext|> is counted as plain text",
+    "Transferencia recibida de 1.250,00 € desde ES91 2100 0418 4502 0005 1332",
+]
+
+
+@pytest.fixture
+def encoding(monkeypatch):
+    """Byte-level encoding (the tiktoken encodings are downloaded on first use), used as the model encoding."""
+    encoding = tiktoken.Encoding(
+        name="test_bytes",
+        pat_str=r"\S+|\s+",
+        mergeable_ranks={bytes([i]): i for i in range(256)},
+        special_tokens={"<|endoftext|>": 256},
+    )
+    monkeypatch.setattr(tokenizer, "get_model_encoding", lambda model_name=None: encoding)
+    monkeypatch.setattr(tokenizer, "get_encoding", lambda encoding_name: encoding)
+    tokenizer._counts.clear()
+    return encoding
+
+
+def test_num_tokens_from_string_matches_tokenizer(encoding):
+    for text in TEXTS:
+        expected = len(encoding.encode_ordinary(text))
+        assert tokenizer.count_tokens(text) == expected
+        assert utils.num_tokens_from_string(text) == expected
+        assert utils.num_tokens_from_string(text, "test_bytes") == expected
+
+
+def test_count_tokens_batch_matches_single_counts(encoding):
+    expected = [len(encoding.encode_ordinary(text)) for text in TEXTS]
+    assert tokenizer.count_tokens_batch(TEXTS) == expected
+    # Served from the memoised counts the second time
+    assert tokenizer.count_tokens_batch(list(reversed(TEXTS))) == list(reversed(expected))
+    assert len(tokenizer._counts) == len(set(TEXTS))
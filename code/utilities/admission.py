@@ -0,0 +1,222 @@
+"""
+This module contains the AdmissionController class, which shares the TPM/RPM quota of a model deployment between
+all the sessions of the process. Every LLM call asks for admission with an estimate of its tokens (input tokens
+plus the expected answer) and waits until two token buckets (tokens and requests per minute) can afford it, so
+simultaneous generations queue instead of running into 429s.
+
+Waiting calls are admitted in round-robin between queues (one per analyst session): a session that asks many
+sections at once cannot starve the others. Callers get their queue position and estimated wait while they wait.
+"""
+
+import asyncio
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Callable, Deque, Dict, List, Optional
+
+# Seconds between updates of the status of a waiting call
+STATUS_INTERVAL = 0.5
+
+
+@dataclass
+class AdmissionStatus:
+    """Status of a call waiting for admission."""
+    position: int
+    queued: int
+    wait: float
+
+
+@dataclass(eq=False)
+class Ticket:
+    """A call asking for admission."""
+    queue: str
+    tokens: int
+    admitted: bool = False
+
+
+class TokenBucket:
+
+    def __init__(self, capacity: float, per_seconds: float = 60.0):
+        """Bucket of `capacity` units, refilled at `capacity` units every `per_seconds` seconds."""
+        self.capacity = capacity
+        self.rate = capacity / per_seconds
+        self.available = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_for(self, amount: float) -> float:
+        """Seconds until `amount` units are available (0 if they already are)."""
+        return max(0.0, (amount - self.available) / self.rate)
+
+
+class AdmissionController:
+
+    def __init__(self, tpm_limit: int = 0, rpm_limit: int = 0):
+        """
+        Args:
+            tpm_limit (int): Tokens per minute of the deployment (0 for no limit).
+            rpm_limit (int): Requests per minute of the deployment (0 for no limit).
+        """
+        self.tokens = TokenBucket(tpm_limit) if tpm_limit > 0 else None
+        self.requests = TokenBucket(rpm_limit) if rpm_limit > 0 else None
+        # Waiting tickets of each queue, in the round-robin order of the queues
+        self._queues: "OrderedDict[str, Deque[Ticket]]" = OrderedDict()
+        self._condition = threading.Condition()
+
+    @property
+    def enabled(self) -> bool:
+        return self.tokens is not None or self.requests is not None
+
+    def _waiting(self) -> List[Ticket]:
+        """Waiting tickets, in the order they will be admitted (round-robin between queues)."""
+        queues = [list(queue) for queue in self._queues.values()]
+        return [ticket for round_ in itertools.zip_longest(*queues) for ticket in round_ if ticket is not None]
+
+    def _wait_for(self, tickets: List[Ticket]) -> float:
+        waits = [0.0]
+        if self.tokens is not None:
+            waits.append(self.tokens.wait_for(sum(min(ticket.tokens, self.tokens.capacity) for ticket in tickets)))
+        if self.requests is not None:
+            waits.append(self.requests.wait_for(len(tickets)))
+        return max(waits)
+
+    def _try_admit(self, ticket: Ticket) -> Optional[AdmissionStatus]:
+        """Admit the ticket if it is next and the quota affords it; otherwise return its status. Call with the lock."""
+        if self.tokens is not None:
+            self.tokens.refill()
+        if self.requests is not None:
+            self.requests.refill()
+        waiting = self._waiting()
+        position = waiting.index(ticket)
+        if position == 0 and self._wait_for([ticket]) == 0:
+            if self.tokens is not None:
+                self.tokens.available -= min(ticket.tokens, self.tokens.capacity)
+            if self.requests is not None:
+                self.requests.available -= 1
+            queue = self._queues[ticket.queue]
+            queue.popleft()
+            # The queue goes to the end of the round
+            del self._queues[ticket.queue]
+            if queue:
+                self._queues[ticket.queue] = queue
+            ticket.admitted = True
+            self._condition.notify_all()
+            return None
+        return AdmissionStatus(position=position + 1, queued=len(waiting), wait=self._wait_for(waiting[:position + 1]))
+
+    def _enqueue(self, queue: str, tokens: int) -> Ticket:
+        ticket = Ticket(queue=queue, tokens=tokens)
+        with self._condition:
+            self._queues.setdefault(queue, deque()).append(ticket)
+        return ticket
+
+    def _cancel(self, ticket: Ticket):
+        with self._condition:
+            queue = self._queues.get(ticket.queue)
+            if queue is not None and ticket in queue:
+                queue.remove(ticket)
+                if not queue:
+                    del self._queues[ticket.queue]
+            self._condition.notify_all()
+
+    def acquire(self, queue: str, tokens: int, on_wait: Optional[Callable[[Optional[AdmissionStatus]], None]] = None) -> Ticket:
+        """
+        Wait until a call of (about) `tokens` tokens of the given queue (session) is admitted.
+        `on_wait` is called, from the calling thread, with the status of the call while it waits, and with None
+        once a call that had to wait is admitted.
+        """
+        ticket = self._enqueue(queue, tokens)
+        if not self.enabled:
+            self._cancel(ticket)
+            ticket.admitted = True
+            return ticket
+        start = time.monotonic()
+        waited = False
+        try:
+            while True:
+                with self._condition:
+                    status = self._try_admit(ticket)
+                    if status is None:
+                        break
+                    self._condition.wait(timeout=min(STATUS_INTERVAL, max(status.wait, 0.01)))
+                waited = True
+                if on_wait:
+                    on_wait(status)
+        except BaseException:
+            self._cancel(ticket)
+            raise
+        self._admitted(ticket, start, on_wait if waited else None)
+        return ticket
+
+    async def aacquire(self, queue: str, tokens: int, on_wait: Optional[Callable[[Optional[AdmissionStatus]], None]] = None) -> Ticket:
+        """Asynchronous version of acquire, which waits without blocking the event loop."""
+        ticket = self._enqueue(queue, tokens)
+        if not self.enabled:
+            self._cancel(ticket)
+            ticket.admitted = True
+            return ticket
+        start = time.monotonic()
+        waited = False
+        try:
+            while True:
+                with self._condition:
+                    status = self._try_admit(ticket)
+                if status is None:
+                    break
+                waited = True
+                if on_wait:
+                    on_wait(status)
+                await asyncio.sleep(min(STATUS_INTERVAL, max(status.wait, 0.01)))
+        except BaseException:
+            self._cancel(ticket)
+            raise
+        self._admitted(ticket, start, on_wait if waited else None)
+        return ticket
+
+    @staticmethod
+    def _admitted(ticket: Ticket, start: float, on_wait: Optional[Callable[[Optional[AdmissionStatus]], None]]):
+        # Tell the callers that were shown a waiting status that the call was admitted
+        if on_wait:
+            on_wait(None)
+        waited = time.monotonic() - start
+        if waited >= 1:
+            logging.info(f"LLM call of {ticket.tokens} tokens admitted after waiting {waited:.1f} s")
+
+    def settle(self, ticket: Ticket, used_tokens: int):
+        """Correct the token bucket with the tokens actually used by an admitted call (instead of its estimate)."""
+        if self.tokens is None or not ticket.admitted:
+            return
+        with self._condition:
+            self.tokens.refill()
+            estimate = min(ticket.tokens, self.tokens.capacity)
+            self.tokens.available = min(self.tokens.capacity, self.tokens.available + estimate - used_tokens)
+            self._condition.notify_all()
+
+
+_controllers: Dict[str, AdmissionController] = {}
+_controllers_lock = threading.Lock()
+
+
+def get_admission_controller(interface: str, model: str) -> AdmissionController:
+    """Return the process-wide admission controller of a deployment, limited by LLM_TPM_LIMIT and LLM_RPM_LIMIT."""
+    key = f"{interface}:{model}"
+    with _controllers_lock:
+        if key not in _controllers:
+            _controllers[key] = AdmissionController(
+                tpm_limit=int(os.getenv("LLM_TPM_LIMIT", 0)),
+                rpm_limit=int(os.getenv("LLM_RPM_LIMIT", 0)),
+            )
+        return _controllers[key]
+
+
+def estimate_output_tokens() -> int:
+    """Tokens reserved for the answer of each call (LLM_ESTIMATED_OUTPUT_TOKENS)."""
+    return int(os.getenv("LLM_ESTIMATED_OUTPUT_TOKENS", 1000))
@@ -1,15 +1,101 @@
 import os
+import asyncio
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Iterator, Set, IO, Union
 
 from azure.storage.blob import BlobServiceClient
 from azure.storage.blob import BlobClient
+from azure.storage.blob import BlobPrefix
 from azure.storage.blob import generate_blob_sas
 from azure.storage.blob import generate_container_sas
 from azure.storage.blob import ContentSettings
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+from azure.storage.blob.aio import BlobClient as AsyncBlobClient
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotFoundError, ResourceNotModifiedError
 
 from dotenv import load_dotenv
 
+from utilities.blobcache import BlobContentCache
+from utilities.storage import BlobEntry, BlobNotFound, MemoryViewIO
+
+
+# Counter of the requests of the current scope (see StorageRequestCounter.scope)
+_request_scope: ContextVar[Optional[Counter]] = ContextVar("storage_request_scope", default=None)
+
+
+class StorageRequestCounter:
+    """
+    Counts the storage requests sent by this process, by HTTP method.
+    It is installed as the `raw_request_hook` of the blob clients, so every request sent on the wire (retries included) is counted.
+    Requests are also counted in the scope they are sent from, e.g. the load of one case, apart from other sessions.
+    """
+
+    def __init__(self):
+        self._counts: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, request):
+        self.count(request, _request_scope.get())
+
+    def count(self, request, scope: Optional[Counter] = None):
+        method = request.http_request.method
+        with self._lock:
+            self._counts[method] += 1
+            if scope is not None:
+                scope[method] += 1
+
+    @contextmanager
+    def scope(self) -> Iterator[Counter]:
+        """Count the requests sent from the current context (and the contexts copied from it) in a new Counter."""
+        counts: Counter = Counter()
+        token = _request_scope.set(counts)
+        try:
+            yield counts
+        finally:
+            _request_scope.reset(token)
+
+    def hook(self):
+        """
+        Request hook bound to the current scope, for the requests sent from threads that do not inherit the
+        context (e.g. the parallel range downloads of the SDK).
+        """
+        scope = _request_scope.get()
+        return lambda request: self.count(request, scope)
+
+    @property
+    def total(self) -> int:
+        with self._lock:
+            return sum(self._counts.values())
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+# Process-wide storage request counter and containers known to exist
+REQUEST_COUNTER = StorageRequestCounter()
+_existing_containers: Set[str] = set()
+_existing_containers_lock = threading.Lock()
+
+
+def get_connection_string(account_name: str, account_key: str) -> str:
+    """
+    Return the storage connection string. BLOB_STORAGE_CONNECTION_STRING overrides the one built from the account
+    name and key, e.g. to use a local Azurite emulator ("UseDevelopmentStorage=true").
+    """
+    return os.getenv('BLOB_STORAGE_CONNECTION_STRING') or \
+        f"DefaultEndpointsProtocol=https;AccountName={account_name};AccountKey={account_key};EndpointSuffix=core.windows.net"
+
 
 class AzureBlobStorageClient:
 
@@ -19,23 +105,41 @@ class AzureBlobStorageClient:
 
         self.account_name: str = os.getenv('BLOB_STORAGE_ACCOUNT_NAME', account_name)
         self.account_key: str = os.getenv('BLOB_STORAGE_ACCOUNT_KEY', account_key)
-        self.connect_str : str = f"DefaultEndpointsProtocol=https;AccountName={self.account_name};AccountKey={self.account_key};EndpointSuffix=core.windows.net"
+        self.connect_str : str = get_connection_string(self.account_name, self.account_key)
         self.container_name = os.getenv('BLOB_STORAGE_CONTAINER_NAME', container_name)
-        self.blob_service_client : BlobServiceClient = BlobServiceClient.from_connection_string(self.connect_str)
-        
+        # Blobs larger than one chunk are downloaded as ranges of that size, up to max_concurrency of them in parallel
+        self.max_concurrency = int(os.getenv('BLOB_DOWNLOAD_CONCURRENCY', 8))
+        chunk_size = int(os.getenv('BLOB_DOWNLOAD_CHUNK_SIZE', 4 * 1024 * 1024))
+        self.blob_service_client : BlobServiceClient = BlobServiceClient.from_connection_string(
+            self.connect_str,
+            raw_request_hook=REQUEST_COUNTER,
+            max_single_get_size=chunk_size,
+            max_chunk_get_size=chunk_size,
+        )
+        # Local content cache for downloaded blobs, revalidated with the blob ETag (empty BLOB_CACHE_DIR disables it)
+        cache_dir = os.getenv('BLOB_CACHE_DIR', 'tmp/blob_cache')
+        self.cache: Optional[BlobContentCache] = None
+        if cache_dir:
+            self.cache = BlobContentCache(
+                cache_dir,
+                max_bytes=int(os.getenv('BLOB_CACHE_MAX_BYTES', 512 * 1024 * 1024)),
+                max_entries=int(os.getenv('BLOB_CACHE_MAX_ENTRIES', 1000)),
+            )
+
     def delete_file(self, file_name, container_name: Optional[str] = None):
         if container_name is None:
             container_name = self.container_name
         blob_client = self.blob_service_client.get_blob_client(container=container_name, blob=file_name)
         blob_client.delete_blob(delete_snapshots="include")
+        if self.cache:
+            self.cache.delete(container_name, file_name)
     
     def upload_file(self, bytes_data, file_name: str, container_name: Optional[str] = None, content_type: Optional[str] = 'application/pdf', metadata: Optional[Dict] = {}):
         if not container_name:
             container_name = self.container_name
 
         #Create container if not exists
-        if not self.blob_service_client.get_container_client(container_name).exists():
-            self.blob_service_client.create_container(container_name)
+        self._ensure_container(container_name)
 
         # Create a blob client using the local file name as the name for the blob
         blob_client = self.blob_service_client.get_blob_client(container=container_name,
@@ -55,21 +159,63 @@ class AzureBlobStorageClient:
                                                          expiry=datetime.now() + timedelta(hours=3))
 
 
+    def _ensure_container(self, container_name: str):
+        """Create the container if it does not exist. The check is done only once per process and container."""
+        container_key = f"{self.account_name}/{container_name}"
+        with _existing_containers_lock:
+            if container_key in _existing_containers:
+                return
+            if not self.blob_service_client.get_container_client(container_name).exists():
+                self.blob_service_client.create_container(container_name)
+            _existing_containers.add(container_key)
+
     def get_container_files(self, container_name: Optional[str] = None, folder_name: Optional[str] = None, full_path: bool = True):
         if container_name is None:
             container_name = self.container_name
         if folder_name is None:
             folder_name = ''
         container_client = self.blob_service_client.get_container_client(container_name)
-        blob_list = container_client.list_blobs(include='metadata')
+        # Let the service filter by prefix instead of scanning the whole container
+        prefix = os.path.join(folder_name, '').replace("\\","/") if folder_name else None
+        blob_list = container_client.list_blobs(name_starts_with=prefix, include='metadata')
         files = [blob['name'] for blob in blob_list]
-        if folder_name:
-            files = [file for file in files if file.startswith(os.path.join(folder_name, '').replace("\\","/"))]
         # If full_path is True, get only the file name (without any folder or full path)
         if not full_path:
             files = [os.path.basename(file) for file in files]
         return files
-            
+
+    def list_entries(self, prefix: str = '', recursive: bool = True, container_name: Optional[str] = None) -> Iterator[BlobEntry]:
+        """
+        Yield the listing information (size, etag, last_modified) of the blobs whose name starts with the given prefix.
+        If not recursive, only the blobs directly under the prefix are listed (hierarchical listing).
+        """
+        if container_name is None:
+            container_name = self.container_name
+        container_client = self.blob_service_client.get_container_client(container_name)
+        if recursive:
+            blobs = container_client.list_blobs(name_starts_with=prefix or None)
+        else:
+            blobs = (item for item in container_client.walk_blobs(name_starts_with=prefix or None, delimiter='/') if not isinstance(item, BlobPrefix))
+        for blob in blobs:
+            yield BlobEntry(name=blob.name, size=blob.size, etag=blob.etag, last_modified=blob.last_modified)
+
+    def iter_folders(self, path: str, container_name: Optional[str] = None, results_per_page: Optional[int] = None) -> Iterator[str]:
+        """
+        Lazily yield the names of the folders directly under the given path.
+
+        Uses a hierarchical listing (prefix + "/" delimiter), so only the folder prefixes are returned
+        by the service, one page at a time, instead of every blob below the path.
+        """
+        if container_name is None:
+            container_name = self.container_name
+        prefix = os.path.join(path, '').replace("\\","/") if path else ''
+        container_client = self.blob_service_client.get_container_client(container_name)
+        pages = container_client.walk_blobs(name_starts_with=prefix, delimiter='/', results_per_page=results_per_page).by_page()
+        for page in pages:
+            for item in page:
+                if isinstance(item, BlobPrefix):
+                    yield item.name[len(prefix):].rstrip('/')
+
     def get_container_sas(self):
         # Generate a SAS URL to the container and return it
         return "?" + generate_container_sas(account_name= self.account_name, container_name= self.container_name,account_key=self.account_key,  permission="r", expiry=datetime.utcnow() + timedelta(hours=1))
@@ -80,33 +226,89 @@ class AzureBlobStorageClient:
 
     def get_file_from_sas(self, sas_url: str) -> bytes:
         """Get a file from blob storage given the file's SAS URL."""
-        blob_client = BlobClient.from_blob_url(sas_url)
+        blob_client = BlobClient.from_blob_url(sas_url, raw_request_hook=REQUEST_COUNTER)
         download_stream = blob_client.download_blob()
         return download_stream.readall()
     
     def get_file(self, file_path: str, container_name: Optional[str] = None) -> bytes:
-        """Get a file from blob storage given the file's path."""
+        """
+        Get a file from blob storage given the file's path, with a single (conditional) GET request.
+        Raises BlobNotFound if the file or the container does not exist. It never writes to the storage.
+        """
         if container_name is None:
             container_name = self.container_name
-        # If container does not exist, create it
-        if not self.blob_service_client.get_container_client(container_name).exists():
-            self.blob_service_client.create_container(container_name)
-        # Check if file exists, if not create it
-        if not self.blob_service_client.get_blob_client(container_name, file_path).exists():
-            self.blob_service_client.get_blob_client(container_name, file_path).upload_blob(b'')
-        
         blob_client = self.blob_service_client.get_blob_client(container=container_name, blob=file_path)
-        download_stream = blob_client.download_blob()
-        return download_stream.readall()
+        try:
+            return self._download_with_cache(blob_client, container_name, file_path)
+        except ResourceNotFoundError as e:
+            if self.cache:
+                self.cache.delete(container_name, file_path)
+            raise BlobNotFound(f"File {file_path} not found in container {container_name}") from e
+
+    def open_file(self, file_path: str, container_name: Optional[str] = None) -> IO[bytes]:
+        """
+        Get a file from blob storage as a seekable binary stream. Raises BlobNotFound if it does not exist.
+        Meant for large files (e.g. xlsx workbooks): the blob ranges are downloaded in parallel straight into
+        one preallocated buffer, and the stream reads from that buffer without copying it.
+        """
+        if container_name is None:
+            container_name = self.container_name
+        blob_client = self.blob_service_client.get_blob_client(container=container_name, blob=file_path)
+        try:
+            return MemoryViewIO(self._download_with_cache(blob_client, container_name, file_path, into_buffer=True))
+        except ResourceNotFoundError as e:
+            if self.cache:
+                self.cache.delete(container_name, file_path)
+            raise BlobNotFound(f"File {file_path} not found in container {container_name}") from e
+
+    def _download_with_cache(self, blob_client: BlobClient, container_name: str, file_path: str, into_buffer: bool = False) -> Union[bytes, bytearray]:
+        """
+        Download a blob, revalidating the locally cached copy (if any) with a conditional GET.
+        With `into_buffer`, the blob is read into a bytearray preallocated with the blob size instead of being assembled by readall.
+        """
+        cached = self.cache.get(container_name, file_path) if self.cache else None
+        # The ranges of a parallel download are requested from threads of the SDK, outside the request scope
+        request_hook = REQUEST_COUNTER.hook()
+        if cached is None:
+            download_stream = blob_client.download_blob(max_concurrency=self.max_concurrency, raw_request_hook=request_hook)
+        else:
+            etag, content = cached
+            try:
+                download_stream = blob_client.download_blob(max_concurrency=self.max_concurrency, etag=etag, match_condition=MatchConditions.IfModified, raw_request_hook=request_hook)
+            except ResourceNotModifiedError:
+                return content
+        if into_buffer:
+            content = bytearray(download_stream.size)
+            download_stream.readinto(MemoryViewIO(content))
+        else:
+            content = download_stream.readall()
+        if self.cache is None:
+            return content
+        self.cache.put(container_name, file_path, download_stream.properties.etag, content)
+        return content
+
+    def download_many(self, paths: List[str], max_concurrency: int = 8, container_name: Optional[str] = None) -> Dict[str, bytes]:
+        """
+        Download several files concurrently over one pooled HTTP session (see AsyncAzureBlobStorageClient).
+        Files that do not exist are left out of the result.
+        """
+        async def _download_many() -> Dict[str, bytes]:
+            async with AsyncAzureBlobStorageClient(self.account_name, self.account_key, self.container_name, cache=self.cache) as client:
+                return await client.download_many(paths, max_concurrency=max_concurrency, container_name=container_name)
+        return asyncio.run(_download_many())
 
-    def list_cases(self, path: str, filter_by_word: str, full_path: bool = True, remove_items: List[str] = ['C0 - Información Común']) -> List[str]:
+    def list_cases(self, path: str, filter_by_word: str, full_path: bool = True, remove_items: List[str] = ['C0 - Información Común'], hierarchical: bool = True) -> List[str]:
         """
         List all cases (folders only) in the given path, filter the list by a contained word and remove specific items. 
+
+        With `hierarchical` (the default) only the folder prefixes under the path are listed. Otherwise every
+        blob under the path is listed and the folders are derived from the blob names.
         """
-        container_name = self.container_name
-        folder_name = path
-        files = self.get_container_files(container_name, folder_name, full_path=True)
-        folders = sorted(list(set([os.path.basename(os.path.dirname(name)) for name in files if '/' in os.path.dirname(name)])))
+        if hierarchical:
+            folders = sorted(self.iter_folders(path))
+        else:
+            files = self.get_container_files(self.container_name, path, full_path=True)
+            folders = sorted(list(set([os.path.basename(os.path.dirname(name)) for name in files if '/' in os.path.dirname(name)])))
         if filter_by_word and filter_by_word != "ALL":
             folders = [folder for folder in folders if filter_by_word in folder]
         if remove_items:
@@ -114,3 +316,78 @@ class AzureBlobStorageClient:
         if full_path:
             folders = [os.path.join(path, folder) for folder in folders]
         return folders
+
+
+class AsyncAzureBlobStorageClient:
+    """
+    Asynchronous (azure.storage.blob.aio) counterpart of AzureBlobStorageClient for bulk downloads.
+    All the blob clients share the HTTP session of the service client, so it must be used as an async context manager.
+    """
+
+    def __init__(self, account_name: str = "", account_key: str = "", container_name: str = "", cache: Optional[BlobContentCache] = None):
+
+        load_dotenv()
+
+        self.account_name: str = os.getenv('BLOB_STORAGE_ACCOUNT_NAME', account_name)
+        self.account_key: str = os.getenv('BLOB_STORAGE_ACCOUNT_KEY', account_key)
+        self.connect_str : str = get_connection_string(self.account_name, self.account_key)
+        self.container_name = os.getenv('BLOB_STORAGE_CONTAINER_NAME', container_name)
+        self.cache = cache
+        self.blob_service_client: Optional[AsyncBlobServiceClient] = None
+
+    async def __aenter__(self) -> "AsyncAzureBlobStorageClient":
+        self.blob_service_client = AsyncBlobServiceClient.from_connection_string(self.connect_str, raw_request_hook=REQUEST_COUNTER)
+        await self.blob_service_client.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.blob_service_client.close()
+        self.blob_service_client = None
+
+    async def get_file(self, file_path: str, container_name: Optional[str] = None) -> bytes:
+        """Get a file from blob storage given the file's path. Raises BlobNotFound if it does not exist."""
+        if container_name is None:
+            container_name = self.container_name
+        blob_client = self.blob_service_client.get_blob_client(container=container_name, blob=file_path)
+        try:
+            return await self._download_with_cache(blob_client, container_name, file_path)
+        except ResourceNotFoundError as e:
+            if self.cache:
+                self.cache.delete(container_name, file_path)
+            raise BlobNotFound(f"File {file_path} not found in container {container_name}") from e
+
+    async def _download_with_cache(self, blob_client: AsyncBlobClient, container_name: str, file_path: str) -> bytes:
+        """Download a blob, revalidating the locally cached copy (if any) with a conditional GET."""
+        if self.cache is None:
+            download_stream = await blob_client.download_blob()
+            return await download_stream.readall()
+        cached = self.cache.get(container_name, file_path)
+        if cached is None:
+            download_stream = await blob_client.download_blob()
+        else:
+            etag, content = cached
+            try:
+                download_stream = await blob_client.download_blob(etag=etag, match_condition=MatchConditions.IfModified)
+            except ResourceNotModifiedError:
+                return content
+        content = await download_stream.readall()
+        self.cache.put(container_name, file_path, download_stream.properties.etag, content)
+        return content
+
+    async def download_many(self, paths: List[str], max_concurrency: int = 8, container_name: Optional[str] = None) -> Dict[str, bytes]:
+        """
+        Download several files concurrently, with at most `max_concurrency` requests in flight.
+        Returns the contents keyed by path, in the order of `paths`. Files that do not exist are left out.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def download(path: str) -> Optional[bytes]:
+            async with semaphore:
+                try:
+                    return await self.get_file(path, container_name)
+                except BlobNotFound:
+                    logging.warning(f"File {path} not found in blob storage")
+                    return None
+
+        contents = await asyncio.gather(*(download(path) for path in paths))
+        return {path: content for path, content in zip(paths, contents) if content is not None}
@@ -0,0 +1,144 @@
+"""
+This module contains the BlobContentCache class, a size-bounded on-disk LRU cache for blob contents.
+Entries are keyed by container and blob path and store the blob's ETag next to its body, so that callers
+can revalidate them with a conditional GET (If-None-Match) instead of downloading the blob again.
+The cache lives on disk, so it survives restarts and is shared between the server processes.
+
+Each process keeps a running total of the size and number of entries, and only lists the cache directory (to evict
+the least recently used entries and to sweep the temporary files left by interrupted writes) when its total
+crosses a limit. The listing resyncs the total with the entries written by the other processes.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import List, Optional, Tuple
+
+
+class BlobContentCache:
+
+    FILE_SUFFIX = ".blob"
+    TMP_SUFFIX = ".tmp"
+    # Temporary files older than this are leftovers of interrupted writes (e.g. of a killed process)
+    STALE_TMP_SECONDS = 3600
+
+    def __init__(self, cache_dir: str, max_bytes: int = 512 * 1024 * 1024, max_entries: int = 1000):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # Running size and number of entries, None until the cache directory is first listed
+        self._total_bytes: Optional[int] = None
+        self._total_entries = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _entry_path(self, container_name: str, blob_path: str) -> str:
+        key = hashlib.sha256(f"{container_name}/{blob_path}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key + self.FILE_SUFFIX)
+
+    def get(self, container_name: str, blob_path: str) -> Optional[Tuple[str, bytes]]:
+        """Return the cached (etag, body) of a blob, or None if it is not cached."""
+        entry_path = self._entry_path(container_name, blob_path)
+        try:
+            with open(entry_path, 'rb') as f:
+                etag = f.readline().rstrip(b"\n").decode("utf-8")
+                body = f.read()
+        except FileNotFoundError:
+            return None
+        # Refresh the access time used for the LRU eviction
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        return etag, body
+
+    def put(self, container_name: str, blob_path: str, etag: str, body: bytes):
+        """Store the body of a blob with its etag, evicting the least recently used entries if needed."""
+        if not etag or len(body) > self.max_bytes:
+            return
+        entry_path = self._entry_path(container_name, blob_path)
+        # Write to a temporary file and rename it, so readers in other processes never see partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=self.TMP_SUFFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(etag.encode("utf-8") + b"\n")
+                f.write(body)
+            size = os.path.getsize(tmp_path)
+            replaced_size = self._size(entry_path)
+            os.replace(tmp_path, entry_path)
+        except OSError as e:
+            logging.warning(f"Could not write blob cache entry for {blob_path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += size - (replaced_size or 0)
+                if replaced_size is None:
+                    self._total_entries += 1
+            within_limits = self._within_limits()
+        if not within_limits:
+            self.evict()
+
+    def delete(self, container_name: str, blob_path: str):
+        entry_path = self._entry_path(container_name, blob_path)
+        size = self._size(entry_path)
+        try:
+            os.remove(entry_path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if self._total_bytes is not None and size is not None:
+                self._total_bytes -= size
+                self._total_entries -= 1
+
+    @staticmethod
+    def _size(path: str) -> Optional[int]:
+        try:
+            return os.path.getsize(path)
+        except FileNotFoundError:
+            return None
+
+    def _within_limits(self) -> bool:
+        """Whether the running total is within the limits (False before the first listing). Call with the lock."""
+        return self._total_bytes is not None and self._total_entries <= self.max_entries and self._total_bytes <= self.max_bytes
+
+    def _scan(self) -> List[Tuple[float, int, str]]:
+        """List the (mtime, size, path) of the entries, removing the stale temporary files. Call with the lock."""
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.cache_dir):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith(self.FILE_SUFFIX):
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+            elif entry.name.endswith(self.TMP_SUFFIX) and now - stat.st_mtime > self.STALE_TMP_SECONDS:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+        return entries
+
+    def evict(self):
+        """
+        List the cache directory and remove the least recently used entries until the cache is within its byte and
+        entry limits, and the stale temporary files.
+        """
+        with self._lock:
+            entries = self._scan()
+            total_bytes = sum(size for _, size, _ in entries)
+            entries.sort()
+            while entries and (len(entries) > self.max_entries or total_bytes > self.max_bytes):
+                _, size, path = entries.pop(0)
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_bytes -= size
+            self._total_bytes = total_bytes
+            self._total_entries = len(entries)
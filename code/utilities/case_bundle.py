@@ -0,0 +1,159 @@
+"""
+This module contains the ingest stage that precompiles the workbooks of a case into a columnar bundle:
+one Parquet file per visible sheet, plus a small metadata JSON (sheet names, detected header row, token counts),
+stored next to the case in its `_bundle` folder. Loading a bundle skips the Excel parsing and the header detection.
+
+Build the bundles of all the cases of PRE_NARRATIVE_FOLDER (or only the given ones) with:
+
+    python -m utilities.case_bundle [case ...]
+"""
+
+import io
+import json
+import logging
+import os
+import sys
+from typing import Dict, List, Optional
+
+import pandas as pd
+from dotenv import load_dotenv
+
+from utilities.storage import BlobNotFound, StorageBackend, get_storage_backend
+from utilities.tables import read_excel_sheet, process_excel_table, render_table
+from utilities.tokenizer import count_tokens_batch, get_model_encoding
+
+BUNDLE_FOLDER = "_bundle"
+BUNDLE_VERSION = 3
+BUNDLE_METADATA_FILENAME = "metadata.json"
+WORKBOOK_KEYWORDS = ["Tabla Resumen", "Intervinientes Adicionales"]
+
+# Inferred types of object columns that Parquet can store as they are
+ARROW_COMPATIBLE_OBJECT_TYPES = {"string", "empty", "boolean", "integer", "floating", "mixed-integer-float", "datetime", "date", "time"}
+
+
+def get_bundle_folder(case_path: str, workbook_name: str) -> str:
+    """Return the folder of the bundle of a workbook of the case."""
+    return "/".join([case_path.replace("\\", "/").rstrip("/"), BUNDLE_FOLDER, os.path.splitext(workbook_name)[0]])
+
+
+def get_bundle_metadata_path(case_path: str, workbook_name: str) -> str:
+    return get_bundle_folder(case_path, workbook_name) + "/" + BUNDLE_METADATA_FILENAME
+
+
+def is_bundle_file(path: str) -> bool:
+    return f"/{BUNDLE_FOLDER}/" in path.replace("\\", "/")
+
+
+def to_arrow_compatible(df: pd.DataFrame) -> pd.DataFrame:
+    """Make a sheet storable as Parquet: string column names, and object columns of mixed types as strings."""
+    df = df.copy()
+    df.columns = [str(col) for col in df.columns]
+    for col in df.columns:
+        if df[col].dtype == 'O' and pd.api.types.infer_dtype(df[col], skipna=True) not in ARROW_COMPATIBLE_OBJECT_TYPES:
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+
+def build_workbook_bundle(storage: StorageBackend, case_path: str, workbook_name: str, source_etag: str = "") -> Dict:
+    """
+    Convert the visible sheets of a case workbook to Parquet files and upload them, with their metadata, to the bundle folder.
+    The metadata is uploaded last, so a bundle is only visible once all its sheets are stored.
+    """
+    folder = get_bundle_folder(case_path, workbook_name)
+    workbook_path = case_path.replace("\\", "/").rstrip("/") + "/" + workbook_name
+
+    sheets = []
+    tables = []
+    with storage.open_file(workbook_path) as workbook, pd.ExcelFile(workbook) as xls:
+        for sheet in xls.book.worksheets:
+            if sheet.sheet_state != "visible":
+                continue
+            df, header_row = read_excel_sheet(xls, sheet=sheet.title)
+            df = to_arrow_compatible(df)
+            parquet_buffer = io.BytesIO()
+            df.to_parquet(parquet_buffer, index=False)
+            parquet_filename = f"{len(sheets)}.parquet"
+            storage.upload_file(parquet_buffer.getvalue(), folder + "/" + parquet_filename, content_type="application/vnd.apache.parquet")
+            sheets.append({
+                "name": sheet.title,
+                "file": parquet_filename,
+                "header_row": None if header_row is None else int(header_row),
+                "rows": len(df),
+                "columns": list(df.columns),
+            })
+            tables.append(render_table(process_excel_table(df)))
+
+    encoding = get_model_encoding()
+    for sheet, tokens in zip(sheets, count_tokens_batch(tables, encoding=encoding)):
+        sheet["tokens"] = tokens
+
+    metadata = {
+        "version": BUNDLE_VERSION,
+        "workbook": workbook_name,
+        "source_etag": source_etag,
+        "encoding": encoding.name,
+        "sheets": sheets,
+    }
+    storage.upload_file(json.dumps(metadata, ensure_ascii=False, indent=2).encode("utf-8"), folder + "/" + BUNDLE_METADATA_FILENAME, content_type="application/json")
+    return metadata
+
+
+def build_case_bundle(storage: StorageBackend, case_path: str) -> List[Dict]:
+    """Build the bundles of all the workbooks of a case. Returns their metadata."""
+    prefix = os.path.join(case_path, '').replace("\\", "/")
+    bundles = []
+    for entry in storage.list_entries(prefix):
+        workbook_name = entry.name[len(prefix):]
+        if is_bundle_file(entry.name) or "/" in workbook_name or os.path.splitext(workbook_name)[1] != ".xlsx":
+            continue
+        if not any(keyword in workbook_name for keyword in WORKBOOK_KEYWORDS):
+            continue
+        logging.info(f"Building bundle of {entry.name}...")
+        bundles.append(build_workbook_bundle(storage, case_path, workbook_name, source_etag=entry.etag))
+    return bundles
+
+
+def load_workbook_bundle(storage: StorageBackend, case_path: str, workbook_name: str, source_etag: Optional[str] = None, preprocess: bool = True) -> Optional[Dict[str, Dict]]:
+    """
+    Load the precompiled sheets of a case workbook, in the same format as reading the workbook itself:
+    {sheet name: {'content': DataFrame, 'tokens': int}}.
+    Returns None if there is no bundle, or if it was built from a different version (etag) of the workbook.
+    """
+    folder = get_bundle_folder(case_path, workbook_name)
+    try:
+        metadata = json.loads(storage.get_file(folder + "/" + BUNDLE_METADATA_FILENAME))
+    except BlobNotFound:
+        return None
+    if metadata.get("version") != BUNDLE_VERSION or (source_etag and metadata.get("source_etag") != source_etag):
+        logging.info(f"Bundle of {workbook_name} is outdated, reading the workbook instead")
+        return None
+
+    paths = [folder + "/" + sheet["file"] for sheet in metadata["sheets"]]
+    contents = storage.download_many(paths)
+    if len(contents) != len(paths):
+        return None
+
+    sheets_data = {}
+    for sheet, path in zip(metadata["sheets"], paths):
+        df = pd.read_parquet(io.BytesIO(contents[path]))
+        sheets_data[sheet["name"]] = {
+            'content': process_excel_table(df, preprocess=preprocess),
+            'tokens': sheet["tokens"],
+        }
+    # Count the tokens again if the bundle was built for a model with a different encoding
+    encoding = get_model_encoding()
+    if metadata.get("encoding") != encoding.name or not preprocess:
+        tables = [render_table(sheet_data['content']) for sheet_data in sheets_data.values()]
+        for sheet_data, tokens in zip(sheets_data.values(), count_tokens_batch(tables, encoding=encoding)):
+            sheet_data['tokens'] = tokens
+    return sheets_data
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    storage = get_storage_backend()
+    pre_narrative_path = os.getenv("PRE_NARRATIVE_FOLDER", "")
+    cases = sys.argv[1:] or storage.list_cases(pre_narrative_path, filter_by_word="ALL", full_path=False)
+    for case in cases:
+        build_case_bundle(storage, os.path.join(pre_narrative_path, case))
@@ -0,0 +1,317 @@
+"""
+This module contains the CaseLoadingPipeline class, which loads everything the reports need about a case
+(case JSON files, workbooks, additional documentation, reference documents) into a CaseData object.
+
+The loading is split into stages with declared dependencies. Stages run concurrently on a thread pool as soon as
+their dependencies are done: the downloads overlap, and workbooks are parsed and documents extracted in the worker
+processes of utilities.documents, so the parsing does not hold the GIL of the web server. The raw downloads are
+dropped once the stages have read them: CaseData keeps the parsed data only. Progress and timings of each stage are reported through a callback, called
+from the thread that runs the pipeline, so the pipeline can drive a Streamlit page or run without any UI.
+"""
+
+import contextvars
+import io
+import json
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from utilities.case_bundle import get_bundle_metadata_path, is_bundle_file, load_workbook_bundle
+from utilities.documents import SUPPORTED_DOCUMENT_EXTENSIONS, extract_documents, map_in_process_pool
+from utilities.enums import CaseTypes
+from utilities.manifest import CaseManifest
+from utilities.reference_documents import ReferenceDocumentCache
+from utilities.storage import StorageBackend
+from utilities.tables import get_rendered_table, process_excel_tables
+from utilities.tokenizer import count_tokens_batch
+
+ALERT_KEYWORDS = ["Alerta", "alerta", "Alert", "alert"]
+CUSTOMER_KEYWORDS = ["Cliente", "cliente", "Customer", "customer"]
+SUMMARY_WORKBOOK_KEYWORD = "Tabla Resumen"
+ADDITIONAL_WORKBOOK_KEYWORD = "Intervinientes Adicionales"
+# Narrative subfolders whose documents are additional documentation (the rest refer to the principal implicado)
+ADDITIONAL_DOCUMENTATION_FOLDERS = ["Correos", "Docu Aportada"]
+
+
+@dataclass(frozen=True)
+class Stage:
+    """A step of the case loading, run with the results of the stages it depends on."""
+    name: str
+    label: str
+    run: Callable[[Dict[str, Any]], Any]
+    depends_on: Tuple[str, ...] = ()
+
+
+@dataclass(frozen=True)
+class StageEvent:
+    """Progress of the case loading, reported when a stage starts and when it finishes."""
+    stage: str
+    label: str
+    status: str  # "started" or "done"
+    completed: int
+    total: int
+    elapsed: Optional[float] = None
+
+
+class CaseLoadingError(Exception):
+    """Raised when a stage of the case loading fails."""
+
+    def __init__(self, stage: str, error: Exception):
+        super().__init__(f"Stage '{stage}' failed: {error!r}")
+        self.stage = stage
+        self.error = error
+
+
+@dataclass
+class CaseData:
+    """Everything the reports need about a case."""
+    case: str
+    case_file_paths: List[str]
+    narrative_file_paths: List[str]
+    case_json: Dict[str, Any]  # Parsed JSON files of the case folder, keyed by path
+    alert_data: List[Dict]
+    customer_data: List[Dict]
+    excel_data: Dict[str, Dict]
+    additional_excel_data: Dict[str, Dict]
+    additional_documentation: Dict[str, str]
+    additional_documentation_principal_implicado: Dict[str, str]
+    json_interviniente_cliente: Dict[str, Dict]
+    playbook: str
+    alert_assessment: Optional[str]
+    alert_assessment_filename: Optional[str]
+    timings: Dict[str, float] = field(default_factory=dict)
+
+    @property
+    def files(self) -> List[str]:
+        """Names of the files of the case folder."""
+        return [os.path.basename(path) for path in self.case_file_paths]
+
+    @property
+    def numero_cuenta(self) -> str:
+        return self.alert_data[0].get("numero_cuenta", "") if self.alert_data else ""
+
+
+def join_documents_text(title: str, documents: Dict[str, Any]) -> str:
+    """Join documents (or JSON files) into a single text, with a title per document."""
+    return "\n\n".join([f"### {title} \"{filename}\":\n\n{content}" for filename, content in documents.items()])
+
+
+def get_alert_assessment_filename(case_type: str, case: str) -> Optional[str]:
+    """Name of the alert assessment of the case type (taken from the case name if the case type is "all")."""
+    try:
+        if case_type == CaseTypes.ALL.value:
+            # Get case type from the selected case abbreviation and value from CaseTypes enum
+            abbrev = case.split(" - ")[1]
+            parsed_case_type = CaseTypes.get_value(abbrev)
+        else:
+            parsed_case_type = case_type
+    except IndexError:
+        return None
+    return str(parsed_case_type) + ".docx"
+
+
+def select_case_json(case_json: Dict[str, Any], keywords: List[str]) -> List[Dict]:
+    """The parsed JSON files of a case whose name contains any of the keywords."""
+    return [data for path, data in case_json.items() if any(k in os.path.basename(path) for k in keywords)]
+
+
+def parse_workbook(content: bytes) -> Dict[str, Dict]:
+    """
+    Read the visible sheets of a case workbook into {sheet name: {'content': DataFrame, 'rendered': {...}}},
+    rendering each table for the prompts. Run in the worker processes of utilities.documents.
+    """
+    with pd.ExcelFile(io.BytesIO(content)) as xls:
+        sheets_data = {}
+        for sheet in xls.book.worksheets:
+            if sheet.sheet_state == "visible":
+                sheet_data = {'content': process_excel_tables(xls, sheet)}
+                get_rendered_table(sheet_data)
+                sheets_data[sheet.title] = sheet_data
+    return sheets_data
+
+
+class CaseLoadingPipeline:
+
+    def __init__(self, storage: StorageBackend, manifest: CaseManifest, reference_documents: ReferenceDocumentCache,
+                 pre_narrative_path: str, narrative_path: str, playbook_filename: str, max_workers: int = 8):
+        """
+        Args:
+            storage (StorageBackend): Storage of the case data.
+            manifest (CaseManifest): Index of the storage, used to list the case files.
+            reference_documents (ReferenceDocumentCache): Cache of the Playbook and the alert assessments.
+            pre_narrative_path (str): Folder of the case data (JSON files and workbooks).
+            narrative_path (str): Folder of the additional documentation of the cases.
+            playbook_filename (str): Path of the Playbook.
+            max_workers (int): Threads running the stages, and concurrent downloads.
+        """
+        self.storage = storage
+        self.manifest = manifest
+        self.reference_documents = reference_documents
+        self.pre_narrative_path = pre_narrative_path
+        self.narrative_path = narrative_path
+        self.playbook_filename = playbook_filename
+        self.max_workers = max_workers
+
+    ### STAGES ###
+
+    def _case_path(self, case: str) -> str:
+        return os.path.join(self.pre_narrative_path, case).replace("\\", "/")
+
+    def _narrative_case_folder(self, case: str) -> str:
+        return os.path.join(self.narrative_path, case, '').replace("\\", "/")
+
+    def _download(self, paths: List[str]) -> Dict[str, bytes]:
+        # Workbooks are left out: they are read by the workbook stages
+        return self.storage.download_many([path for path in paths if os.path.splitext(path)[1] != ".xlsx"], max_concurrency=self.max_workers)
+
+    @staticmethod
+    def _read_case_json(contents: Dict[str, bytes], case_file_paths: List[str]) -> Dict[str, Any]:
+        return {path: json.loads(contents[path]) for path in case_file_paths
+                if os.path.splitext(path)[1] == ".json" and path in contents}
+
+    def _load_workbook(self, case_path: str, case_file_paths: List[str], keyword: str, required: bool = False) -> Dict[str, Dict]:
+        """Load the tables of a case workbook, from its bundle if it is up to date, sorted by number of tokens."""
+        workbook_paths = [path for path in case_file_paths if keyword in os.path.basename(path) and os.path.splitext(path)[1] == ".xlsx"]
+        if not workbook_paths:
+            if required:
+                raise FileNotFoundError(f"No '{keyword}' workbook found in {case_path}")
+            return {}
+        workbook_path = workbook_paths[0]
+        workbook_name = os.path.basename(workbook_path)
+
+        sheets_data = None
+        if self.manifest.entry(get_bundle_metadata_path(case_path, workbook_name)) is not None:
+            workbook_entry = self.manifest.entry(workbook_path)
+            sheets_data = load_workbook_bundle(self.storage, case_path, workbook_name, source_etag=workbook_entry.etag if workbook_entry else None)
+        if sheets_data is None:
+            # Download the workbook here, parse it in a worker process, and count the tokens of all its sheets at once
+            content = self.storage.get_file(workbook_path)
+            sheets_data = map_in_process_pool(parse_workbook, [content])[0]
+            tokens = count_tokens_batch([get_rendered_table(sheet_data) for sheet_data in sheets_data.values()])
+            for sheet_data, sheet_tokens in zip(sheets_data.values(), tokens):
+                sheet_data['tokens'] = sheet_tokens
+        # Sort excel data dataframes by number of tokens
+        return {k: v for k, v in sorted(sheets_data.items(), key=lambda item: item[1]['tokens'])}
+
+    def _read_additional_documentation(self, contents: Dict[str, bytes], case: str) -> Tuple[Dict[str, str], Dict[str, str]]:
+        """Extract the documents of the narrative folder, split into additional documentation and principal implicado documentation."""
+        case_folder = self._narrative_case_folder(case)
+        documents = {path: content for path, content in contents.items()
+                     if path.startswith(case_folder) and os.path.splitext(path)[1].lower() in SUPPORTED_DOCUMENT_EXTENSIONS}
+        texts = extract_documents(documents)
+        # Remove the narrative case folder from the keys
+        additional_docu = {path[len(case_folder):]: text for path, text in texts.items()}
+        additional_docu_principal_implicado = {}
+        for filename in list(additional_docu):
+            folder = os.path.dirname(filename)
+            if not any(name in folder for name in ADDITIONAL_DOCUMENTATION_FOLDERS):
+                additional_docu_principal_implicado[filename] = additional_docu.pop(filename)
+        return additional_docu, additional_docu_principal_implicado
+
+    def _read_additional_json_files(self, contents: Dict[str, bytes], case: str) -> Dict[str, Dict]:
+        case_folder = self._narrative_case_folder(case)
+        return {path[len(case_folder):]: json.loads(content) for path, content in contents.items()
+                if path.startswith(case_folder) and os.path.splitext(path)[1] == ".json"}
+
+    def _read_alert_assessment(self, alert_assessment_filename: Optional[str]) -> Optional[str]:
+        if not alert_assessment_filename:
+            return None
+        try:
+            return self.reference_documents.text(alert_assessment_filename)
+        except Exception as e:
+            logging.warning(f"Alert assessment {alert_assessment_filename} could not be loaded: {e!r}")
+            return None
+
+    def stages(self, case: str, case_file_paths: List[str], narrative_file_paths: List[str], alert_assessment_filename: Optional[str]) -> List[Stage]:
+        """The stages to load a case, given the files of its folders."""
+        case_path = self._case_path(case)
+        return [
+            Stage("download", "Case files", lambda _: self._download(case_file_paths + narrative_file_paths)),
+            Stage("case_json", "Alert and customer JSON data", lambda r: self._read_case_json(r["download"], case_file_paths), depends_on=("download",)),
+            Stage("excel", "Excel data", lambda _: self._load_workbook(case_path, case_file_paths, SUMMARY_WORKBOOK_KEYWORD, required=True)),
+            Stage("additional_excel", "Additional Excel data", lambda _: self._load_workbook(case_path, case_file_paths, ADDITIONAL_WORKBOOK_KEYWORD)),
+            Stage("documentation", "Additional documentation", lambda r: self._read_additional_documentation(r["download"], case), depends_on=("download",)),
+            Stage("intervinientes_json", "JSON de Intervinientes Adicionales", lambda r: self._read_additional_json_files(r["download"], case), depends_on=("download",)),
+            Stage("playbook", "Playbook", lambda _: self.reference_documents.text(self.playbook_filename)),
+            Stage("alert_assessment", "Alert assessment", lambda _: self._read_alert_assessment(alert_assessment_filename)),
+        ]
+
+    ### EXECUTION ###
+
+    @staticmethod
+    def _run_stage(stage: Stage, dependencies: Dict[str, Any]) -> Tuple[Any, float]:
+        start = time.perf_counter()
+        result = stage.run(dependencies)
+        return result, time.perf_counter() - start
+
+    def run_stages(self, stages: List[Stage], on_progress: Optional[Callable[[StageEvent], None]] = None) -> Tuple[Dict[str, Any], Dict[str, float]]:
+        """
+        Run the stages concurrently, each one as soon as its dependencies are done.
+        Returns the result and the time of each stage. Raises CaseLoadingError if a stage fails.
+        """
+        notify = on_progress or (lambda event: None)
+        pending = {stage.name: stage for stage in stages}
+        running: Dict[Future, Stage] = {}
+        results: Dict[str, Any] = {}
+        timings: Dict[str, float] = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="case-loading") as executor:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    if all(dependency in results for dependency in stage.depends_on):
+                        del pending[name]
+                        # Stages run in the context of the caller (e.g. its storage request scope)
+                        context = contextvars.copy_context()
+                        running[executor.submit(context.run, self._run_stage, stage, {dependency: results[dependency] for dependency in stage.depends_on})] = stage
+                        notify(StageEvent(stage.name, stage.label, "started", len(results), len(stages)))
+                if not running:
+                    raise ValueError(f"Stages with unknown or circular dependencies: {list(pending)}")
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    try:
+                        results[stage.name], timings[stage.name] = future.result()
+                    except Exception as e:
+                        for other in running:
+                            other.cancel()
+                        raise CaseLoadingError(stage.name, e) from e
+                    logging.info(f"Case loading stage '{stage.name}' done in {timings[stage.name]:.2f} s")
+                    notify(StageEvent(stage.name, stage.label, "done", len(results), len(stages), timings[stage.name]))
+        return results, timings
+
+    def run(self, case: str, case_type: str, on_progress: Optional[Callable[[StageEvent], None]] = None) -> CaseData:
+        """Load a case. `on_progress` is called with a StageEvent when each stage starts and finishes."""
+        start = time.perf_counter()
+        case_path = self._case_path(case)
+        case_file_paths = [path for path in self.manifest.files(folder_name=case_path) if not is_bundle_file(path)]
+        narrative_file_paths = self.manifest.files(folder_name=os.path.join(self.narrative_path, case))
+        alert_assessment_filename = get_alert_assessment_filename(case_type, case)
+
+        results, timings = self.run_stages(self.stages(case, case_file_paths, narrative_file_paths, alert_assessment_filename), on_progress)
+        # The downloads are only kept by the stages that read them
+        case_json = results.pop("case_json")
+        del results["download"]
+        additional_docu, additional_docu_principal_implicado = results["documentation"]
+        timings["total"] = time.perf_counter() - start
+        logging.info(f"Case {case} loaded in {timings['total']:.2f} s")
+        return CaseData(
+            case=case,
+            case_file_paths=case_file_paths,
+            narrative_file_paths=narrative_file_paths,
+            case_json=case_json,
+            alert_data=select_case_json(case_json, ALERT_KEYWORDS),
+            customer_data=select_case_json(case_json, CUSTOMER_KEYWORDS),
+            excel_data=results["excel"],
+            additional_excel_data=results["additional_excel"],
+            additional_documentation=additional_docu,
+            additional_documentation_principal_implicado=additional_docu_principal_implicado,
+            json_interviniente_cliente=results["intervinientes_json"],
+            playbook=results["playbook"],
+            alert_assessment=results["alert_assessment"],
+            alert_assessment_filename=alert_assessment_filename,
+            timings=timings,
+        )
@@ -0,0 +1,351 @@
+"""
+This module contains the headless API of the case processing: loading a case, assembling its prompts and generating
+its pre-narrative, narrative and SAR, without Streamlit. The pages are views over these functions (they keep the
+selections of the analyst in the session state and render the results), and the same functions can run in a worker
+process, a script or a benchmark of the whole pipeline:
+
+    case_data = load_case("<case>")
+    base_prompt = build_base_prompt(case_data)
+    prenarrative = build_prenarrative(case_data, base_prompt)
+    narrative = build_narrative(case_data, base_prompt, prenarrative)
+    sar = build_sar(case_data, narrative)
+"""
+
+import json
+import logging
+import os
+import re
+from typing import Callable, Dict, Iterator, List, Optional
+
+from utilities.case_loading import CaseData, CaseLoadingPipeline, StageEvent
+from utilities.enums import CaseTypes, HistoryStrategies, QuestionsTypes, QuestionsTypesSAR, TemplateNameSAR
+from utilities.llm import ReportGenerator
+from utilities.manifest import get_manifest
+from utilities.prenarrative import ask_section_plan, build_section_plan, get_section_dependencies, get_section_messages
+from utilities.prompts import Prompts
+from utilities.reference_documents import get_reference_documents
+from utilities.storage import get_storage_backend
+from utilities.tables import get_rendered_table, render_sheets
+
+# Answers of the sections of a report, in order
+Sections = Dict[QuestionsTypes, str]
+SARSections = Dict[QuestionsTypesSAR, str]
+
+ALERT_KEYWORDS = ["Alerta", "alerta", "Alert", "alert"]
+CUSTOMER_KEYWORDS = ["Cliente", "cliente", "Customer", "customer"]
+NO_ALERT_ASSESSMENT = "No alert assessment found for this case type."
+
+
+### CASE LOADING ###
+
+def get_case_loading_pipeline(storage=None, max_workers: int = 8) -> CaseLoadingPipeline:
+    """Case-loading pipeline of the storage (STORAGE_BACKEND by default), with the folders of the environment."""
+    storage = storage or get_storage_backend()
+    manifest = get_manifest(storage)
+    return CaseLoadingPipeline(
+        storage=storage,
+        manifest=manifest,
+        reference_documents=get_reference_documents(storage, manifest),
+        pre_narrative_path=os.getenv("PRE_NARRATIVE_FOLDER", ""),
+        narrative_path=os.getenv("NARRATIVE_FOLDER", ""),
+        playbook_filename=os.getenv("PLAYBOOK_FILENAME", ""),
+        max_workers=max_workers,
+    )
+
+
+def load_case(
+    case_id: str,
+    case_type: str = CaseTypes.ALL.value,
+    pipeline: Optional[CaseLoadingPipeline] = None,
+    on_progress: Optional[Callable[[StageEvent], None]] = None,
+) -> CaseData:
+    """Load a case (see CaseLoadingPipeline.run)."""
+    pipeline = pipeline or get_case_loading_pipeline()
+    return pipeline.run(case_id, case_type, on_progress=on_progress)
+
+
+def get_report_generator(base_prompt: str, case: str, queue_key: Optional[str] = None) -> ReportGenerator:
+    """ReportGenerator of a case, with the model and temperature of OPENAI_MODEL_NAME and OPENAI_MODEL_TEMPERATURE."""
+    return ReportGenerator(
+        prompt=base_prompt,
+        model=os.getenv("OPENAI_MODEL_NAME", ReportGenerator.DEFAULT_MODEL),
+        temperature=float(os.getenv("OPENAI_MODEL_TEMPERATURE", 0.0)),
+        session_id=case,
+        queue_key=queue_key,
+    )
+
+
+### PRE-NARRATIVE ###
+
+def build_base_prompt(
+    case_data: CaseData,
+    sheet_names: Optional[List[str]] = None,
+    alert_data: Optional[List[Dict]] = None,
+    customer_data: Optional[List[Dict]] = None,
+) -> str:
+    """
+    Base prompt of the pre-narrative and narrative of a case, with the given tables (all by default) and alert
+    and customer JSON data (those of the case by default).
+    """
+    sheet_names = list(case_data.excel_data) if sheet_names is None else sheet_names
+    return Prompts.base_prompt(
+        alert_data=case_data.alert_data if alert_data is None else alert_data,
+        customer_data=case_data.customer_data if customer_data is None else customer_data,
+        transactions_df=render_sheets(case_data.excel_data, sheet_names),
+        playbook=case_data.playbook,
+        alert_assessment=case_data.alert_assessment if case_data.alert_assessment is not None else NO_ALERT_ASSESSMENT,
+    )
+
+
+def get_specific_table_name(excel_data: Dict[str, Dict], numero_cuenta: str, keyword: str) -> Optional[str]:
+    """Name of the table whose name contains the keyword, preferring the one of the account of the alert."""
+    tables = [t for t in excel_data.keys() if keyword in t.lower()]
+    selected_table = None
+
+    # If more than one table matches, try to find a match with 'numero_cuenta'
+    if len(tables) > 1:
+        for table in tables:
+            nums = re.findall(r'\d+', table)  # Extract numbers from table name
+            for num in nums:
+                if num in numero_cuenta:
+                    selected_table = table
+                    break  # Stop after finding the first match
+
+    # If no table was selected by 'numero_cuenta' match or only one table matches
+    if not selected_table and tables:
+        selected_table = tables[0]
+
+    return selected_table
+
+
+def get_specific_table_text(excel_data: Dict[str, Dict], numero_cuenta: str, keyword: str) -> str:
+    """Markdown of the (formatted) table matching the keyword, rendered once per case."""
+    selected_table = get_specific_table_name(excel_data, numero_cuenta, keyword)
+    if selected_table:
+        return get_rendered_table(excel_data[selected_table], floatfmt=",.2f", formatted=True)
+    return ""
+
+
+def get_prenarrative_prompts(case_data: CaseData) -> Dict[QuestionsTypes, str]:
+    """Questions of the pre-narrative of a case, in order."""
+    tabla_abonos = get_specific_table_text(case_data.excel_data, case_data.numero_cuenta, keyword="abono")
+    tabla_cargos = get_specific_table_text(case_data.excel_data, case_data.numero_cuenta, keyword="cargos")
+    return {
+        QuestionsTypes.NATURALEZA_ALERTA: Prompts.naturaleza_alerta(),
+        QuestionsTypes.PRINCIPAL_IMPLICADO: Prompts.principal_implicado(),
+        QuestionsTypes.CONTEXTO_HISTORICO: Prompts.contexto_historico(),
+        QuestionsTypes.ANALISIS_OPERATIVA: Prompts.analisis_operativa(tabla_abonos, tabla_cargos),
+        QuestionsTypes.GRAFO_INTERVINIENTES: Prompts.grafo_intervinientes(),
+        QuestionsTypes.RECOMENDACION_INICIAL: Prompts.recomendacion_prenarrativa(),
+    }
+
+
+def build_prenarrative(
+    case_data: CaseData,
+    base_prompt: Optional[str] = None,
+    prompts: Optional[Dict[QuestionsTypes, str]] = None,
+    report_generator: Optional[ReportGenerator] = None,
+    on_chunk: Optional[Callable[[QuestionsTypes, str], None]] = None,
+    on_done: Optional[Callable[[QuestionsTypes, str], None]] = None,
+    max_concurrency: Optional[int] = None,
+) -> Sections:
+    """
+    Generate the pre-narrative of a case, starting a new conversation: independent sections are asked concurrently
+    (see utilities.prenarrative), and the conversation is then saved to the chat history of the case.
+    `on_chunk` and `on_done` are called, from the calling thread, with the text of each section while it is streamed
+    and once it is complete.
+    """
+    report_generator = report_generator or get_report_generator(base_prompt or build_base_prompt(case_data), case_data.case)
+    prompts = prompts if prompts is not None else get_prenarrative_prompts(case_data)
+    max_concurrency = max_concurrency or int(os.getenv("PRENARRATIVE_CONCURRENCY", 4))
+
+    report_generator.clear_session(case_data.case)
+    sections = build_section_plan(prompts)
+    answers = ask_section_plan(report_generator, sections, on_chunk=on_chunk, on_done=on_done, max_concurrency=max_concurrency)
+    # Write the conversation to the chat history in plan order, for the narrative
+    report_generator.add_messages(get_section_messages(sections, answers), session_id=case_data.case)
+    return answers
+
+
+### NARRATIVE ###
+
+def get_narrative_prompts(case_data: CaseData, additional_sheet_names: Optional[List[str]] = None) -> Dict[QuestionsTypes, Optional[str]]:
+    """
+    Questions of the narrative of a case, in order. The sections without a question (None) keep the answer of the
+    pre-narrative.
+    """
+    additional_sheet_names = list(case_data.additional_excel_data) if additional_sheet_names is None else additional_sheet_names
+    return {
+        QuestionsTypes.NATURALEZA_ALERTA: None,
+        QuestionsTypes.PRINCIPAL_IMPLICADO: Prompts.principal_implicado(
+            informacion_externa=case_data.additional_documentation_principal_implicado),
+        QuestionsTypes.CONTEXTO_HISTORICO: None,
+        QuestionsTypes.ANALISIS_OPERATIVA: None,
+        QuestionsTypes.GRAFO_INTERVINIENTES: None,
+        QuestionsTypes.DOCUMENTACION_ADICIONAL: Prompts.documentacion_adicional(
+            documentacion_adicional=case_data.additional_documentation
+        ),
+        QuestionsTypes.INTERVINIENTES_ADICIONALES: Prompts.intervinientes_adicionales(
+            json_interviniente_cliente=case_data.json_interviniente_cliente,
+            transactions_interviniente_df=render_sheets(case_data.additional_excel_data, additional_sheet_names)
+        ),
+        QuestionsTypes.CONCLUSION_FINAL: Prompts.conclusion_final(),
+    }
+
+
+def get_narrative_questions(narrative_prompts: Dict[QuestionsTypes, Optional[str]], prenarrative: Sections) -> Dict[QuestionsTypes, Dict]:
+    """
+    Questions of the narrative as {section: {"prompt": ..., "answer": ...}}: the sections with a question are asked
+    again (as well as the final conclusion), the rest keep the answer of the pre-narrative.
+    """
+    questions = {}
+    for question, prompt in narrative_prompts.items():
+        if question == QuestionsTypes.CONCLUSION_FINAL or question not in prenarrative or prompt is not None:
+            questions[question] = {"prompt": prompt, "answer": ""}
+        else:
+            questions[question] = {"prompt": None, "answer": prenarrative[question]}
+    return questions
+
+
+def build_narrative(
+    case_data: CaseData,
+    base_prompt: Optional[str] = None,
+    prenarrative: Optional[Sections] = None,
+    questions: Optional[Dict[QuestionsTypes, Dict]] = None,
+    report_generator: Optional[ReportGenerator] = None,
+    on_section: Optional[Callable[[QuestionsTypes, str], None]] = None,
+    on_error: Optional[Callable[[QuestionsTypes, Exception], None]] = None,
+) -> Sections:
+    """
+    Generate the narrative of a case, continuing the conversation of its pre-narrative: each section is asked with
+    only the sections it depends on (with the full history strategy, with the whole conversation). `on_section` is called with the answer of each section.
+    If the final conclusion fails, `on_error` is called with the error and the narrative is completed with a
+    placeholder conclusion; without `on_error`, the error is raised.
+    """
+    report_generator = report_generator or get_report_generator(base_prompt or build_base_prompt(case_data), case_data.case)
+    if questions is None:
+        questions = get_narrative_questions(get_narrative_prompts(case_data), prenarrative or {})
+
+    full_history = report_generator.history_window.strategy == HistoryStrategies.FULL
+    answers: Sections = {}
+    for question, details in questions.items():
+        prompt = details["prompt"]
+        if prompt is not None and not details["answer"]:
+            depends_on = None if full_history else get_section_dependencies(question)
+            try:
+                answer = "".join(report_generator.ask_question_stream(
+                    prompt, session_id=case_data.case, section=question.name, depends_on=depends_on))
+            except Exception as e:
+                if question != QuestionsTypes.CONCLUSION_FINAL or on_error is None:
+                    raise
+                logging.error(f"Critical error generating conclusion final: {e!r}")
+                on_error(question, e)
+                answer = "Critical error generating the conclusion final."
+            if not answer and question == QuestionsTypes.CONCLUSION_FINAL:
+                answer = "No response generated from the API."
+        else:
+            answer = details["answer"]
+        answers[question] = answer
+        if on_section:
+            on_section(question, answer)
+    return answers
+
+
+### SAR ###
+
+def read_case_json(storage, folder: str, case: str, files: List[str], keywords: List[str]) -> List[Dict]:
+    """JSON files of a case folder whose name contains any of the keywords."""
+    return [json.loads(storage.get_file(os.path.join(folder, case, file).replace("\\", "/")))
+            for file in files if any(k in file for k in keywords)]
+
+
+def is_persona_fisica(customer_data: Optional[List[Dict]]) -> bool:
+    """Whether the customer is a natural person (not identified with a CIF)."""
+    tipo_documento = customer_data[0].get("identificacion", {}).get("tipo_documento", "") if customer_data else ""
+    return tipo_documento not in ["CIF"]
+
+
+def get_sar_folder_type(customer_data: Optional[List[Dict]]) -> str:
+    """Folder of the SAR templates of the customer."""
+    return "Persona Fisica" if is_persona_fisica(customer_data) else "Persona Juridica"
+
+
+def get_sar_prompts(sar_folder_type: str, storage=None) -> Dict[QuestionsTypesSAR, str]:
+    """Questions of the SAR, built from the templates (SAR_TEMPLATES_FOLDER) of the customer type, in order."""
+    storage = storage or get_storage_backend()
+    manifest = get_manifest(storage)
+    reference_documents = get_reference_documents(storage, manifest)
+    sar_templates = manifest.files(folder_name=os.path.join(os.getenv("SAR_TEMPLATES_FOLDER", ""), sar_folder_type), full_path=True)
+
+    def read_docx_template(name: TemplateNameSAR) -> str:
+        for file in sar_templates:
+            if name.value in file:
+                return reference_documents.text(file)
+        return ""
+
+    return {
+        QuestionsTypesSAR.RESUMEN_EJECUTIVO: Prompts.resumen_ejecutivo(
+            template=read_docx_template(TemplateNameSAR.RESUMEN_EJECUTIVO)),
+        QuestionsTypesSAR.IDENTIFICACION_INTERVINIENTE: Prompts.identificacion_interviniente(
+            template=read_docx_template(TemplateNameSAR.IDENTIFICACION_INTERVINIENTE)),
+        QuestionsTypesSAR.DESCRIPCION_OPERACIONES: Prompts.descripcion_operaciones(
+            template=read_docx_template(TemplateNameSAR.DESCRIPCION_OPERACIONES)),
+        QuestionsTypesSAR.INDICIO_BLANQUEO: Prompts.indicios_blanqueo(
+            template=read_docx_template(TemplateNameSAR.INDICIO_BLANQUEO)),
+        QuestionsTypesSAR.GESTIONES_COMPROBACIONES: Prompts.gestiones_comprobaciones(
+            template=read_docx_template(TemplateNameSAR.GESTIONES_COMPROBACIONES)),
+        QuestionsTypesSAR.DOCUMENTACION_REMITIDA: Prompts.documentacion_remitida(
+            template=read_docx_template(TemplateNameSAR.DOCUMENTACION_REMITIDA)),
+    }
+
+
+def build_sar_prompt(case_data: CaseData, narrative_output: str, alert_data: List[Dict], customer_data: List[Dict], sheet_names: Optional[List[str]] = None) -> str:
+    """Base prompt of the SAR of a case, with the text of its narrative and the alert and customer data of SAR_DATA_FOLDER."""
+    sheet_names = list(case_data.excel_data) if sheet_names is None else sheet_names
+    return Prompts.base_prompt_SAR(
+        alert_data=alert_data,
+        customer_data=customer_data,
+        transactions_df=render_sheets(case_data.excel_data, sheet_names),
+        narrative_output=narrative_output,
+    )
+
+
+def build_sar(
+    case_data: CaseData,
+    narrative: Optional[Sections] = None,
+    prompts: Optional[Dict[QuestionsTypesSAR, str]] = None,
+    report_generator: Optional[ReportGenerator] = None,
+    stream: Optional[Callable[[QuestionsTypesSAR, Iterator[str]], str]] = None,
+    on_section: Optional[Callable[[QuestionsTypesSAR, str], None]] = None,
+    storage=None,
+) -> SARSections:
+    """
+    Generate the SAR of a case from its narrative (needed unless a report generator with the SAR prompt is given,
+    see build_sar_prompt). `stream` is called with the answer stream of each section
+    (except the money laundering indicators, which are not streamed) and returns the answer, e.g. st.write_stream.
+    `on_section` is called with the answer of each section.
+    """
+    if report_generator is None or prompts is None:
+        storage = storage or get_storage_backend()
+        sar_data_path = os.getenv("SAR_DATA_FOLDER", "")
+        files = get_manifest(storage).files(folder_name=os.path.join(sar_data_path, case_data.case), full_path=False)
+        customer_data = read_case_json(storage, sar_data_path, case_data.case, files, CUSTOMER_KEYWORDS)
+        if prompts is None:
+            prompts = get_sar_prompts(get_sar_folder_type(customer_data), storage=storage)
+        if report_generator is None:
+            if narrative is None:
+                raise ValueError("The narrative is needed to build the SAR prompt")
+            alert_data = read_case_json(storage, sar_data_path, case_data.case, files, ALERT_KEYWORDS)
+            report_generator = get_report_generator(build_sar_prompt(case_data, "\n".join(narrative.values()), alert_data, customer_data), case_data.case)
+
+    answers: SARSections = {}
+    for question_type, question in prompts.items():
+        if question_type == QuestionsTypesSAR.INDICIO_BLANQUEO:
+            answer = report_generator.ask_question(question, session_id=case_data.case, section=question_type.name)
+        else:
+            chunks = report_generator.ask_question_stream(question, session_id=case_data.case, section=question_type.name)
+            answer = stream(question_type, chunks) if stream else "".join(chunks)
+        answers[question_type] = answer
+        if on_section:
+            on_section(question_type, answer)
+    return answers
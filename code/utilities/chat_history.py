@@ -0,0 +1,110 @@
+"""
+This module contains the chat history store of the conversations with the LLM: one pooled SQLAlchemy engine per
+DATABASE_URL for the whole process (SQLite databases are opened in WAL mode, so sessions can read while another
+one writes), and the SQLChatMessageHistory of each session, which is built once and then reused.
+
+The database is shared by every session of the process: a session clears its own conversation with history.clear(),
+and the database file is only removed by reset_database, when no session is using it (e.g. at server start).
+"""
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from langchain_community.chat_message_histories import SQLChatMessageHistory
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+
+DEFAULT_DATABASE_URL = "sqlite:///memory.db"
+
+# Connection settings of SQLite databases: WAL journal, relaxed fsync (safe in WAL mode), wait for locks instead of failing
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=30000",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA temp_store=MEMORY",
+)
+
+_engines: Dict[str, Engine] = {}
+_histories: "OrderedDict[tuple, SQLChatMessageHistory]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def _create_engine(database_url: str) -> Engine:
+    if not database_url.startswith("sqlite"):
+        return create_engine(database_url, pool_size=int(os.getenv("DATABASE_POOL_SIZE", 10)), pool_pre_ping=True)
+
+    in_memory = database_url in ("sqlite://", "sqlite:///:memory:")
+    engine_args = {"connect_args": {"check_same_thread": False, "timeout": 30}}
+    if not in_memory:
+        engine_args["pool_size"] = int(os.getenv("DATABASE_POOL_SIZE", 10))
+    engine = create_engine(database_url, **engine_args)
+    if not in_memory:
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+    return engine
+
+
+def get_engine(database_url: Optional[str] = None) -> Engine:
+    """Return the process-wide engine of a database (DATABASE_URL by default), creating it on first use."""
+    database_url = database_url or os.getenv("DATABASE_URL", DEFAULT_DATABASE_URL)
+    with _lock:
+        if database_url not in _engines:
+            logging.info(f"Creating chat history engine for {database_url.split('@')[-1]}")
+            _engines[database_url] = _create_engine(database_url)
+        return _engines[database_url]
+
+
+def get_session_history(session_id: str, database_url: Optional[str] = None) -> SQLChatMessageHistory:
+    """
+    Return the chat history of a session. Histories are stateless views over the database, so they are reused
+    (up to CHAT_HISTORY_CACHE_SIZE sessions) instead of creating their table model and checking the table every time.
+    """
+    database_url = database_url or os.getenv("DATABASE_URL", DEFAULT_DATABASE_URL)
+    key = (database_url, session_id)
+    with _lock:
+        history = _histories.get(key)
+        if history is not None:
+            _histories.move_to_end(key)
+            return history
+
+    history = SQLChatMessageHistory(session_id, connection=get_engine(database_url))
+    max_entries = int(os.getenv("CHAT_HISTORY_CACHE_SIZE", 256))
+    with _lock:
+        history = _histories.setdefault(key, history)
+        _histories.move_to_end(key)
+        while len(_histories) > max_entries:
+            _histories.popitem(last=False)
+    return history
+
+
+def reset_database(database_url: Optional[str] = None):
+    """
+    Delete the whole chat history database (DATABASE_URL by default): the pooled engine is disposed, the cached
+    histories dropped and, for a SQLite file, the database is removed with its WAL and shared-memory files.
+    Only call it when no session is using the database, e.g. once at server start.
+    """
+    database_url = database_url or os.getenv("DATABASE_URL", DEFAULT_DATABASE_URL)
+    with _lock:
+        engine = _engines.pop(database_url, None)
+        if engine is not None:
+            engine.dispose()
+        for key in [key for key in _histories if key[0] == database_url]:
+            del _histories[key]
+    url = make_url(database_url)
+    if url.get_backend_name() == "sqlite" and url.database and url.database != ":memory:":
+        for path in (url.database, url.database + "-wal", url.database + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+        logging.info(f"Chat history database {url.database} reset")
+    else:
+        logging.warning(f"Chat history database {database_url.split('@')[-1]} is not a SQLite file, it was not reset")
@@ -0,0 +1,369 @@
+"""
+This module contains the functions to extract the text of the case documents (docx and PDF attachments, Playbook,
+alert assessments...) from their in-memory content, and to extract many of them in parallel worker processes.
+"""
+
+import io
+import logging
+import multiprocessing
+import os
+import posixpath
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, IO, Iterable, Iterator, List, Optional, Tuple, Union
+
+import docx
+import fitz
+from lxml import etree
+from docx.oxml.text.paragraph import CT_P
+from docx.oxml.table import CT_Tbl
+
+# Extensions of the documents whose text can be extracted
+SUPPORTED_DOCUMENT_EXTENSIONS = (".docx", ".pdf")
+
+# Below this number of documents (or PDF page ranges), they are extracted in the calling process
+PARALLEL_EXTRACTION_MIN_DOCUMENTS = 2
+
+# WordprocessingML names used by the streaming extractor
+W_NAMESPACE = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+W = "{%s}" % W_NAMESPACE
+RELATIONSHIPS_NAMESPACE = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+OFFICE_DOCUMENT_RELATIONSHIP = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+DEFAULT_MAIN_PART = "word/document.xml"
+
+# Text of the run children, as python-docx renders them (w:br is only a line break when it is a text wrapping break)
+RUN_CHILD_TEXT = {W + "cr": "\n", W + "noBreakHyphen": "-", W + "ptab": "\t", W + "tab": "\t"}
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+_process_pool_lock = threading.Lock()
+
+
+def get_docx_text(file: Union[str, bytes, bytearray, memoryview]) -> str:
+    """
+    Extract text from a docx file, including paragraphs and tables in order.
+    Uses the streaming extractor, and the python-docx object model if the file cannot be streamed.
+    """
+    try:
+        return get_docx_text_streaming(file)
+    except (zipfile.BadZipFile, KeyError, IndexError, ValueError, etree.LxmlError) as e:
+        logging.info(f"Streaming docx extraction failed ({e!r}), using python-docx")
+        return get_docx_text_object_model(file)
+
+
+def get_docx_text_object_model(file: Union[str, bytes, bytearray, memoryview]) -> str:
+    """
+    Extract text from a docx file, including paragraphs and tables in order, building its python-docx object model.
+    """
+    file_obj: Union[str, IO[bytes]]
+    
+    if isinstance(file, (bytes, bytearray, memoryview)):
+        # Convert bytearray and memoryview to bytes
+        if isinstance(file, (bytearray, memoryview)):
+            file = bytes(file)
+        file_obj = io.BytesIO(file)
+    else:
+        file_obj = file
+
+    doc = docx.Document(file_obj)
+    fullText = []
+
+    for element in doc.element.body:
+        if isinstance(element, CT_P):  # Check if the element is a paragraph
+            para = docx.text.paragraph.Paragraph(element, doc)
+            fullText.append(para.text)
+        elif isinstance(element, CT_Tbl):  # Check if the element is a table
+            table = docx.table.Table(element, doc)
+            md_table = table_to_markdown(table)
+            fullText.append(md_table)
+            fullText.append('\n')  # Separate tables with a newline
+
+    return '\n'.join(fullText)
+
+
+
+def _get_main_part_name(docx_zip: zipfile.ZipFile) -> str:
+    """Return the name of the main document part, from the package relationships."""
+    try:
+        rels = etree.fromstring(docx_zip.read("_rels/.rels"), parser=etree.XMLParser(resolve_entities=False))
+    except KeyError:
+        return DEFAULT_MAIN_PART
+    for rel in rels.iter(RELATIONSHIPS_NAMESPACE + "Relationship"):
+        if rel.get("Type") == OFFICE_DOCUMENT_RELATIONSHIP and rel.get("TargetMode") != "External":
+            return posixpath.normpath(rel.get("Target", DEFAULT_MAIN_PART)).lstrip("/")
+    return DEFAULT_MAIN_PART
+
+
+def _run_text(r) -> str:
+    text = []
+    for child in r:
+        if child.tag == W + "t":
+            text.append(child.text or "")
+        elif child.tag == W + "br":
+            if child.get(W + "type", "textWrapping") == "textWrapping":
+                text.append("\n")
+        elif child.tag in RUN_CHILD_TEXT:
+            text.append(RUN_CHILD_TEXT[child.tag])
+    return "".join(text)
+
+
+def _paragraph_text(p) -> str:
+    """Text of a w:p element: its runs and the runs of its hyperlinks (same as python-docx Paragraph.text)."""
+    text = []
+    for child in p:
+        if child.tag == W + "r":
+            text.append(_run_text(child))
+        elif child.tag == W + "hyperlink":
+            text.extend(_run_text(r) for r in child.iterchildren(W + "r"))
+    return "".join(text)
+
+
+def _int_property(element, path: str, default: int) -> int:
+    values = element.xpath(path + "/@w:val", namespaces={"w": W_NAMESPACE})
+    return int(values[0]) if values else default
+
+
+def _table_rows(tbl) -> List[List[str]]:
+    """
+    Text of the cells of each row of a w:tbl element, with the layout of python-docx _Row.cells: a cell spanning
+    several grid columns is repeated once per column, and a vertically merged cell repeats the cell above.
+    """
+    rows: List[List[str]] = []
+    # Position and width of the cell starting at each grid offset of the previous row, to resolve vertical merges
+    previous_row_offsets: Dict[int, Tuple[int, int]] = {}
+    previous_row: Optional[List[str]] = None
+    for tr in tbl.iterchildren(W + "tr"):
+        grid_before = _int_property(tr, "w:trPr/w:gridBefore", 0)
+        offset = grid_before
+        row: List[str] = []
+        row_offsets: Dict[int, Tuple[int, int]] = {}
+        for tc in tr.iterchildren(W + "tc"):
+            grid_span = _int_property(tc, "w:tcPr/w:gridSpan", 1)
+            v_merge = tc.xpath("w:tcPr/w:vMerge", namespaces={"w": W_NAMESPACE})
+            if v_merge and v_merge[0].get(W + "val", "continue") == "continue":
+                if previous_row is None or offset not in previous_row_offsets:
+                    raise ValueError(f"no `tc` element at grid_offset={offset}")
+                # The cell above is already resolved (and repeated once per grid column) in the previous row
+                start, width = previous_row_offsets[offset]
+                cells = previous_row[start:start + width]
+            else:
+                cells = ["\n".join(_paragraph_text(p) for p in tc.iterchildren(W + "p"))] * grid_span
+            row_offsets[offset] = (len(row), len(cells))
+            row.extend(cells)
+            offset += grid_span
+        rows.append(row)
+        previous_row, previous_row_offsets = row, row_offsets
+    return rows
+
+
+def _rows_to_markdown(rows: List[List[str]]) -> str:
+    """Same output as `table_to_markdown`, from the text of the cells of each row."""
+    headers = [text.strip() for text in rows[0]]
+    md_table = ['| ' + ' | '.join(headers) + ' |', '|' + ' --- |' * len(headers)]
+    for row in rows[1:]:
+        md_table.append('| ' + ' | '.join(text.strip() for text in row) + ' |')
+    return '\n'.join(md_table)
+
+
+def _iter_docx_blocks(file_obj: Union[str, IO[bytes]]) -> Iterator[str]:
+    """
+    Yield the text of the paragraphs and the Markdown of the tables of the document body, in order,
+    parsing the main document part incrementally and discarding each block once it is rendered.
+    """
+    with zipfile.ZipFile(file_obj) as docx_zip:
+        with docx_zip.open(_get_main_part_name(docx_zip)) as document_xml:
+            for _, element in etree.iterparse(document_xml, events=("end",), tag=(W + "p", W + "tbl"), resolve_entities=False):
+                parent = element.getparent()
+                # Paragraphs and tables nested in tables (or content controls) are rendered with their container
+                if parent is None or parent.tag != W + "body":
+                    continue
+                if element.tag == W + "p":
+                    yield _paragraph_text(element)
+                else:
+                    yield _rows_to_markdown(_table_rows(element))
+                    yield '\n'  # Separate tables with a newline
+                # Free the rendered block, and the already rendered ones before it
+                element.clear()
+                while element.getprevious() is not None:
+                    del parent[0]
+
+
+def get_docx_text_streaming(file: Union[str, bytes, bytearray, memoryview]) -> str:
+    """
+    Extract text from a docx file, including paragraphs and tables in order, streaming its main XML part
+    instead of building the python-docx object model. Same output as `get_docx_text_object_model`.
+    """
+    file_obj: Union[str, IO[bytes]]
+    if isinstance(file, (bytes, bytearray, memoryview)):
+        file_obj = io.BytesIO(file)
+    else:
+        file_obj = file
+    return '\n'.join(_iter_docx_blocks(file_obj))
+
+
+def table_to_markdown(table: docx.table.Table) -> str:
+    """
+    Convert a docx table to a Markdown formatted string.
+    """
+    md_table = []
+    # Extract headers
+    headers = []
+    for cell in table.rows[0].cells:
+        headers.append(cell.text.strip())
+    md_table.append('| ' + ' | '.join(headers) + ' |')
+    md_table.append('|' + ' --- |' * len(headers))
+
+    # Extract rows
+    for row in table.rows[1:]:
+        row_text = []
+        for cell in row.cells:
+            row_text.append(cell.text.strip())
+        md_table.append('| ' + ' | '.join(row_text) + ' |')
+    
+    return '\n'.join(md_table)
+
+
+def get_pdf_page_count(content: bytes) -> int:
+    with fitz.open(stream=content, filetype="pdf") as pdf:
+        return pdf.page_count
+
+
+def get_pdf_text(content: bytes, first_page: int = 0, last_page: Optional[int] = None) -> str:
+    """Extract the text of the pages [first_page, last_page) of a PDF file (all of them by default), page by page."""
+    with fitz.open(stream=content, filetype="pdf") as pdf:
+        last_page = pdf.page_count if last_page is None else min(last_page, pdf.page_count)
+        return '\n'.join(pdf[page_number].get_text() for page_number in range(first_page, last_page))
+
+
+def _pdf_limits() -> Tuple[int, int]:
+    return int(os.getenv("PDF_MAX_PAGES", 100)), int(os.getenv("PDF_MAX_BYTES", 20 * 1024 * 1024))
+
+
+def _oversized_pdf_note(filename: str, size: int, max_bytes: int) -> str:
+    logging.warning(f"PDF {filename} not extracted: {size:,} bytes exceed PDF_MAX_BYTES ({max_bytes:,})")
+    return f"[PDF not extracted: {size:,} bytes exceed the maximum size of {max_bytes:,} bytes]"
+
+
+def _truncated_pdf_note(page_count: int, max_pages: int) -> str:
+    return f"\n[PDF truncated: only the first {max_pages} of {page_count} pages were extracted]"
+
+
+def extract_document_text(filename: str, content: bytes) -> str:
+    """Extract the text of a document from its content, according to its extension."""
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".docx":
+        return get_docx_text(content)
+    if extension == ".pdf":
+        max_pages, max_bytes = _pdf_limits()
+        if len(content) > max_bytes:
+            return _oversized_pdf_note(filename, len(content), max_bytes)
+        page_count = get_pdf_page_count(content)
+        text = get_pdf_text(content, last_page=max_pages)
+        return text + (_truncated_pdf_note(page_count, max_pages) if page_count > max_pages else "")
+    raise ValueError(f"Unsupported document type: {filename}")
+
+
+def _extract_document_part(filename: str, content: bytes, first_page: int, last_page: Optional[int]) -> Tuple[str, float]:
+    """Extract a document (or a range of pages of a PDF) in a worker process. Returns its text and the extraction time."""
+    start = time.perf_counter()
+    if last_page is None:
+        text = extract_document_text(filename, content)
+    else:
+        text = get_pdf_text(content, first_page, last_page)
+    return text, time.perf_counter() - start
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """
+    Return the process-wide pool of worker processes used to extract documents, creating it on first use.
+    Workers are spawned (not forked), so they do not inherit the locks held by the threads of the web server.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            max_workers = int(os.getenv("DOCUMENT_WORKERS", min(4, os.cpu_count() or 1)))
+            _process_pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+        return _process_pool
+
+
+def _discard_process_pool(pool: ProcessPoolExecutor):
+    """Shut a broken pool down, so the next call to `get_process_pool` creates a new one."""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is pool:
+            _process_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def map_in_process_pool(function: Callable, *iterables: Iterable) -> List[Any]:
+    """
+    Map a function over the worker processes, in order. If a worker died (e.g. killed for running out of memory),
+    the pool is broken for good: it is replaced by a new one and the whole map is retried once.
+    """
+    iterables = tuple(list(iterable) for iterable in iterables)
+    pool = get_process_pool()
+    try:
+        return list(pool.map(function, *iterables))
+    except BrokenProcessPool as e:
+        logging.warning(f"Worker process pool broken ({e}), retrying with a new pool")
+        _discard_process_pool(pool)
+        return list(get_process_pool().map(function, *iterables))
+
+
+def extract_documents(contents: Dict[str, bytes], timings: Optional[Dict[str, float]] = None) -> Dict[str, str]:
+    """
+    Extract the text of several documents, given their content keyed by filename, across the worker processes.
+    PDF files are split into ranges of PDF_PAGES_PER_TASK pages extracted in parallel, up to PDF_MAX_PAGES pages
+    and PDF_MAX_BYTES bytes per file. The extraction time of each file is logged (and stored in `timings` if given).
+    The result keeps the order of `contents`.
+    """
+    max_pages, max_bytes = _pdf_limits()
+    pages_per_task = int(os.getenv("PDF_PAGES_PER_TASK", 10))
+
+    # Split the documents into tasks: whole documents, or page ranges of the PDF files
+    texts: Dict[str, str] = {}
+    notes: Dict[str, str] = {}
+    tasks: List[Tuple[str, int, Optional[int]]] = []
+    for filename, content in contents.items():
+        if os.path.splitext(filename)[1].lower() != ".pdf":
+            tasks.append((filename, 0, None))
+            continue
+        if len(content) > max_bytes:
+            texts[filename] = _oversized_pdf_note(filename, len(content), max_bytes)
+            continue
+        try:
+            page_count = get_pdf_page_count(content)
+        except RuntimeError as e:
+            logging.warning(f"PDF {filename} could not be opened: {e}")
+            page_count = 0
+        if page_count == 0:
+            texts[filename] = ""
+            continue
+        if page_count > max_pages:
+            notes[filename] = _truncated_pdf_note(page_count, max_pages)
+        for first_page in range(0, min(page_count, max_pages), pages_per_task):
+            tasks.append((filename, first_page, min(first_page + pages_per_task, page_count, max_pages)))
+
+    args = ([filename for filename, _, _ in tasks], [contents[filename] for filename, _, _ in tasks],
+            [first_page for _, first_page, _ in tasks], [last_page for _, _, last_page in tasks])
+    if len(tasks) < PARALLEL_EXTRACTION_MIN_DOCUMENTS:
+        results = list(map(_extract_document_part, *args))
+    else:
+        results = map_in_process_pool(_extract_document_part, *args)
+
+    # Join the page ranges of each file, in order
+    parts: Dict[str, List[str]] = {}
+    elapsed: Dict[str, float] = {}
+    for (filename, _, _), (text, seconds) in zip(tasks, results):
+        parts.setdefault(filename, []).append(text)
+        elapsed[filename] = elapsed.get(filename, 0.0) + seconds
+    for filename, file_parts in parts.items():
+        texts[filename] = '\n'.join(file_parts) + notes.get(filename, "")
+        logging.info(f"Extracted {filename} in {elapsed[filename]:.2f} s")
+    if timings is not None:
+        timings.update(elapsed)
+
+    logging.info(f"Extracted the text of {len(contents)} documents")
+    return {filename: texts[filename] for filename in contents}
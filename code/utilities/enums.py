@@ -37,6 +37,14 @@ class TemplateNameSAR(Enum):
     GESTIONES_COMPROBACIONES = "GestionesyComprobacionesRealizadas"
     DOCUMENTACION_REMITIDA = "DocumentacionRemitida"
 
+class HistoryStrategies(Enum):
+    """
+    Enum for the strategies of the conversation history sent to the LLM
+    """
+    FULL = "full"
+    LAST_N = "last_n"
+    SUMMARY = "summary"
+
 class CaseTypes(Enum):
     """
     Enum for case typologies
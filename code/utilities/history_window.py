@@ -0,0 +1,171 @@
+"""
+This module contains the HistoryWindow class, which chooses the part of a conversation sent to the LLM with each
+question, so that the input does not grow with every section asked:
+- full: the whole conversation.
+- last_n: the last `last_n` turns (question and answer).
+- summary: the most recent turns that fit in `max_tokens`, with the older turns replaced by a summary.
+
+Questions are tagged with the section they belong to (QuestionsTypes name), so a question can also be asked with
+only the turns of the sections it depends on.
+
+The summaries of the older turns are kept for the process, by session and history length, so the generators of the
+following pages do not summarise the same turns again.
+"""
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+from utilities.enums import HistoryStrategies
+from utilities.tokenizer import count_tokens_batch
+
+SECTION_KEY = "section"
+
+SUMMARY_CACHE_SIZE = 64
+
+# Summaries by (session id, sections selected, length of the history, number of summarised messages)
+_summaries: "OrderedDict[Tuple, str]" = OrderedDict()
+_summaries_lock = threading.Lock()
+
+
+def tag_section(message: BaseMessage, section: Optional[str]) -> BaseMessage:
+    """Tag a message with the section it belongs to (stored with the message in the chat history)."""
+    if section:
+        message.additional_kwargs[SECTION_KEY] = section
+    return message
+
+
+def get_section(message: BaseMessage) -> Optional[str]:
+    return message.additional_kwargs.get(SECTION_KEY)
+
+
+def split_turns(messages: List[BaseMessage]) -> List[List[BaseMessage]]:
+    """Split a conversation in turns, each one starting with a question (HumanMessage)."""
+    turns: List[List[BaseMessage]] = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def count_message_tokens(messages: List[BaseMessage]) -> int:
+    return sum(count_tokens_batch([str(message.content) for message in messages])) if messages else 0
+
+
+def clear_summaries(session_id: str):
+    """Forget the summaries of a session (its history was cleared, so its lengths no longer match)."""
+    with _summaries_lock:
+        for key in [key for key in _summaries if key[0] == session_id]:
+            del _summaries[key]
+
+
+class HistoryWindow:
+
+    def __init__(
+        self,
+        strategy: HistoryStrategies = HistoryStrategies.FULL,
+        last_n: int = 6,
+        max_tokens: int = 30000,
+        summarizer: Optional[Callable[[List[BaseMessage]], str]] = None,
+    ):
+        """
+        Args:
+            strategy (HistoryStrategies): Part of the conversation sent with each question.
+            last_n (int): Turns kept by the last_n strategy.
+            max_tokens (int): Token ceiling of the turns kept verbatim by the summary strategy.
+            summarizer (Callable): Function that summarises a list of messages (required by the summary strategy).
+        """
+        if strategy == HistoryStrategies.SUMMARY and summarizer is None:
+            raise ValueError("The summary history strategy needs a summarizer")
+        self.strategy = strategy
+        self.last_n = last_n
+        self.max_tokens = max_tokens
+        self.summarizer = summarizer
+
+    @classmethod
+    def from_env(cls, summarizer: Optional[Callable[[List[BaseMessage]], str]] = None) -> "HistoryWindow":
+        """Window configured with HISTORY_STRATEGY, HISTORY_LAST_N and HISTORY_MAX_TOKENS."""
+        return cls(
+            strategy=HistoryStrategies(os.getenv("HISTORY_STRATEGY", HistoryStrategies.FULL.value).lower()),
+            last_n=int(os.getenv("HISTORY_LAST_N", 6)),
+            max_tokens=int(os.getenv("HISTORY_MAX_TOKENS", 30000)),
+            summarizer=summarizer,
+        )
+
+    @staticmethod
+    def select_sections(turns: List[List[BaseMessage]], sections: Sequence[str]) -> Optional[List[List[BaseMessage]]]:
+        """
+        Latest turn of each of the given sections (that were asked), in conversation order.
+        Returns None if no question of the conversation is tagged (a history saved before questions were tagged).
+        """
+        latest = {}
+        tagged = False
+        for index, turn in enumerate(turns):
+            section = get_section(turn[0])
+            tagged = tagged or section is not None
+            if section in sections:
+                latest[section] = index
+        if not tagged:
+            return None
+        return [turns[index] for index in sorted(latest.values())]
+
+    def _summarize(self, messages: List[BaseMessage], key: Optional[Tuple]) -> str:
+        # Without a session the summary is not kept
+        if key is None:
+            return self.summarizer(messages)
+        with _summaries_lock:
+            if key in _summaries:
+                _summaries.move_to_end(key)
+                return _summaries[key]
+        summary = self.summarizer(messages)
+        with _summaries_lock:
+            _summaries[key] = summary
+            while len(_summaries) > SUMMARY_CACHE_SIZE:
+                _summaries.popitem(last=False)
+        return summary
+
+    def _summary_window(self, turns: List[List[BaseMessage]], key: Optional[Tuple] = None) -> List[BaseMessage]:
+        # Keep the most recent turns under the token ceiling, and summarise the older ones
+        tokens = 0
+        first_kept = len(turns)
+        for index in range(len(turns) - 1, -1, -1):
+            tokens += count_message_tokens(turns[index])
+            if tokens > self.max_tokens:
+                break
+            first_kept = index
+        older = [message for turn in turns[:first_kept] for message in turn]
+        recent = [message for turn in turns[first_kept:] for message in turn]
+        if not older:
+            return recent
+        summary = self._summarize(older, key + (len(older),) if key is not None else None)
+        return [SystemMessage(content=f"Resumen de la conversación anterior:\n{summary}")] + recent
+
+    def apply(
+        self,
+        messages: List[BaseMessage],
+        sections: Optional[Sequence[str]] = None,
+        session_id: Optional[str] = None,
+    ) -> List[BaseMessage]:
+        """
+        Part of the conversation to send with the next question. If `sections` is given (even empty), only the
+        turns of those sections are considered. The summaries of the summary strategy are kept by `session_id`.
+        """
+        turns = split_turns(messages)
+        if sections is not None:
+            selected = self.select_sections(turns, sections)
+            if selected is None:
+                logging.info("The conversation history has no sections, using the whole history")
+            else:
+                turns = selected
+
+        if self.strategy == HistoryStrategies.LAST_N:
+            turns = turns[-self.last_n:] if self.last_n > 0 else []
+        elif self.strategy == HistoryStrategies.SUMMARY:
+            key = (session_id, tuple(sections) if sections is not None else None, len(messages)) if session_id else None
+            return self._summary_window(turns, key)
+        return [message for turn in turns for message in turn]
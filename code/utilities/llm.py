@@ -1,16 +1,22 @@
 import os
 import logging
-from typing import Optional
-import openai
-from langchain_openai import ChatOpenAI, AzureChatOpenAI
+import re
+from functools import lru_cache
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Sequence
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.messages import HumanMessage
-from langchain_community.chat_message_histories import SQLChatMessageHistory
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
 from langchain_core.chat_history import BaseChatMessageHistory
-from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_core.runnables.config import RunnableConfig
 from langchain_core.runnables import RunnableSequence
-from sqlalchemy import create_engine
+
+from utilities import chat_history
+from utilities.admission import AdmissionStatus, Ticket, estimate_output_tokens, get_admission_controller
+from utilities.history_window import HistoryWindow, clear_summaries, count_message_tokens, tag_section
+from utilities.llm_clients import get_async_chat_model, get_chat_model
+from utilities.prompts import Prompts
+from utilities.response_cache import get_cache_key, get_response_cache, is_response_cache_enabled
+from utilities.retry import RetryPolicy, acall_with_retry, astream_with_retry, call_with_retry, stream_with_retry
+from utilities.tokenizer import count_tokens
 
 
 # Setup logging
@@ -20,26 +26,47 @@ class ReportGenerator:
 
     DEFAULT_MODEL = "gpt-4o"
 
-    def __init__(self, prompt: str, model: str, session_id: str = "default_session_id", temperature: float = 0.0):
+    def __init__(
+        self,
+        prompt: str,
+        model: str,
+        session_id: str = "default_session_id",
+        temperature: float = 0.0,
+        use_cache: Optional[bool] = None,
+        history_window: Optional[HistoryWindow] = None,
+        queue_key: Optional[str] = None,
+    ):
         logging.info("Initializing ReportGenerator...")
 
         self.model_interface = os.getenv("OPENAI_MODEL_INTERFACE", "azure").lower()
-        if self.model_interface not in ["openai", "azure"]:
-            raise ValueError(f'Model interface "{self.model_interface}" not supported. Use "openai" or "azure".')
-
-        if self.model_interface == "openai":
-            openai.api_key = self.get_env_variable('OPENAI_API_KEY')
-            self.model = ChatOpenAI(model=model, temperature=temperature)
-        elif self.model_interface == "azure":
-            openai.base_url = self.get_env_variable('AZURE_OPENAI_ENDPOINT')
-            openai.api_key = self.get_env_variable('AZURE_OPENAI_API_KEY')
-            openai.api_version = self.get_env_variable('OPENAI_API_VERSION')
-            self.model = AzureChatOpenAI(deployment_name=model, temperature=temperature)
-        
+        # Chat models (and their HTTP connections) are shared by all the generators of the process
+        self.model = get_chat_model(self.model_interface, model, temperature)
+
         self.prompt = self.set_prompt(prompt=prompt)
         self.chain = RunnableSequence(self.prompt | self.model)
         self.session_id = session_id
-        self.set_message_history()
+        # Part of the conversation sent with each question (HISTORY_STRATEGY)
+        self.history_window = history_window or HistoryWindow.from_env(summarizer=self.summarize_messages)
+        # Retries of rate limits and transient errors (LLM_MAX_RETRIES), the clients do not retry by themselves
+        self.retry_policy = RetryPolicy.from_env()
+        # Calls wait for the TPM/RPM quota of the deployment (LLM_TPM_LIMIT, LLM_RPM_LIMIT), queued fairly per analyst
+        # session (`queue_key`, the session id by default); `on_admission_wait` is called with the status while waiting
+        self.admission = get_admission_controller(self.model_interface, model)
+        self.queue_key = queue_key
+        self.on_admission_wait: Optional[Callable[[Optional[AdmissionStatus]], None]] = None
+
+        # Opt-in response cache (LLM_CACHE_ENABLED), keyed by the fingerprint of each request
+        self.system_prompt = prompt
+        self.model_name = model
+        self.temperature = temperature
+        if use_cache is None:
+            use_cache = is_response_cache_enabled()
+        self.response_cache = get_response_cache() if use_cache else None
+        # Whether the last answer to each question came from the cache (each call only sets its own question, so the
+        # sections asked concurrently do not overwrite each other)
+        self.cached_answers: Dict[str, bool] = {}
+        # Input tokens of the last call to the LLM
+        self.last_input_tokens = 0
 
     @staticmethod
     def get_env_variable(var_name: str) -> str:
@@ -61,47 +88,211 @@ class ReportGenerator:
     @staticmethod
     def clear_session(session_id: str):
         ReportGenerator.get_session_history(session_id).clear()
+        clear_summaries(session_id)
 
     @staticmethod
     def get_session_history(session_id: str) -> BaseChatMessageHistory:
-        # Create a SQLAlchemy engine
-        database_url = os.getenv('DATABASE_URL', 'sqlite:///memory.db')  # Default to SQLite in-memory DB
-        engine = create_engine(database_url)
-
-        # Pass the connection object to SQLChatMessageHistory
-        return SQLChatMessageHistory(session_id, connection=engine)
+        # Histories share one pooled engine per DATABASE_URL (see utilities.chat_history)
+        return chat_history.get_session_history(session_id)
     
-    def set_message_history(self):
-        self.with_message_history = \
-            RunnableWithMessageHistory(
-                self.chain,
-                ReportGenerator.get_session_history,
-                input_messages_key="messages"
-            )
+    @staticmethod
+    @lru_cache(maxsize=32)
+    def get_prompt_template(prompt: str) -> ChatPromptTemplate:
+        # Parsed once per base prompt, instead of on every page rerun
+        return ChatPromptTemplate.from_messages(
+            [
+                ("system", prompt),
+                MessagesPlaceholder(variable_name="messages"),
+            ],
+            template_format="mustache",
+        )
 
     def set_prompt(self, prompt):
         if not hasattr(self, "_cached_prompt"):
-            self._cached_prompt = ChatPromptTemplate.from_messages(
-                [
-                    ("system", prompt),
-                    MessagesPlaceholder(variable_name="messages"),
-                ],
-                template_format="mustache",
-            )
+            self._cached_prompt = ReportGenerator.get_prompt_template(prompt)
         return self._cached_prompt
 
-    def invoke_chain(self, question: str, session_id: Optional[str] = None, stream: bool = False):
-        config = self.get_config(session_id)
-        input_data = {"messages": [HumanMessage(content=question)]}
+    def _cache_key(self, history: List[BaseMessage], question: str) -> str:
+        return get_cache_key(self.model_interface, self.model_name, self.temperature, self.system_prompt, history, question)
+
+    def _get_cached_response(self, key: str, question: str) -> Optional[str]:
+        if self.response_cache is None:
+            return None
+        response = self.response_cache.get(key)
+        self.cached_answers[question] = response is not None
+        if response is not None:
+            logging.info("LLM response served from the cache")
+        return response
+
+    def is_cached(self, question: str) -> bool:
+        """Whether the last answer to a question came from the response cache."""
+        return self.cached_answers.get(question, False)
+
+    @staticmethod
+    def _replay_stream(response: str) -> Iterator[str]:
+        """Replay a cached answer as a stream of words, for the callers that render streams."""
+        yield from re.findall(r"\s*\S+\s*", response) or [response]
+
+    def summarize_messages(self, messages: List[BaseMessage]) -> str:
+        """Summarise a part of the conversation (used by the summary history strategy)."""
+        transcript = "\n\n".join(f"{message.type.upper()}: {message.content}" for message in messages)
+        messages = [SystemMessage(content=Prompts.resumen_historial()), HumanMessage(content=transcript)]
+        tokens = count_message_tokens(messages)
+
+        def call():
+            ticket = self._admit(tokens)
+            response = self.model.invoke(messages)
+            self._settle(ticket, tokens, response.content)
+            return response
+
+        return call_with_retry(call, self.retry_policy).content
+
+    @staticmethod
+    def _resume_messages(partial: str) -> List[BaseMessage]:
+        """Messages that ask to continue an interrupted answer (none if nothing was streamed yet)."""
+        if not partial:
+            return []
+        return [AIMessage(content=partial), HumanMessage(content=Prompts.continuar_respuesta())]
+
+    def _log_input_tokens(self, history: List[BaseMessage], question: str) -> int:
+        tokens = count_message_tokens([SystemMessage(content=self.system_prompt)] + history + [HumanMessage(content=question)])
+        self.last_input_tokens = tokens
+        logging.info(f"LLM call with {tokens} input tokens ({len(history)} history messages)")
+        return tokens
+
+    def _admit(self, input_tokens: int) -> Ticket:
+        return self.admission.acquire(self.queue_key or self.session_id, input_tokens + estimate_output_tokens(), on_wait=self.on_admission_wait)
+
+    async def _aadmit(self, input_tokens: int) -> Ticket:
+        return await self.admission.aacquire(self.queue_key or self.session_id, input_tokens + estimate_output_tokens(), on_wait=self.on_admission_wait)
 
+    def _settle(self, ticket: Ticket, input_tokens: int, response: str):
+        # Give back the part of the reserved answer tokens that was not used
+        if self.admission.enabled:
+            self.admission.settle(ticket, input_tokens + count_tokens(response))
+
+    def _save_stream(self, question: BaseMessage, stream: Iterator[str], key: Optional[str]) -> Iterator[str]:
+        """Pass a stream through, saving the turn to the session history (and the cache) once it is consumed."""
+        chunks = []
+        for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
+        response = "".join(chunks)
+        self.add_messages([question, AIMessage(content=response)])
+        if key:
+            self.response_cache.put(key, response)
+
+    def invoke_chain(
+        self,
+        question: str,
+        session_id: Optional[str] = None,
+        stream: bool = False,
+        section: Optional[str] = None,
+        depends_on: Optional[Sequence[str]] = None,
+    ):
+        """
+        Ask a question after the session history, and save the question and its answer to it.
+        The question is tagged with its `section`; if `depends_on` is given, only the turns of those sections are sent.
+        """
+        if session_id:
+            self.session_id = session_id
+        history = self.history_window.apply(self.session_messages, sections=depends_on, session_id=self.session_id)
+        question_message = tag_section(HumanMessage(content=question), section)
+
+        key = None
+        if self.response_cache is not None:
+            key = self._cache_key(history, question)
+            response = self._get_cached_response(key, question)
+            if response is not None:
+                # Keep the conversation as if the question had been asked
+                self.add_messages([question_message, AIMessage(content=response)])
+                return self._replay_stream(response) if stream else response
+
+        tokens = self._log_input_tokens(history, question)
+        messages = history + [question_message]
         if stream:
-            return (r.content for r in self.with_message_history.stream(input_data, config=config))
+            def start(partial: str) -> Iterator[str]:
+                ticket = self._admit(tokens)
+
+                def chunks():
+                    answer = ""
+                    for r in self.chain.stream({"messages": messages + self._resume_messages(partial)}):
+                        answer += r.content
+                        yield r.content
+                    self._settle(ticket, tokens, answer)
+                return chunks()
+            return self._save_stream(question_message, stream_with_retry(start, self.retry_policy), key)
         else:
-            response = self.with_message_history.invoke(input_data, config=config)
+            def call():
+                ticket = self._admit(tokens)
+                response = self.chain.invoke({"messages": messages})
+                self._settle(ticket, tokens, response.content)
+                return response
+            response = call_with_retry(call, self.retry_policy)
+            self.add_messages([question_message, AIMessage(content=response.content)])
+            if key:
+                self.response_cache.put(key, response.content)
             return response.content
 
-    def ask_question(self, question: str, session_id: Optional[str] = None):
-        return self.invoke_chain(question, session_id, stream=False)
+    def ask_question(self, question: str, session_id: Optional[str] = None, section: Optional[str] = None, depends_on: Optional[Sequence[str]] = None):
+        return self.invoke_chain(question, session_id, stream=False, section=section, depends_on=depends_on)
+
+    def ask_question_stream(self, question: str, session_id: Optional[str] = None, section: Optional[str] = None, depends_on: Optional[Sequence[str]] = None):
+        return self.invoke_chain(question, session_id, stream=True, section=section, depends_on=depends_on)
+
+    def _async_chain(self) -> RunnableSequence:
+        return RunnableSequence(self.prompt | get_async_chat_model(self.model_interface, self.model_name, self.temperature))
 
-    def ask_question_stream(self, question: str, session_id: Optional[str] = None):
-        return self.invoke_chain(question, session_id, stream=True)
+    async def astream_with_history(self, question: str, history: List[BaseMessage]) -> AsyncIterator[str]:
+        """Stream the answer to a question asked after the given messages, without reading or writing the session history."""
+        key = self._cache_key(history, question) if self.response_cache is not None else None
+        response = self._get_cached_response(key, question) if key else None
+        if response is not None:
+            for chunk in self._replay_stream(response):
+                yield chunk
+            return
+        tokens = self._log_input_tokens(history, question)
+        messages = history + [HumanMessage(content=question)]
+        chain = self._async_chain()
+
+        async def start(partial: str) -> AsyncIterator[str]:
+            ticket = await self._aadmit(tokens)
+            answer = ""
+            async for r in chain.astream({"messages": messages + self._resume_messages(partial)}):
+                answer += r.content
+                yield r.content
+            self._settle(ticket, tokens, answer)
+
+        chunks = []
+        async for chunk in astream_with_retry(start, self.retry_policy):
+            chunks.append(chunk)
+            yield chunk
+        if key:
+            self.response_cache.put(key, "".join(chunks))
+
+    async def ainvoke_with_history(self, question: str, history: List[BaseMessage]) -> str:
+        """Answer a question asked after the given messages, without reading or writing the session history."""
+        key = self._cache_key(history, question) if self.response_cache is not None else None
+        response = self._get_cached_response(key, question) if key else None
+        if response is not None:
+            return response
+        tokens = self._log_input_tokens(history, question)
+        input_data = {"messages": history + [HumanMessage(content=question)]}
+        chain = self._async_chain()
+
+        async def call():
+            ticket = await self._aadmit(tokens)
+            response = await chain.ainvoke(input_data)
+            self._settle(ticket, tokens, response.content)
+            return response
+
+        response = await acall_with_retry(call, self.retry_policy)
+        if key:
+            self.response_cache.put(key, response.content)
+        return response.content
+
+    def add_messages(self, messages: List[BaseMessage], session_id: Optional[str] = None):
+        """Append messages (e.g. questions and answers asked outside the session) to the session history."""
+        if session_id:
+            self.session_id = session_id
+        ReportGenerator.get_session_history(self.session_id).add_messages(messages)
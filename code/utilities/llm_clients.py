@@ -0,0 +1,146 @@
+"""
+This module contains the process-wide registry of LLM clients: one chat model per (interface, deployment, temperature),
+shared by every ReportGenerator and session. All of them send their requests through the same pooled httpx client
+(keep-alive and HTTP/2), so a new case or page rerun does not open new connections or repeat the TLS handshake.
+Credentials are passed to each client, instead of being set in the global openai module. The clients do not retry
+by themselves: ReportGenerator retries with the policy of utilities.retry, which honours the rate limit headers.
+
+Asynchronous connections belong to the event loop that opens them, so all the asynchronous calls (e.g. the concurrent
+pre-narrative sections) run on one long-lived event loop, in a background thread, with one pooled async client:
+`run_async` submits a coroutine to it, and its connections and TLS sessions are reused across generations and sessions.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+from typing import Coroutine, Dict, Optional, Tuple, TypeVar
+
+import httpx
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_openai import AzureChatOpenAI, ChatOpenAI
+
+SUPPORTED_INTERFACES = ("openai", "azure")
+
+T = TypeVar("T")
+
+_models: Dict[Tuple[str, str, float], BaseChatModel] = {}
+_http_client: Optional[httpx.Client] = None
+# Event loop of the asynchronous calls, with its HTTP client and chat models
+_event_loop: Optional[asyncio.AbstractEventLoop] = None
+_http_async_client: Optional[httpx.AsyncClient] = None
+_async_models: Dict[Tuple[str, str, float], BaseChatModel] = {}
+_lock = threading.Lock()
+
+
+def _get_env_variable(var_name: str) -> str:
+    value = os.getenv(var_name)
+    if not value:
+        raise EnvironmentError(f"Environment variable {var_name} is not set")
+    return value
+
+
+def _http_client_args() -> dict:
+    return {
+        "http2": os.getenv("LLM_HTTP2", "true").lower() in ("1", "true", "yes"),
+        "limits": httpx.Limits(
+            max_connections=int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", 20)),
+            max_keepalive_connections=int(os.getenv("LLM_HTTP_MAX_KEEPALIVE", 10)),
+            keepalive_expiry=float(os.getenv("LLM_HTTP_KEEPALIVE_EXPIRY", 60)),
+        ),
+        "timeout": httpx.Timeout(float(os.getenv("LLM_HTTP_TIMEOUT", 600)), connect=10.0),
+    }
+
+
+def get_http_client() -> httpx.Client:
+    """Return the pooled HTTP client shared by the synchronous LLM calls."""
+    global _http_client
+    with _lock:
+        if _http_client is None or _http_client.is_closed:
+            _http_client = httpx.Client(**_http_client_args())
+        return _http_client
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Return the event loop of the asynchronous LLM calls, starting its background thread on first use."""
+    global _event_loop
+    with _lock:
+        if _event_loop is None or _event_loop.is_closed():
+            _event_loop = asyncio.new_event_loop()
+            threading.Thread(target=_event_loop.run_forever, name="llm-event-loop", daemon=True).start()
+        return _event_loop
+
+
+def run_async(coroutine: Coroutine[None, None, T]) -> T:
+    """Run a coroutine on the event loop of the asynchronous LLM calls, blocking until it finishes."""
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop()).result()
+
+
+def _check_event_loop():
+    if asyncio.get_running_loop() is not _event_loop:
+        raise RuntimeError("Asynchronous LLM calls must run on the shared event loop (see run_async)")
+
+
+def get_http_async_client() -> httpx.AsyncClient:
+    """Return the pooled HTTP client shared by the asynchronous LLM calls."""
+    global _http_async_client
+    _check_event_loop()
+    with _lock:
+        if _http_async_client is None or _http_async_client.is_closed:
+            _http_async_client = httpx.AsyncClient(**_http_client_args())
+        return _http_async_client
+
+
+def _create_chat_model(interface: str, model: str, temperature: float, http_async_client: Optional[httpx.AsyncClient] = None) -> BaseChatModel:
+    if interface == "openai":
+        return ChatOpenAI(
+            model=model,
+            temperature=temperature,
+            api_key=_get_env_variable("OPENAI_API_KEY"),
+            http_client=get_http_client(),
+            http_async_client=http_async_client,
+            max_retries=0,
+        )
+    return AzureChatOpenAI(
+        azure_deployment=model,
+        temperature=temperature,
+        azure_endpoint=_get_env_variable("AZURE_OPENAI_ENDPOINT"),
+        api_key=_get_env_variable("AZURE_OPENAI_API_KEY"),
+        api_version=_get_env_variable("OPENAI_API_VERSION"),
+        http_client=get_http_client(),
+        http_async_client=http_async_client,
+        max_retries=0,
+    )
+
+
+def _model_key(interface: str, model: str, temperature: float) -> Tuple[str, str, float]:
+    interface = interface.lower()
+    if interface not in SUPPORTED_INTERFACES:
+        raise ValueError(f'Model interface "{interface}" not supported. Use "openai" or "azure".')
+    return interface, model, float(temperature)
+
+
+def get_chat_model(interface: str, model: str, temperature: float = 0.0) -> BaseChatModel:
+    """Return the shared chat model of an interface ("openai" or "azure"), model or deployment and temperature."""
+    key = _model_key(interface, model, temperature)
+    with _lock:
+        chat_model = _models.get(key)
+    if chat_model is None:
+        logging.info(f"Creating {key[0]} chat model for {model} (temperature {temperature})")
+        chat_model = _create_chat_model(*key)
+        with _lock:
+            chat_model = _models.setdefault(key, chat_model)
+    return chat_model
+
+
+def get_async_chat_model(interface: str, model: str, temperature: float = 0.0) -> BaseChatModel:
+    """Return the shared chat model for the asynchronous calls (made on the event loop of run_async)."""
+    key = _model_key(interface, model, temperature)
+    _check_event_loop()
+    with _lock:
+        chat_model = _async_models.get(key)
+    if chat_model is None:
+        chat_model = _create_chat_model(*key, http_async_client=get_http_async_client())
+        with _lock:
+            chat_model = _async_models.setdefault(key, chat_model)
+    return chat_model
@@ -0,0 +1,252 @@
+"""
+This module contains the CaseManifest class, a process-wide in-memory index of the files of every case
+(case → files, with size, ETag and last_modified), so that the pages can list cases and case files without
+listing the storage container on every rerun.
+
+The index is filled lazily, and only under the configured roots: the case folders of a root are listed (folder
+prefixes only) when the cases of the root are first queried, and the files of a case when the case is first queried.
+Afterwards only the folders that are queried after `max_age` seconds are listed again, each one on its own prefix.
+A root queried as a whole is listed at once, and the listings of folders outside the case folders are kept for
+`max_age` seconds too. Listings run outside the lock of the index, so a slow listing does not block the queries of
+other folders.
+"""
+
+import os
+import logging
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from utilities.storage import BlobEntry
+
+
+class CaseManifest:
+
+    def __init__(self, storage, roots: List[str], max_age: float = 60.0):
+        """
+        Args:
+            storage: Storage client used to list the container (e.g. AzureBlobStorageClient).
+            roots (List[str]): Folders whose subfolders are cases (e.g. PRE_NARRATIVE_FOLDER, SAR_DATA_FOLDER).
+            max_age (float): Seconds after which a folder is listed again when it is queried.
+        """
+        self.storage = storage
+        self.roots = [root.strip("/") for root in roots if root]
+        self.max_age = max_age
+        # Blobs grouped by folder key (see `_folder_key`), and the time each folder was last listed
+        self._folders: Dict[str, Dict[str, BlobEntry]] = {}
+        self._listed_at: Dict[str, float] = {}
+        # Case folders of each root, and the time each root was last listed
+        self._cases: Dict[str, Set[str]] = {}
+        self._cases_listed_at: Dict[str, float] = {}
+        # Recursive listings of the folders that are not indexed recursively, and the time each one was listed
+        self._trees: Dict[str, List[BlobEntry]] = {}
+        self._trees_listed_at: Dict[str, float] = {}
+        self._lock = threading.RLock()
+
+    ### INDEX MAINTENANCE ###
+
+    def _folder_key(self, name: str) -> Tuple[str, bool]:
+        """
+        Return the folder a blob is indexed under, and whether that folder is indexed recursively.
+        Blobs inside a case folder are indexed under the case folder ("<root>/<case>"), recursively.
+        Any other blob is indexed under its own directory.
+        """
+        for root in self.roots:
+            if name.startswith(root + "/"):
+                parts = name[len(root) + 1:].split("/")
+                if len(parts) > 1:
+                    return f"{root}/{parts[0]}", True
+                return root, False
+        return os.path.dirname(name), False
+
+    def _is_recursive(self, key: str) -> bool:
+        return any(key.startswith(root + "/") and "/" not in key[len(root) + 1:] for root in self.roots)
+
+    def _refresh_root(self, root: str) -> Dict[str, Dict[str, BlobEntry]]:
+        """
+        List again a whole root (its own files and every case folder) with a single listing, dropping the cases that
+        no longer exist. Call without the lock.
+        """
+        folders: Dict[str, Dict[str, BlobEntry]] = {root: {}}
+        for entry in self.storage.list_entries(root + "/"):
+            key, _ = self._folder_key(entry.name)
+            folders.setdefault(key, {})[entry.name] = entry
+        cases = {key[len(root) + 1:] for key in folders if self._is_recursive(key)}
+        now = time.monotonic()
+        with self._lock:
+            for removed_case in self._cases.get(root, set()) - cases:
+                self._folders.pop(f"{root}/{removed_case}", None)
+                self._listed_at.pop(f"{root}/{removed_case}", None)
+            for key, entries in folders.items():
+                self._folders[key] = entries
+                self._listed_at[key] = now
+            self._cases[root] = cases
+            self._cases_listed_at[root] = now
+        return folders
+
+    def build(self):
+        """Fill the whole index ahead of the queries (e.g. to warm it up), with one listing per root."""
+        start = time.monotonic()
+        for root in self.roots:
+            self._refresh_root(root)
+        logging.info(f"Case manifest built for {len(self.roots)} roots in {time.monotonic() - start:.2f} s")
+
+    def _is_stale(self, listed_at: Optional[float]) -> bool:
+        return listed_at is None or time.monotonic() - listed_at > self.max_age
+
+    def _refresh_folder(self, key: str) -> Dict[str, BlobEntry]:
+        """List again a single folder of the index. Call without the lock."""
+        prefix = key + "/" if key else ""
+        recursive = self._is_recursive(key)
+        entries = {entry.name: entry for entry in self.storage.list_entries(prefix, recursive=recursive)}
+        with self._lock:
+            self._folders[key] = entries
+            self._listed_at[key] = time.monotonic()
+        return entries
+
+    def _refresh_cases(self, root: str) -> Set[str]:
+        """
+        List again the case folders of a root (folder prefixes only), dropping the cases that no longer exist.
+        Call without the lock.
+        """
+        cases = set(self.storage.iter_folders(root))
+        with self._lock:
+            for removed_case in self._cases.get(root, set()) - cases:
+                self._folders.pop(f"{root}/{removed_case}", None)
+                self._listed_at.pop(f"{root}/{removed_case}", None)
+            self._cases[root] = cases
+            self._cases_listed_at[root] = time.monotonic()
+        return cases
+
+    def refresh(self, force: bool = False):
+        """Refresh the folders (and case lists) listed more than `max_age` seconds ago, or all of them if forced."""
+        with self._lock:
+            roots = [root for root in self._cases if force or self._is_stale(self._cases_listed_at.get(root))]
+            keys = [key for key in self._folders if force or self._is_stale(self._listed_at.get(key))]
+            for folder in [folder for folder in self._trees if force or self._is_stale(self._trees_listed_at.get(folder))]:
+                # Listed again when they are next queried
+                del self._trees[folder]
+                self._trees_listed_at.pop(folder, None)
+        for root in roots:
+            self._refresh_cases(root)
+        for key in keys:
+            self._refresh_folder(key)
+
+    def invalidate(self, path: str):
+        """Mark the folder containing the given blob path (and the listings that include it) as stale, e.g. after writing to it."""
+        path = path.replace("\\", "/").strip("/")
+        with self._lock:
+            key, _ = self._folder_key(path)
+            self._listed_at.pop(key, None)
+            for root in self.roots:
+                if key.startswith(root + "/"):
+                    self._cases_listed_at.pop(root, None)
+            for folder in self._trees:
+                if path.startswith(folder + "/"):
+                    self._trees_listed_at.pop(folder, None)
+
+    ### QUERIES ###
+
+    def _get_folder(self, key: str) -> Dict[str, BlobEntry]:
+        with self._lock:
+            if not self._is_stale(self._listed_at.get(key)):
+                return self._folders[key]
+        return self._refresh_folder(key)
+
+    def _get_root(self, root: str) -> List[BlobEntry]:
+        """All the files of a root, merged from its case folders (the root is listed at once if any of them is stale)."""
+        with self._lock:
+            cases = None if self._is_stale(self._cases_listed_at.get(root)) else self._cases[root]
+            keys = [root] + [f"{root}/{case}" for case in cases or ()]
+            if cases is not None and not any(self._is_stale(self._listed_at.get(key)) for key in keys):
+                folders = [self._folders[key] for key in keys]
+            else:
+                folders = None
+        if folders is None:
+            folders = list(self._refresh_root(root).values())
+        return [entry for entries in folders for entry in entries.values()]
+
+    def _get_tree(self, folder: str) -> List[BlobEntry]:
+        """Recursive listing of a folder that is not indexed recursively (outside the case folders)."""
+        with self._lock:
+            if not self._is_stale(self._trees_listed_at.get(folder)):
+                return self._trees[folder]
+        entries = list(self.storage.list_entries(folder + "/"))
+        with self._lock:
+            self._trees[folder] = entries
+            self._trees_listed_at[folder] = time.monotonic()
+        return entries
+
+    def cases(self, path: str, filter_by_word: str, full_path: bool = True, remove_items: List[str] = ['C0 - Información Común']) -> List[str]:
+        """
+        List all cases (folders only) in the given root path, filter the list by a contained word and remove specific items.
+        Same result as AzureBlobStorageClient.list_cases, served from the index.
+        """
+        root = path.strip("/")
+        if root not in self.roots:
+            return self.storage.list_cases(path, filter_by_word, full_path=full_path, remove_items=remove_items)
+        with self._lock:
+            cases = None if self._is_stale(self._cases_listed_at.get(root)) else self._cases[root]
+        if cases is None:
+            cases = self._refresh_cases(root)
+        folders = sorted(cases)
+        if filter_by_word and filter_by_word != "ALL":
+            folders = [folder for folder in folders if filter_by_word in folder]
+        if remove_items:
+            folders = [folder for folder in folders if folder not in remove_items]
+        if full_path:
+            folders = [os.path.join(path, folder) for folder in folders]
+        return folders
+
+    def entries(self, folder_name: str) -> List[BlobEntry]:
+        """
+        Return the listing information of all the files under the given folder, recursively.
+        Roots and case folders (and their subfolders) are served from the index, any other folder from its own
+        listing, kept for `max_age` seconds. The container root is never listed whole: an empty folder name lists the
+        configured roots only.
+        """
+        folder = folder_name.replace("\\", "/").strip("/")
+        if not folder:
+            return sorted((entry for root in self.roots for entry in self._get_root(root)), key=lambda entry: entry.name)
+        if folder in self.roots:
+            return sorted(self._get_root(folder), key=lambda entry: entry.name)
+        key, recursive = self._folder_key(folder + "/_")
+        if not recursive:
+            return sorted(self._get_tree(folder), key=lambda entry: entry.name)
+        entries = self._get_folder(key).values()
+        if key == folder:
+            return sorted(entries, key=lambda entry: entry.name)
+        prefix = folder + "/"
+        return sorted((entry for entry in entries if entry.name.startswith(prefix)), key=lambda entry: entry.name)
+
+    def files(self, folder_name: str, full_path: bool = True) -> List[str]:
+        """List the files under the given folder. Same result as AzureBlobStorageClient.get_container_files."""
+        files = [entry.name for entry in self.entries(folder_name)]
+        if not full_path:
+            files = [os.path.basename(file) for file in files]
+        return files
+
+    def entry(self, path: str) -> Optional[BlobEntry]:
+        """Return the listing information of a single file, or None if it does not exist."""
+        path = path.replace("\\", "/").strip("/")
+        key, _ = self._folder_key(path)
+        return self._get_folder(key).get(path)
+
+
+_manifests: Dict[str, CaseManifest] = {}
+_manifests_lock = threading.Lock()
+
+
+def get_manifest(storage) -> CaseManifest:
+    """Return the process-wide case manifest of the storage container, creating it on first use."""
+    key = f"{type(storage).__name__}:{storage.container_name}"
+    with _manifests_lock:
+        if key not in _manifests:
+            roots = [
+                os.getenv("PRE_NARRATIVE_FOLDER", ""),
+                os.getenv("NARRATIVE_FOLDER", ""),
+                os.getenv("SAR_DATA_FOLDER", ""),
+                os.getenv("SAR_TEMPLATES_FOLDER", ""),
+            ]
+            _manifests[key] = CaseManifest(storage, roots=roots, max_age=float(os.getenv("MANIFEST_MAX_AGE", 60)))
+        return _manifests[key]
@@ -0,0 +1,181 @@
+"""
+This module contains the section plan of the pre-narrative: each section (QuestionsTypes) declares the sections
+whose answers it needs. Sections without dependencies only need the base prompt, so they are asked concurrently,
+each one in its own conversation; a section with dependencies waits for them and is asked with their questions
+and answers as history. Once the plan is done, the conversation is written to the chat history in plan order,
+so the following pages continue it as if the sections had been asked one after another. Each question is tagged
+with its section, so the Narrative page can send each of its sections with only the turns it depends on.
+"""
+
+import asyncio
+import logging
+import queue
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+
+from utilities.enums import QuestionsTypes
+from utilities.history_window import tag_section
+from utilities.llm_clients import get_event_loop
+
+# Sections whose answers each section needs, in the pre-narrative and the narrative (any other section only needs the base prompt)
+SECTION_DEPENDENCIES: Dict[QuestionsTypes, Tuple[QuestionsTypes, ...]] = {
+    QuestionsTypes.RECOMENDACION_INICIAL: (
+        QuestionsTypes.NATURALEZA_ALERTA,
+        QuestionsTypes.PRINCIPAL_IMPLICADO,
+        QuestionsTypes.CONTEXTO_HISTORICO,
+        QuestionsTypes.ANALISIS_OPERATIVA,
+    ),
+    QuestionsTypes.DOCUMENTACION_ADICIONAL: (
+        QuestionsTypes.NATURALEZA_ALERTA,
+        QuestionsTypes.ANALISIS_OPERATIVA,
+    ),
+    QuestionsTypes.INTERVINIENTES_ADICIONALES: (
+        QuestionsTypes.PRINCIPAL_IMPLICADO,
+        QuestionsTypes.ANALISIS_OPERATIVA,
+    ),
+    QuestionsTypes.CONCLUSION_FINAL: (
+        QuestionsTypes.NATURALEZA_ALERTA,
+        QuestionsTypes.PRINCIPAL_IMPLICADO,
+        QuestionsTypes.CONTEXTO_HISTORICO,
+        QuestionsTypes.ANALISIS_OPERATIVA,
+        QuestionsTypes.DOCUMENTACION_ADICIONAL,
+        QuestionsTypes.INTERVINIENTES_ADICIONALES,
+    ),
+}
+
+# Sections whose answer is not streamed (e.g. the graph, which is only rendered once complete)
+NON_STREAMED_SECTIONS = (QuestionsTypes.GRAFO_INTERVINIENTES,)
+
+
+@dataclass(frozen=True)
+class Section:
+    """A section of the pre-narrative: its question, and the sections (of the same plan) it depends on."""
+    question: QuestionsTypes
+    prompt: str
+    depends_on: Tuple[QuestionsTypes, ...] = ()
+    stream: bool = True
+
+
+def build_section_plan(prompts: Dict[QuestionsTypes, str]) -> List[Section]:
+    """Build the plan of the given sections (in order), keeping only the dependencies that are part of the plan."""
+    return [
+        Section(
+            question=question,
+            prompt=prompt,
+            depends_on=tuple(dependency for dependency in SECTION_DEPENDENCIES.get(question, ()) if dependency in prompts),
+            stream=question not in NON_STREAMED_SECTIONS,
+        )
+        for question, prompt in prompts.items()
+    ]
+
+
+def get_section_dependencies(question: QuestionsTypes) -> Optional[List[str]]:
+    """
+    Names of the sections a section depends on, as tagged in the chat history.
+    None if the section declares no dependencies, so it is asked with the whole history window.
+    """
+    if question not in SECTION_DEPENDENCIES:
+        return None
+    return [dependency.name for dependency in SECTION_DEPENDENCIES[question]]
+
+
+def get_section_messages(sections: List[Section], answers: Dict[QuestionsTypes, str]) -> List[BaseMessage]:
+    """Questions and answers of the given sections, in plan order."""
+    messages: List[BaseMessage] = []
+    for section in sections:
+        if section.question in answers:
+            messages += [
+                tag_section(HumanMessage(content=section.prompt), section.question.name),
+                AIMessage(content=answers[section.question]),
+            ]
+    return messages
+
+
+async def run_section_plan(
+    report_generator,
+    sections: List[Section],
+    on_chunk: Optional[Callable[[QuestionsTypes, str], None]] = None,
+    on_done: Optional[Callable[[QuestionsTypes, str], None]] = None,
+    max_concurrency: int = 4,
+) -> Dict[QuestionsTypes, str]:
+    """
+    Ask the sections of the plan, each one as soon as the sections it depends on are answered.
+    `on_chunk` is called with the text generated so far of a streamed section, and `on_done` with the answer
+    of each section when it is complete. Returns the answers, in plan order.
+    """
+    answers: Dict[QuestionsTypes, str] = {}
+    done_events = {section.question: asyncio.Event() for section in sections}
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def ask(section: Section):
+        for dependency in section.depends_on:
+            await done_events[dependency].wait()
+        history = get_section_messages([s for s in sections if s.question in section.depends_on], answers)
+        async with semaphore:
+            start = time.monotonic()
+            if section.stream:
+                answer = ""
+                async for chunk in report_generator.astream_with_history(section.prompt, history):
+                    answer += chunk
+                    if on_chunk:
+                        on_chunk(section.question, answer)
+            else:
+                answer = await report_generator.ainvoke_with_history(section.prompt, history)
+            logging.info(f'Section "{section.question.value}" answered in {time.monotonic() - start:.2f} s')
+        answers[section.question] = answer
+        if on_done:
+            on_done(section.question, answer)
+        done_events[section.question].set()
+
+    tasks = [asyncio.ensure_future(ask(section)) for section in sections]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # A failed (or cancelled) section stops the plan: cancel the other sections and wait until they are done,
+        # so none of them keeps using the shared clients after the plan returns
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return {section.question: answers[section.question] for section in sections}
+
+
+def ask_section_plan(
+    report_generator,
+    sections: List[Section],
+    on_chunk: Optional[Callable[[QuestionsTypes, str], None]] = None,
+    on_done: Optional[Callable[[QuestionsTypes, str], None]] = None,
+    max_concurrency: int = 4,
+) -> Dict[QuestionsTypes, str]:
+    """
+    Run the section plan on the shared event loop of the LLM clients (see run_section_plan), blocking until it
+    finishes. The callbacks (`on_chunk`, `on_done` and the admission status of the report generator) are called
+    from the calling thread, e.g. the thread of a Streamlit script.
+    """
+    callbacks: "queue.Queue[Optional[Tuple[Callable, tuple]]]" = queue.Queue()
+
+    def relay(callback: Optional[Callable]) -> Optional[Callable]:
+        return (lambda *args: callbacks.put((callback, args))) if callback else None
+
+    on_admission_wait = report_generator.on_admission_wait
+    report_generator.on_admission_wait = relay(on_admission_wait)
+    try:
+        future = asyncio.run_coroutine_threadsafe(
+            run_section_plan(report_generator, sections, on_chunk=relay(on_chunk), on_done=relay(on_done), max_concurrency=max_concurrency),
+            get_event_loop(),
+        )
+        future.add_done_callback(lambda _: callbacks.put(None))
+        try:
+            while (item := callbacks.get()) is not None:
+                callback, args = item
+                callback(*args)
+        except BaseException:
+            # E.g. the script was stopped: do not leave the sections running
+            future.cancel()
+            raise
+        return future.result()
+    finally:
+        report_generator.on_admission_wait = on_admission_wait
@@ -14,6 +14,8 @@ from utilities.prompts_templates.narratives import (
     documentacion_adicional_template,
     intervinientes_adicionales_template,
     grafo_intervinientes_template,
+    resumen_historial_template,
+    continuar_respuesta_template,
 )
 from utilities.prompts_templates.SAR import (
     base_prompt_SAR_template,
@@ -169,6 +171,26 @@ class Prompts:
         """
         return grafo_intervinientes_template
 
+    @staticmethod
+    def resumen_historial():
+        """
+        Get the instructions to summarise the older turns of a conversation (see HistoryWindow).
+
+        Returns:
+            str: The template for the conversation summary.
+        """
+        return resumen_historial_template
+
+    @staticmethod
+    def continuar_respuesta():
+        """
+        Get the instructions to continue an answer whose stream was interrupted (see utilities.retry).
+
+        Returns:
+            str: The template to resume an answer.
+        """
+        return continuar_respuesta_template
+
     @staticmethod
     def base_prompt_SAR(alert_data: str, customer_data: str, transactions_df: str, narrative_output: str):
         """
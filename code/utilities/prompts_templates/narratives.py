@@ -458,3 +458,15 @@ Devuelve únicamente una string con la definición del grafo apropiado en lengua
 
 IMPORTANTE: Únicamente utiliza los nombres de los intervinientes. En el caso que no se hayan identificado los nombres de los intervinientes adicionales, es decir, que no aparezcan los nombres de los ordenantes (intervinientes para los abonos) o de los beneficiarios (intervinientes para los cargos), devuelve una string vacía ("") como output sin generar ningún grafo. No utilices la descripción del movimiento ni el concepto de las transacciones para identificar a los intervinientes adicionales.
 """
+
+resumen_historial_template = \
+"""Resume la siguiente conversación entre un analista de Transaction Monitoring y un asistente experto sobre un expediente.
+Conserva todos los datos relevantes para el análisis del caso: nombres de los intervinientes, importes, fechas, tipos de alerta, \
+conclusiones y recomendaciones de cada sección. No añadas información que no aparezca en la conversación.
+Devuelve únicamente el resumen, en formato de lista por secciones.
+"""
+
+continuar_respuesta_template = \
+"""Tu respuesta anterior se ha interrumpido. Continúala exactamente desde el punto en el que se cortó, sin repetir \
+ningún texto ya escrito y sin añadir introducciones ni comentarios.
+"""
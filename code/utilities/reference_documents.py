@@ -0,0 +1,167 @@
+"""
+This module contains the ReferenceDocumentCache class, a process-wide in-memory cache of the reference documents
+that are the same for every case and analyst (Playbook, alert assessments, SAR templates): their extracted text
+and token count, keyed by the blob ETag (or the content hash when the storage does not provide one).
+
+Entries are served without touching the storage for `ttl` seconds. Afterwards they are revalidated: the document
+is only extracted again if its ETag (or content) changed. `warm_up` preloads all the reference documents, so that
+a freshly started server does not extract them on the first case load.
+
+Documents are downloaded and extracted outside the lock of the cache, so different documents load concurrently;
+concurrent misses of the same document wait for a single load.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from utilities.documents import extract_document_text
+from utilities.enums import CaseTypes
+from utilities.storage import BlobNotFound
+from utilities.tokenizer import count_tokens
+
+
+@dataclass(frozen=True)
+class ReferenceDocument:
+    """Extracted text of a reference document."""
+    path: str
+    key: str
+    text: str
+    tokens: int
+
+
+class ReferenceDocumentCache:
+
+    def __init__(self, storage, manifest=None, ttl: float = 3600.0):
+        """
+        Args:
+            storage: Storage client the documents are read from (e.g. AzureBlobStorageClient).
+            manifest (CaseManifest): Index of the storage, used to get the ETag of the documents without downloading them.
+            ttl (float): Seconds an entry is served before it is revalidated against the storage.
+        """
+        self.storage = storage
+        self.manifest = manifest
+        self.ttl = ttl
+        # Documents by path, with the time they were last validated, and documents by ETag or content hash
+        self._documents: Dict[str, ReferenceDocument] = {}
+        self._validated_at: Dict[str, float] = {}
+        self._by_key: Dict[str, ReferenceDocument] = {}
+        # Guards the dictionaries above; the loads of each document are serialised by their own lock
+        self._lock = threading.RLock()
+        self._path_locks: Dict[str, threading.Lock] = {}
+
+    @staticmethod
+    def _normalize(path: str) -> str:
+        return path.replace("\\", "/").strip("/")
+
+    def _etag(self, path: str) -> Optional[str]:
+        if self.manifest is None:
+            return None
+        entry = self.manifest.entry(path)
+        if entry is None:
+            raise BlobNotFound(f"File {path} not found")
+        return entry.etag or None
+
+    def _extract(self, path: str, key: str, content: bytes) -> ReferenceDocument:
+        text = extract_document_text(path, content)
+        tokens = count_tokens(text)
+        return ReferenceDocument(path=path, key=key, text=text, tokens=tokens)
+
+    def _get_fresh(self, path: str) -> Optional[ReferenceDocument]:
+        """Cached document of a path, if it was validated less than `ttl` seconds ago."""
+        with self._lock:
+            document = self._documents.get(path)
+            validated_at = self._validated_at.get(path)
+            if document is not None and validated_at is not None and time.monotonic() - validated_at <= self.ttl:
+                return document
+            return None
+
+    def get(self, path: str) -> ReferenceDocument:
+        """Return the extracted text of a reference document. Raises BlobNotFound if it does not exist."""
+        path = self._normalize(path)
+        document = self._get_fresh(path)
+        if document is not None:
+            return document
+
+        with self._lock:
+            path_lock = self._path_locks.setdefault(path, threading.Lock())
+        with path_lock:
+            # Another thread may have loaded the document while this one waited
+            document = self._get_fresh(path)
+            if document is not None:
+                return document
+
+            etag = self._etag(path)
+            with self._lock:
+                document = self._by_key.get(etag) if etag is not None else None
+            if document is None:
+                content = self.storage.get_file(path)
+                key = etag or hashlib.sha256(content).hexdigest()
+                with self._lock:
+                    document = self._by_key.get(key)
+                if document is None:
+                    start = time.monotonic()
+                    document = self._extract(path, key, content)
+                    logging.info(f"Reference document {path} extracted ({document.tokens} tokens) in {time.monotonic() - start:.2f} s")
+            return self._store(path, document)
+
+    def _store(self, path: str, document: ReferenceDocument) -> ReferenceDocument:
+        with self._lock:
+            self._by_key[document.key] = document
+            self._documents[path] = document
+            self._validated_at[path] = time.monotonic()
+            # Drop the versions of the documents that are no longer referenced
+            keys = {document.key for document in self._documents.values()}
+            self._by_key = {key: document for key, document in self._by_key.items() if key in keys}
+            return document
+
+    def text(self, path: str) -> str:
+        """Return the extracted text of a reference document. Raises BlobNotFound if it does not exist."""
+        return self.get(path).text
+
+    def invalidate(self, path: Optional[str] = None):
+        """Revalidate a document (or all of them) on its next use."""
+        with self._lock:
+            if path is None:
+                self._validated_at.clear()
+            else:
+                self._validated_at.pop(self._normalize(path), None)
+
+    def reference_paths(self) -> List[str]:
+        """Paths of all the reference documents: Playbook, alert assessment of each case type and SAR templates."""
+        paths = [os.getenv("PLAYBOOK_FILENAME", "")]
+        paths += [f"{case_type.value}.docx" for case_type in CaseTypes if case_type != CaseTypes.ALL]
+        sar_templates_path = os.getenv("SAR_TEMPLATES_FOLDER", "")
+        if sar_templates_path:
+            templates = self.manifest.files(sar_templates_path) if self.manifest is not None else self.storage.get_container_files(folder_name=sar_templates_path)
+            paths += [path for path in templates if os.path.splitext(path)[1] == ".docx"]
+        return [path for path in paths if path]
+
+    def warm_up(self, paths: Optional[List[str]] = None) -> Dict[str, ReferenceDocument]:
+        """Load the given reference documents (all of them by default). Documents that do not exist are skipped."""
+        start = time.monotonic()
+        documents = {}
+        for path in paths if paths is not None else self.reference_paths():
+            try:
+                documents[path] = self.get(path)
+            except BlobNotFound:
+                logging.warning(f"Reference document {path} not found")
+        logging.info(f"Reference documents warmed up ({len(documents)} documents) in {time.monotonic() - start:.2f} s")
+        return documents
+
+
+_caches: Dict[str, ReferenceDocumentCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_reference_documents(storage, manifest=None) -> ReferenceDocumentCache:
+    """Return the process-wide reference document cache of the storage container, creating it on first use."""
+    key = f"{type(storage).__name__}:{storage.container_name}"
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = ReferenceDocumentCache(storage, manifest=manifest, ttl=float(os.getenv("REFERENCE_DOCUMENTS_TTL", 3600)))
+        return _caches[key]
@@ -0,0 +1,128 @@
+"""
+This module contains the LLMResponseCache class, an opt-in persistent cache of LLM answers stored in SQLite.
+Answers are keyed by a fingerprint of everything that determines them: model interface, model, temperature,
+system prompt, message history and question. Entries older than `max_age` seconds are dropped, and the least
+recently used ones are evicted when the cache exceeds `max_entries` answers or `max_bytes` bytes.
+
+Enable it with LLM_CACHE_ENABLED=true (see ReportGenerator).
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from langchain_core.messages import BaseMessage
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def get_cache_key(interface: str, model: str, temperature: float, system_prompt: str, history: List[BaseMessage], question: str) -> str:
+    """Fingerprint of an LLM request: (interface, model, temperature, system prompt hash, history hash, question hash)."""
+    history_text = json.dumps([[message.type, message.content] for message in history], ensure_ascii=False)
+    fingerprint = json.dumps([interface, model, float(temperature), _hash(system_prompt), _hash(history_text), _hash(question)])
+    return _hash(fingerprint)
+
+
+class LLMResponseCache:
+
+    def __init__(self, db_path: str, max_entries: int = 1000, max_bytes: int = 100 * 1024 * 1024, max_age: float = 7 * 24 * 3600):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, created_at REAL NOT NULL, last_used_at REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used_at ON responses (last_used_at)")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # One connection per operation: the cache is used from several threads (and server processes)
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached answer of a request, or None if it is not cached (or expired)."""
+        now = time.time()
+        with self._connect() as connection:
+            row = connection.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            response, created_at = row
+            if now - created_at > self.max_age:
+                connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            connection.execute("UPDATE responses SET last_used_at = ? WHERE key = ?", (now, key))
+        return response
+
+    def put(self, key: str, response: str):
+        """Store the answer of a request, evicting the expired and least recently used answers if needed."""
+        if not response:
+            return
+        now = time.time()
+        try:
+            with self._connect() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO responses (key, response, size, created_at, last_used_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, response, len(response.encode("utf-8")), now, now),
+                )
+                self._evict(connection, now)
+        except sqlite3.Error as e:
+            logging.warning(f"Could not store LLM response in the cache: {e}")
+
+    def _evict(self, connection: sqlite3.Connection, now: float):
+        connection.execute("DELETE FROM responses WHERE created_at < ?", (now - self.max_age,))
+        count, total_bytes = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if count <= self.max_entries and total_bytes <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in connection.execute("SELECT key, size FROM responses ORDER BY last_used_at").fetchall():
+            if count <= self.max_entries and total_bytes <= self.max_bytes:
+                break
+            evicted.append((key,))
+            count -= 1
+            total_bytes -= size
+        connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def clear(self):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM responses")
+
+
+_caches: Dict[str, LLMResponseCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_response_cache() -> LLMResponseCache:
+    """Return the process-wide LLM response cache, configured with the LLM_CACHE_* environment variables."""
+    db_path = os.getenv("LLM_CACHE_PATH", "tmp/llm_cache.db")
+    with _caches_lock:
+        if db_path not in _caches:
+            _caches[db_path] = LLMResponseCache(
+                db_path,
+                max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", 1000)),
+                max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", 100 * 1024 * 1024)),
+                max_age=float(os.getenv("LLM_CACHE_MAX_AGE", 7 * 24 * 3600)),
+            )
+        return _caches[db_path]
+
+
+def is_response_cache_enabled() -> bool:
+    return os.getenv("LLM_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
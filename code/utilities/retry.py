@@ -0,0 +1,187 @@
+"""
+This module contains the retry policy of the LLM calls. Rate limits (429), timeouts, server errors and dropped
+connections are retried with exponential backoff and full jitter. When the response says how long to wait
+(retry-after-ms, retry-after or x-ratelimit-reset-* headers), that wait is used instead of the backoff.
+
+A stream that fails after some chunks is resumed instead of restarted: the answer streamed so far is kept, and the
+model is asked to continue it.
+"""
+
+import asyncio
+import email.utils
+import logging
+import os
+import random
+import re
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, Iterator, Optional, TypeVar
+
+import httpx
+import openai
+
+T = TypeVar("T")
+
+RETRYABLE_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """Seconds of a duration such as "20ms", "1.5s" or "6m0s" (format of the x-ratelimit-reset-* headers)."""
+    parts = _DURATION_PART.findall(value.strip())
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def get_retry_after(headers) -> Optional[float]:
+    """Seconds to wait before retrying, as requested by the response headers (None if they do not say)."""
+    if headers is None:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass
+        try:
+            # HTTP date
+            return max(0.0, email.utils.parsedate_to_datetime(headers["retry-after"]).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    # Reset of the exhausted limits (requests or tokens)
+    resets = []
+    for limit in ("requests", "tokens"):
+        remaining = headers.get(f"x-ratelimit-remaining-{limit}")
+        reset = headers.get(f"x-ratelimit-reset-{limit}")
+        if reset and remaining is not None and remaining.strip() == "0":
+            seconds = parse_duration(reset)
+            if seconds is not None:
+                resets.append(seconds)
+    return max(resets) if resets else None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether an error of an LLM call is transient (rate limit, timeout, server error or dropped connection)."""
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError, httpx.TransportError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+
+@dataclass
+class RetryPolicy:
+    """Retries of the transient errors of the LLM calls."""
+    max_retries: int = 6
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+
+    @classmethod
+    def from_env(cls) -> "RetryPolicy":
+        """Policy configured with LLM_MAX_RETRIES, LLM_RETRY_BASE_DELAY and LLM_RETRY_MAX_DELAY."""
+        return cls(
+            max_retries=int(os.getenv("LLM_MAX_RETRIES", 6)),
+            base_delay=float(os.getenv("LLM_RETRY_BASE_DELAY", 1.0)),
+            max_delay=float(os.getenv("LLM_RETRY_MAX_DELAY", 60.0)),
+        )
+
+    def delay(self, error: BaseException, attempt: int) -> float:
+        """Seconds to wait before the retry number `attempt` (starting at 0) of a failed call."""
+        response = getattr(error, "response", None)
+        retry_after = get_retry_after(getattr(response, "headers", None))
+        if retry_after is not None:
+            # Small jitter, so the sessions waiting for the same reset do not retry at the same time
+            return min(self.max_delay, retry_after) + random.uniform(0, 0.1 * self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def should_retry(self, error: BaseException, attempt: int) -> bool:
+        return attempt < self.max_retries and is_retryable(error)
+
+
+def _log_retry(error: BaseException, attempt: int, delay: float, policy: RetryPolicy):
+    logging.warning(f"LLM call failed ({type(error).__name__}: {error}), retry {attempt + 1}/{policy.max_retries} in {delay:.1f} s")
+
+
+def call_with_retry(call: Callable[[], T], policy: Optional[RetryPolicy] = None) -> T:
+    """Run an LLM call, retrying its transient errors."""
+    policy = policy or RetryPolicy.from_env()
+    attempt = 0
+    while True:
+        try:
+            return call()
+        except Exception as error:
+            if not policy.should_retry(error, attempt):
+                raise
+            delay = policy.delay(error, attempt)
+            _log_retry(error, attempt, delay, policy)
+            time.sleep(delay)
+            attempt += 1
+
+
+async def acall_with_retry(call: Callable[[], Awaitable[T]], policy: Optional[RetryPolicy] = None) -> T:
+    """Run an asynchronous LLM call, retrying its transient errors."""
+    policy = policy or RetryPolicy.from_env()
+    attempt = 0
+    while True:
+        try:
+            return await call()
+        except Exception as error:
+            if not policy.should_retry(error, attempt):
+                raise
+            delay = policy.delay(error, attempt)
+            _log_retry(error, attempt, delay, policy)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+def stream_with_retry(start: Callable[[str], Iterator[str]], policy: Optional[RetryPolicy] = None) -> Iterator[str]:
+    """
+    Stream an LLM answer, retrying its transient errors. `start` opens the stream given the answer streamed so far
+    (empty at first), so a stream that fails halfway is resumed from where it stopped.
+    """
+    policy = policy or RetryPolicy.from_env()
+    partial = ""
+    attempt = 0
+    while True:
+        try:
+            for chunk in start(partial):
+                partial += chunk
+                yield chunk
+            return
+        except Exception as error:
+            if not policy.should_retry(error, attempt):
+                raise
+            delay = policy.delay(error, attempt)
+            _log_retry(error, attempt, delay, policy)
+            time.sleep(delay)
+            attempt += 1
+
+
+async def astream_with_retry(start: Callable[[str], AsyncIterator[str]], policy: Optional[RetryPolicy] = None) -> AsyncIterator[str]:
+    """Asynchronous version of stream_with_retry."""
+    policy = policy or RetryPolicy.from_env()
+    partial = ""
+    attempt = 0
+    while True:
+        try:
+            async for chunk in start(partial):
+                partial += chunk
+                yield chunk
+            return
+        except Exception as error:
+            if not policy.should_retry(error, attempt):
+                raise
+            delay = policy.delay(error, attempt)
+            _log_retry(error, attempt, delay, policy)
+            await asyncio.sleep(delay)
+            attempt += 1
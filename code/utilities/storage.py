@@ -0,0 +1,284 @@
+"""
+This module defines the StorageBackend protocol implemented by the case data storages, and the local-directory
+implementation of it. AzureBlobStorageClient (Azure Blob Storage or Azurite) is the other implementation.
+
+Use `get_storage_backend()` to get the backend configured with the STORAGE_BACKEND environment variable
+("azure" by default, or "local" to read the case tree from the LOCAL_STORAGE_PATH directory).
+"""
+
+import io
+import mmap
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, IO, Iterator, List, Optional, Protocol, Union
+
+from dotenv import load_dotenv
+
+
+@dataclass(frozen=True)
+class BlobEntry:
+    """Listing information of a blob."""
+    name: str
+    size: int
+    etag: str
+    last_modified: Optional[datetime]
+
+
+class BlobNotFound(FileNotFoundError):
+    """Raised when a blob (or its container) does not exist."""
+
+
+class MemoryViewIO(io.RawIOBase):
+    """
+    Seekable binary stream over an existing buffer (bytes, bytearray, mmap...), so that readers expecting
+    a file object (e.g. pd.ExcelFile) can consume the buffer without copying it into a BytesIO.
+    Over a writable buffer (e.g. a preallocated bytearray) it is also writable, but it never grows the buffer.
+    """
+
+    def __init__(self, buffer: Union[bytes, bytearray, memoryview, mmap.mmap], on_close: Optional[Callable[[], None]] = None):
+        super().__init__()
+        self._view = memoryview(buffer)
+        self._position = 0
+        self._on_close = on_close
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return not self._view.readonly
+
+    def getbuffer(self) -> memoryview:
+        return self._view
+
+    def readinto(self, b) -> int:
+        size = min(len(b), len(self._view) - self._position)
+        if size <= 0:
+            return 0
+        b[:size] = self._view[self._position:self._position + size]
+        self._position += size
+        return size
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self._view) if size is None or size < 0 else min(self._position + size, len(self._view))
+        data = bytes(self._view[self._position:end])
+        self._position = max(self._position, end)
+        return data
+
+    def write(self, b) -> int:
+        data = memoryview(b).cast('B')
+        end = self._position + len(data)
+        if end > len(self._view):
+            raise ValueError(f"Write of {len(data)} bytes at position {self._position} exceeds the buffer size ({len(self._view)})")
+        self._view[self._position:end] = data
+        self._position = end
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = len(self._view) + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+            if self._on_close is not None:
+                self._on_close()
+        super().close()
+
+
+class StorageBackend(Protocol):
+    """Common list/get/put API of the case data storages."""
+
+    container_name: str
+
+    def get_file(self, file_path: str, container_name: Optional[str] = None) -> bytes:
+        """Get the content of a file. Raises BlobNotFound if it does not exist."""
+        ...
+
+    def open_file(self, file_path: str, container_name: Optional[str] = None) -> IO[bytes]:
+        """Open a file as a seekable binary stream (meant for large files such as xlsx workbooks)."""
+        ...
+
+    def download_many(self, paths: List[str], max_concurrency: int = 8, container_name: Optional[str] = None) -> Dict[str, bytes]:
+        """Get the content of several files concurrently. Files that do not exist are left out of the result."""
+        ...
+
+    def upload_file(self, bytes_data, file_name: str, container_name: Optional[str] = None, content_type: Optional[str] = 'application/pdf', metadata: Optional[Dict] = {}) -> str:
+        ...
+
+    def delete_file(self, file_name, container_name: Optional[str] = None):
+        ...
+
+    def get_container_files(self, container_name: Optional[str] = None, folder_name: Optional[str] = None, full_path: bool = True) -> List[str]:
+        ...
+
+    def list_entries(self, prefix: str = '', recursive: bool = True, container_name: Optional[str] = None) -> Iterator[BlobEntry]:
+        ...
+
+    def iter_folders(self, path: str, container_name: Optional[str] = None, results_per_page: Optional[int] = None) -> Iterator[str]:
+        ...
+
+    def list_cases(self, path: str, filter_by_word: str, full_path: bool = True, remove_items: List[str] = ['C0 - Información Común']) -> List[str]:
+        ...
+
+
+class LocalStorageBackend:
+    """
+    StorageBackend over a local directory holding the same tree as the blob container (e.g. to work offline).
+    Blob names are the paths relative to the directory, with "/" as separator.
+    """
+
+    def __init__(self, root_path: str = "", mmap_threshold: Optional[int] = None):
+
+        load_dotenv()
+
+        self.root_path = os.path.abspath(os.getenv('LOCAL_STORAGE_PATH', root_path) or ".")
+        self.container_name = self.root_path
+        # Files from this size on are memory-mapped by `open_file` instead of read into memory
+        if mmap_threshold is None:
+            mmap_threshold = int(os.getenv('LOCAL_STORAGE_MMAP_THRESHOLD', 4 * 1024 * 1024))
+        self.mmap_threshold = mmap_threshold
+
+    def _local_path(self, file_path: str) -> str:
+        return os.path.join(self.root_path, *file_path.replace("\\", "/").strip("/").split("/"))
+
+    def _blob_name(self, local_path: str) -> str:
+        return Path(os.path.relpath(local_path, self.root_path)).as_posix()
+
+    def get_file(self, file_path: str, container_name: Optional[str] = None) -> bytes:
+        """Get a file given its path relative to the storage directory. Raises BlobNotFound if it does not exist."""
+        try:
+            with open(self._local_path(file_path), 'rb') as f:
+                return f.read()
+        except (FileNotFoundError, IsADirectoryError) as e:
+            raise BlobNotFound(f"File {file_path} not found in {self.root_path}") from e
+
+    def open_file(self, file_path: str, container_name: Optional[str] = None) -> IO[bytes]:
+        """Open a file as a seekable binary stream. Large files are memory-mapped instead of read into memory."""
+        local_path = self._local_path(file_path)
+        try:
+            size = os.path.getsize(local_path)
+        except OSError as e:
+            raise BlobNotFound(f"File {file_path} not found in {self.root_path}") from e
+        if size < self.mmap_threshold or size == 0:
+            return io.BytesIO(self.get_file(file_path))
+        with open(local_path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return MemoryViewIO(mapped, on_close=mapped.close)
+
+    def download_many(self, paths: List[str], max_concurrency: int = 8, container_name: Optional[str] = None) -> Dict[str, bytes]:
+        """Read several files concurrently. Files that do not exist are left out of the result."""
+        def read(path: str) -> Optional[bytes]:
+            try:
+                return self.get_file(path)
+            except BlobNotFound:
+                return None
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            contents = list(executor.map(read, paths))
+        return {path: content for path, content in zip(paths, contents) if content is not None}
+
+    def upload_file(self, bytes_data, file_name: str, container_name: Optional[str] = None, content_type: Optional[str] = 'application/pdf', metadata: Optional[Dict] = {}) -> str:
+        local_path = self._local_path(file_name)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        # Write to a temporary file and rename it, so readers never see partial files
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(local_path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(bytes_data)
+        os.replace(tmp_path, local_path)
+        return Path(local_path).as_uri()
+
+    def delete_file(self, file_name, container_name: Optional[str] = None):
+        try:
+            os.remove(self._local_path(file_name))
+        except FileNotFoundError as e:
+            raise BlobNotFound(f"File {file_name} not found in {self.root_path}") from e
+
+    def get_container_files(self, container_name: Optional[str] = None, folder_name: Optional[str] = None, full_path: bool = True) -> List[str]:
+        prefix = os.path.join(folder_name, '').replace("\\", "/") if folder_name else ''
+        files = [entry.name for entry in self.list_entries(prefix)]
+        # If full_path is True, get only the file name (without any folder or full path)
+        if not full_path:
+            files = [os.path.basename(file) for file in files]
+        return files
+
+    def list_entries(self, prefix: str = '', recursive: bool = True, container_name: Optional[str] = None) -> Iterator[BlobEntry]:
+        """Yield the listing information of the files whose path starts with the given prefix (only the direct ones if not recursive)."""
+        prefix = prefix.replace("\\", "/")
+        folder, _ = os.path.split(prefix)
+        local_folder = self._local_path(folder) if folder else self.root_path
+        if not os.path.isdir(local_folder):
+            return
+        if recursive:
+            walker = os.walk(local_folder)
+        else:
+            walker = [(local_folder, [], [name for name in os.listdir(local_folder) if os.path.isfile(os.path.join(local_folder, name))])]
+        names = []
+        for dirpath, dirnames, filenames in walker:
+            dirnames.sort()
+            for filename in filenames:
+                local_path = os.path.join(dirpath, filename)
+                name = self._blob_name(local_path)
+                if name.startswith(prefix):
+                    names.append((name, local_path))
+        for name, local_path in sorted(names):
+            stat = os.stat(local_path)
+            yield BlobEntry(
+                name=name,
+                size=stat.st_size,
+                etag=f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+                last_modified=datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc),
+            )
+
+    def iter_folders(self, path: str, container_name: Optional[str] = None, results_per_page: Optional[int] = None) -> Iterator[str]:
+        """Yield the names of the folders directly under the given path."""
+        local_folder = self._local_path(path) if path else self.root_path
+        if not os.path.isdir(local_folder):
+            return
+        for entry in sorted(os.scandir(local_folder), key=lambda entry: entry.name):
+            if entry.is_dir():
+                yield entry.name
+
+    def list_cases(self, path: str, filter_by_word: str, full_path: bool = True, remove_items: List[str] = ['C0 - Información Común']) -> List[str]:
+        """
+        List all cases (folders only) in the given path, filter the list by a contained word and remove specific items.
+        """
+        folders = list(self.iter_folders(path))
+        if filter_by_word and filter_by_word != "ALL":
+            folders = [folder for folder in folders if filter_by_word in folder]
+        if remove_items:
+            folders = [folder for folder in folders if folder not in remove_items]
+        if full_path:
+            folders = [os.path.join(path, folder) for folder in folders]
+        return folders
+
+
+def get_storage_backend() -> StorageBackend:
+    """Return the storage backend selected by the STORAGE_BACKEND environment variable ("azure" or "local")."""
+    load_dotenv()
+    backend = os.getenv("STORAGE_BACKEND", "azure").lower()
+    if backend == "local":
+        return LocalStorageBackend()
+    if backend == "azure":
+        from utilities.azureblobstorage import AzureBlobStorageClient
+        return AzureBlobStorageClient()
+    raise ValueError(f'Storage backend "{backend}" not supported. Use "azure" or "local".')
@@ -0,0 +1,308 @@
+"""
+This module contains the functions to read the case workbooks ("Tabla Resumen", "Intervinientes Adicionales")
+into pandas DataFrames and to preprocess their tables before they are shown or injected into the prompts.
+"""
+
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from openpyxl.cell.cell import TYPE_ERROR, TYPE_NUMERIC
+from pandas.errors import EmptyDataError
+from pandas.io.parsers import TextParser
+
+
+def _convert_cell(cell) -> Any:
+    """Convert an openpyxl cell value the same way pandas does when reading a workbook."""
+    if cell.value is None:
+        return ""
+    elif cell.data_type == TYPE_ERROR:
+        return np.nan
+    elif cell.data_type == TYPE_NUMERIC:
+        value = int(cell.value)
+        if value == cell.value:
+            return value
+        return float(cell.value)
+    return cell.value
+
+
+def _get_sheet_data(worksheet) -> List[List[Any]]:
+    """Read the cell values of a worksheet as pandas does: trailing empty cells and rows trimmed, rows padded to the same width."""
+    if getattr(worksheet, "reset_dimensions", None) is not None:
+        worksheet.reset_dimensions()
+    data: List[List[Any]] = []
+    last_row_with_data = -1
+    for row_number, row in enumerate(worksheet.rows):
+        converted_row = [_convert_cell(cell) for cell in row]
+        while converted_row and converted_row[-1] == "":
+            converted_row.pop()
+        if converted_row:
+            last_row_with_data = row_number
+        data.append(converted_row)
+    data = data[:last_row_with_data + 1]
+    if data:
+        max_width = max(len(row) for row in data)
+        data = [row + [""] * (max_width - len(row)) for row in data]
+    return data
+
+
+def _parse_sheet_data(data: List[List[Any]], header: Optional[int]) -> pd.DataFrame:
+    """Build the DataFrame of the cell values of a sheet, as pd.read_excel does."""
+    if not data:
+        return pd.DataFrame()
+    try:
+        return TextParser(data, header=header, skip_blank_lines=False).read()
+    except EmptyDataError:
+        return pd.DataFrame()
+
+
+def read_excel_sheet(filepath, search_limit_rows=10, sheet=None) -> Tuple[pd.DataFrame, Optional[int]]:
+    """
+    Reads an Excel sheet, identifying the header row based on content and maximum column criteria.
+    The sheet is streamed once with openpyxl (read-only mode), and both the header detection and the final
+    DataFrame are built from the cell values in memory. Same result as `read_excel_sheet_two_pass`.
+
+    :param filepath: Path to the Excel file (or an open pd.ExcelFile).
+    :param search_limit_rows: The maximum number of rows to search for the header.
+    :param sheet: Name of the sheet to read. The first sheet is read if not given.
+    :return: A pandas DataFrame with the correct headers, and the index of the detected header row (None if not found).
+    """
+    if isinstance(filepath, pd.ExcelFile):
+        xls = filepath
+    else:
+        xls = pd.ExcelFile(filepath)
+    try:
+        if xls.engine != "openpyxl":
+            return read_excel_sheet_two_pass(xls, search_limit_rows=search_limit_rows, sheet=sheet)
+        worksheet = xls.book[sheet] if sheet else xls.book.worksheets[0]
+        data = _get_sheet_data(worksheet)
+    finally:
+        if xls is not filepath:
+            xls.close()
+
+    # Identify the maximum number of content columns, with the same missing values as pd.read_excel
+    df = _parse_sheet_data(data, header=None)
+    counts = df.count(axis=1).tolist()
+    max_content_columns = max(counts, default=None)
+
+    # Iterate through rows to find the header
+    header_row_idx = None
+    for i, count in enumerate(counts):
+        if count == 0:
+            continue  # Skip completely NaN rows
+        elif count == max_content_columns:
+            header_row_idx = i
+            break
+        elif i >= search_limit_rows:
+            break
+
+    if header_row_idx is not None:
+        # Build the DataFrame again from the cell values in memory, with the identified header row
+        df = _parse_sheet_data(data, header=header_row_idx)
+
+    return df, header_row_idx
+
+
+def read_excel_sheet_two_pass(filepath, search_limit_rows=10, sheet=None) -> Tuple[pd.DataFrame, Optional[int]]:
+    """
+    Reads an Excel sheet, identifying the header row based on content and maximum column criteria.
+    Reads the sheet twice with pd.read_excel (used for the workbooks that openpyxl cannot read).
+
+    :param filepath: Path to the Excel file (or an open pd.ExcelFile).
+    :param search_limit_rows: The maximum number of rows to search for the header.
+    :param sheet: Name of the sheet to read. The first sheet is read if not given.
+    :return: A pandas DataFrame with the correct headers, and the index of the detected header row (None if not found).
+    """
+    # Step 1: Open the Excel file without headers
+    if sheet:
+        df = pd.read_excel(filepath, header=None, sheet_name=sheet)
+    else:
+        df = pd.read_excel(filepath, header=None)
+    # Step 2: Identify the maximum number of content columns
+    max_content_columns = df.apply(lambda x: x.count(), axis=1).max()
+
+    # Step 3: Iterate through rows to find the header
+    header_row_idx = None
+    for i, row in df.iterrows():
+        if row.isna().all():
+            continue  # Skip completely NaN rows
+        elif row.count() == max_content_columns:
+            # Found a row that matches the maximum number of content columns
+            header_row_idx = i
+            break
+        elif i >= search_limit_rows:
+            break
+
+    if header_row_idx is not None:
+        # Step 4: Re-read the Excel file with the identified header row
+        if sheet:
+            df = pd.read_excel(filepath, header=header_row_idx, sheet_name=sheet)
+        else:
+            df = pd.read_excel(filepath, header=header_row_idx)
+
+    return df, header_row_idx
+
+
+def read_excel_with_dynamic_headers(filepath, search_limit_rows=10, sheet=None) -> pd.DataFrame:
+    """
+    Reads an Excel file, identifying the header row based on content and maximum column criteria.
+
+    :param filepath: Path to the Excel file.
+    :param search_limit_rows: The maximum number of rows to search for the header.
+    :return: A pandas DataFrame with the correct headers.
+    """
+    df, _ = read_excel_sheet(filepath, search_limit_rows=search_limit_rows, sheet=sheet)
+    return df
+
+
+@dataclass(frozen=True)
+class ColumnRule:
+    """Vectorised formatting applied to every column of a table that the rule matches (by name and values)."""
+    name: str
+    matches: Callable[[str, pd.Series], bool]
+    format: Callable[[pd.Series], pd.Series]
+
+
+def format_percentages(values: pd.Series) -> pd.Series:
+    """Show fractional (0-1) values as truncated percentages ("12%"), leaving the zeros as they are."""
+    nonzero = values != 0
+    if not nonzero.any():
+        return values
+    percentages = (values * 100).astype(np.int64).astype(str) + "%"
+    return percentages.where(nonzero, values.astype(object))
+
+
+def format_currency(values: pd.Series, symbol: str = "€") -> pd.Series:
+    """Show numeric values as amounts with thousands separator, two decimals and the currency symbol ("1,234.50 €")."""
+    if not pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+        return values.apply(lambda x: f"{x:,.2f} {symbol}")
+    amounts = pd.Series(np.char.mod("%.2f", values.to_numpy()), index=values.index, dtype=object)
+    amounts = amounts.str.replace(r"(\d)(?=(?:\d{3})+\.)", r"\1,", regex=True)
+    return amounts + f" {symbol}"
+
+
+def is_float_column(name: str, values: pd.Series) -> bool:
+    return values.dtype == 'float64'
+
+
+# Preprocessing of the tables read from the case workbooks, in order:
+# absolute value of the float columns (remove the sign of the debits), then fractional columns as percentages
+PREPROCESS_RULES = [
+    ColumnRule("absolute", is_float_column, lambda values: values.abs()),
+    ColumnRule("percentage", lambda name, values: is_float_column(name, values) and values.max() <= 1, format_percentages),
+]
+
+
+def apply_column_rules(df: pd.DataFrame, rules: List[ColumnRule]) -> pd.DataFrame:
+    """Return a copy of the table with the rules applied, in order, to the columns they match."""
+    df = df.copy()
+    for rule in rules:
+        for col in df.columns:
+            if rule.matches(col, df[col]):
+                df[col] = rule.format(df[col])
+    return df
+
+
+def process_excel_table(df: pd.DataFrame, preprocess: bool = True) -> pd.DataFrame:
+    """
+    Prepare a table read from a case workbook: fill the missing values and, if `preprocess`, apply the
+    PREPROCESS_RULES (absolute value of the float columns, fractional ones shown as percentages).
+    """
+    # Set all NaN values to empty string or 0, depending on the column type
+    df = df.fillna({col: "" if df[col].dtype == 'O' else 0 for col in df.columns})
+    if preprocess:
+        df = apply_column_rules(df, PREPROCESS_RULES)
+
+    return df
+
+
+def add_currency_symbol(df: pd.DataFrame, keyword_column: str = "importe", symbol: str = "€") -> pd.DataFrame:
+    """
+    Add currency symbol to the columns of a DataFrame whose name contains the keyword
+    """
+    rules = [ColumnRule("currency", lambda name, values: keyword_column in str(name).lower(), lambda values: format_currency(values, symbol))]
+    return apply_column_rules(df, rules)
+
+
+def get_formatted_table(sheet_data: Dict) -> pd.DataFrame:
+    """
+    Return the table of a sheet ({'content': DataFrame, 'tokens': int}) with its amounts formatted (see add_currency_symbol).
+    The formatted table is stored next to the raw one, so it is only formatted once.
+    """
+    if 'formatted' not in sheet_data:
+        sheet_data['formatted'] = add_currency_symbol(sheet_data['content'])
+    return sheet_data['formatted']
+
+
+def _format_float_column(values: np.ndarray, floatfmt: str) -> np.ndarray:
+    """Format a float column with a format spec (e.g. ".0f", ",.2f"), leaving the missing values empty."""
+    missing = np.isnan(values)
+    text = np.char.mod("%" + floatfmt.replace(",", ""), np.where(missing, 0, values)).astype(object)
+    if "," in floatfmt:
+        text = pd.Series(text, dtype=object).str.replace(r"(\d)(?=(?:\d{3})+(?:\.|$))", r"\1,", regex=True).to_numpy()
+    text[missing] = ""
+    return text
+
+
+def _format_column(values: pd.Series, floatfmt: str, escape: Callable[[str], str]) -> List[str]:
+    """Text of the cells of a column: floats with `floatfmt`, missing values empty, anything else as str."""
+    if values.dtype == 'float64':
+        return _format_float_column(values.to_numpy(), floatfmt).tolist()
+    missing = values.isna().to_numpy()
+    return ["" if is_missing else escape(str(value)) for value, is_missing in zip(values.tolist(), missing)]
+
+
+def _escape_pipe_cell(text: str) -> str:
+    return text.replace("|", "\\|").replace("\r", " ").replace("\n", " ")
+
+
+def _escape_tsv_cell(text: str) -> str:
+    return text.replace("\t", " ").replace("\r", " ").replace("\n", " ")
+
+
+def render_table(df: pd.DataFrame, fmt: str = "pipe", floatfmt: str = ".0f") -> str:
+    """
+    Render a table as text for the prompts, building the lines from the column arrays in a single pass
+    (instead of tabulate's DataFrame.to_markdown):
+    - "pipe": Markdown pipe table, without padding, numeric columns right-aligned.
+    - "tsv": tab-separated values, one line per row, the most compact rendering.
+    """
+    if fmt == "pipe":
+        escape = _escape_pipe_cell
+    elif fmt == "tsv":
+        escape = _escape_tsv_cell
+    else:
+        raise ValueError(f'Table format "{fmt}" not supported. Use "pipe" or "tsv".')
+    headers = [escape(str(col)) for col in df.columns]
+    columns = [_format_column(df.iloc[:, i], floatfmt, escape) for i in range(df.shape[1])]
+    if fmt == "tsv":
+        return "\n".join(["\t".join(headers)] + ["\t".join(row) for row in zip(*columns)])
+    alignments = ["---:" if pd.api.types.is_numeric_dtype(df.iloc[:, i]) and not pd.api.types.is_bool_dtype(df.iloc[:, i]) else ":---" for i in range(df.shape[1])]
+    lines = ["| " + " | ".join(headers) + " |", "|" + "|".join(alignments) + "|"]
+    lines += ["| " + " | ".join(row) + " |" for row in zip(*columns)]
+    return "\n".join(lines)
+
+
+def get_rendered_table(sheet_data: Dict, fmt: str = "pipe", floatfmt: str = ".0f", formatted: bool = False) -> str:
+    """
+    Return the text of the table of a sheet ({'content': DataFrame, 'tokens': int}), rendered with `render_table`
+    from its raw table or, if `formatted`, from its formatted one (see get_formatted_table).
+    Each rendering is stored in the sheet data, so it is only computed once.
+    """
+    rendered = sheet_data.setdefault('rendered', {})
+    key = (fmt, floatfmt, formatted)
+    if key not in rendered:
+        rendered[key] = render_table(get_formatted_table(sheet_data) if formatted else sheet_data['content'], fmt=fmt, floatfmt=floatfmt)
+    return rendered[key]
+
+
+def render_sheets(sheets_data: Dict[str, Dict], sheet_names: List[str], fmt: str = "pipe", floatfmt: str = ".0f") -> str:
+    """Join the rendered tables of the given sheets into a single text, with the title of each table."""
+    return "".join(f"### {sheet}:\n\n" + get_rendered_table(sheets_data[sheet], fmt=fmt, floatfmt=floatfmt) + "\n\n" for sheet in sheet_names)
+
+
+def process_excel_tables(xls: pd.ExcelFile, sheet, skip_rows=None, preprocess=True) -> pd.DataFrame:
+    """Read a sheet of an open workbook (with dynamic headers) and prepare its table."""
+    df = read_excel_with_dynamic_headers(filepath=xls, sheet=sheet.title)
+    return process_excel_table(df, preprocess=preprocess)
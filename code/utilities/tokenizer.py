@@ -0,0 +1,86 @@
+"""
+This module contains the token counting service used to size the prompts: the encoding is resolved from the
+model in OPENAI_MODEL_NAME (o200k_base for gpt-4o), encodings stay loaded for the life of the process, and
+counts are memoised by content hash, so the same sheet or prompt is only encoded once.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, Optional
+
+import tiktoken
+
+DEFAULT_MODEL = "gpt-4o"
+FALLBACK_ENCODING = "o200k_base"
+
+_counts: "OrderedDict[str, int]" = OrderedDict()
+_counts_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name: str) -> tiktoken.Encoding:
+    """Return a tiktoken encoding, loading it only once per process."""
+    return tiktoken.get_encoding(encoding_name)
+
+
+@lru_cache(maxsize=None)
+def get_encoding_name_for_model(model_name: str) -> str:
+    """Return the name of the encoding of a model, or o200k_base if tiktoken does not know the model (e.g. a deployment name)."""
+    try:
+        return tiktoken.encoding_name_for_model(model_name)
+    except KeyError:
+        return FALLBACK_ENCODING
+
+
+def get_model_encoding(model_name: Optional[str] = None) -> tiktoken.Encoding:
+    """Return the encoding of the given model, or of the model in OPENAI_MODEL_NAME."""
+    model_name = model_name or os.getenv("OPENAI_MODEL_NAME", DEFAULT_MODEL)
+    return get_encoding(get_encoding_name_for_model(model_name))
+
+
+def _count_key(encoding: tiktoken.Encoding, text: str) -> str:
+    return encoding.name + ":" + hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _get_count(key: str) -> Optional[int]:
+    with _counts_lock:
+        count = _counts.get(key)
+        if count is not None:
+            _counts.move_to_end(key)
+        return count
+
+
+def _put_count(key: str, count: int):
+    max_entries = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", 4096))
+    with _counts_lock:
+        _counts[key] = count
+        _counts.move_to_end(key)
+        while len(_counts) > max_entries:
+            _counts.popitem(last=False)
+
+
+def count_tokens(text: str, encoding: Optional[tiktoken.Encoding] = None) -> int:
+    """Returns the number of tokens in a text string (with the encoding of the configured model by default)."""
+    return count_tokens_batch([text], encoding=encoding)[0]
+
+
+def count_tokens_batch(texts: List[str], encoding: Optional[tiktoken.Encoding] = None, num_threads: int = 8) -> List[int]:
+    """
+    Returns the number of tokens of each text string. The texts that were not counted before are encoded
+    together, across `num_threads` threads.
+    """
+    encoding = encoding or get_model_encoding()
+    keys = [_count_key(encoding, text) for text in texts]
+    counts = [_get_count(key) for key in keys]
+    missing = {key: text for key, text, count in zip(keys, texts, counts) if count is None}
+    if missing:
+        # Special tokens (e.g. "<|endoftext|>") found in the texts are counted as plain text
+        encoded = encoding.encode_ordinary_batch(list(missing.values()), num_threads=num_threads)
+        new_counts = {key: len(tokens) for key, tokens in zip(missing, encoded)}
+        for key, count in new_counts.items():
+            _put_count(key, count)
+        counts = [new_counts[key] if count is None else count for key, count in zip(keys, counts)]
+    return counts
@@ -1,6 +1,5 @@
 import os
 import io
-import docx
 import streamlit as st
 import re
 import time
@@ -8,19 +7,16 @@ import json
 from docx import Document
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 from docx.shared import Inches
-from datetime import datetime, timedelta
-from typing import List, Dict, Union, IO, Optional
+from datetime import datetime
+from typing import Any, List, Dict, Optional
 import markdown
 from bs4 import BeautifulSoup
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 from streamlit_extras.switch_page_button import switch_page
-import pandas as pd
-import tiktoken
-from docx import Document
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.oxml.text.paragraph import CT_P
-from docx.oxml.table import CT_Tbl
 from graphviz import Source
-import tempfile
+
+from utilities import tokenizer
+from utilities.documents import get_docx_text
 
 ### CONSTANTS ###
 
@@ -61,64 +57,25 @@ def alert_and_redirect():
     time.sleep(1)
     switch_page("case selector")
 
-### FILE AND DATA OPERATIONS ###
-
-def get_docx_text(file: Union[str, bytes, bytearray, memoryview]) -> str:
-    """
-    Extract text from a docx file, including paragraphs and tables in order.
-    """
-    file_obj: Union[str, IO[bytes]]
-    
-    if isinstance(file, (bytes, bytearray, memoryview)):
-        # Convert bytearray and memoryview to bytes
-        if isinstance(file, (bytearray, memoryview)):
-            file = bytes(file)
-        file_obj = io.BytesIO(file)
-    else:
-        file_obj = file
-
-    doc = docx.Document(file_obj)
-    fullText = []
-
-    for element in doc.element.body:
-        if isinstance(element, CT_P):  # Check if the element is a paragraph
-            para = docx.text.paragraph.Paragraph(element, doc)
-            fullText.append(para.text)
-        elif isinstance(element, CT_Tbl):  # Check if the element is a table
-            table = docx.table.Table(element, doc)
-            md_table = table_to_markdown(table)
-            fullText.append(md_table)
-            fullText.append('\n')  # Separate tables with a newline
+def get_session_key() -> Optional[str]:
+    """Id of the browser session of the analyst, used to queue the LLM calls fairly between analysts."""
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else None
 
-    return '\n'.join(fullText)
+def show_admission_status(placeholder):
+    """Callback for ReportGenerator.on_admission_wait: shows the queue position and estimated wait in the placeholder."""
+    def on_wait(status):
+        if status is None:
+            placeholder.empty()
+        else:
+            placeholder.info(f"⏳ Waiting for LLM quota: position {status.position} of {status.queued} in the queue, about {status.wait:.0f} s")
+    return on_wait
 
-def table_to_markdown(table: docx.table.Table) -> str:
-    """
-    Convert a docx table to a Markdown formatted string.
-    """
-    md_table = []
-    # Extract headers
-    headers = []
-    for cell in table.rows[0].cells:
-        headers.append(cell.text.strip())
-    md_table.append('| ' + ' | '.join(headers) + ' |')
-    md_table.append('|' + ' --- |' * len(headers))
-
-    # Extract rows
-    for row in table.rows[1:]:
-        row_text = []
-        for cell in row.cells:
-            row_text.append(cell.text.strip())
-        md_table.append('| ' + ' | '.join(row_text) + ' |')
-    
-    return '\n'.join(md_table)
+### FILE AND DATA OPERATIONS ###
 
 def get_folders(path: str) -> List[str]:
     return [name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name))]
 
-def get_files_in_folder(folder_path: str) -> List[str]:
-    return [f for f in os.listdir(folder_path) if os.path.isfile(os.path.join(folder_path, f))]
-
 def get_files_in_folder_recursive(folder_path: str) -> List[str]:
     files = []
     for root, _, filenames in os.walk(folder_path):
@@ -126,19 +83,6 @@ def get_files_in_folder_recursive(folder_path: str) -> List[str]:
             files.append(os.path.join(root, filename))
     return files
 
-def list_cases(path: str, filter_by_word: str, full_path: bool = True, remove_items: List[str] = ['C0 - Información Común']) -> List[str]:
-    """
-    List all cases (folders only) in the given path, filter the list by a contained word and remove specific items. 
-    """
-    folders = [name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name))]
-    if full_path:
-        return [os.path.join(path, folder) for folder in folders]
-    if filter_by_word and filter_by_word != "ALL":
-        folders = [folder for folder in folders if filter_by_word in folder]
-    if remove_items:
-        folders = [folder for folder in folders if folder not in remove_items]
-    return folders
-
 @st.cache_data
 def read_json_from_blob(_blob_client, case: str, folder: str, json_file: str) -> Dict:
     return json.loads(_blob_client.get_file(os.path.join(folder, case, json_file)))
@@ -149,9 +93,13 @@ def load_json(
     files: List[str],
     folder: str,
     _blob_client,
-    height=300
+    height=300,
+    json_data_by_path: Optional[Dict[str, Any]] = None
 ) -> Optional[List[Dict]]:
-    """ Finds and displays a JSON file based on a keyword in the filename. """
+    """
+    Finds and displays a JSON file based on a keyword in the filename.
+    If `json_data_by_path` (parsed files keyed by blob path) is given, the files are taken from it instead of from blob storage.
+    """
     with st.container(border=True):
         json_files = [f for f in files if any(k in f for k in keywords)]
         if json_files:
@@ -160,12 +108,16 @@ def load_json(
             with st.container(border=False, height=height):
                 for json_file in selected_json_files:
                     # json_data = read_json(case, json_file)
-                    json_data = read_json_from_blob(
-                        _blob_client=_blob_client,
-                        case=case,
-                        folder=folder,
-                        json_file=json_file
-                    )
+                    json_path = os.path.join(folder, case, json_file).replace("\\", "/")
+                    if json_data_by_path and json_path in json_data_by_path:
+                        json_data = json_data_by_path[json_path]
+                    else:
+                        json_data = read_json_from_blob(
+                            _blob_client=_blob_client,
+                            case=case,
+                            folder=folder,
+                            json_file=json_file
+                        )
                     selected_json_data.append(json_data)
                     st.json(json_data)
                     st.divider()
@@ -183,44 +135,6 @@ def write_to_file(response: str, file_path: str):
     with open(file_path, 'a') as f:
         f.write(response)
 
-# @st.cache_data
-def read_excel_with_dynamic_headers(filepath, search_limit_rows=10, sheet=None):
-    """
-    Reads an Excel file, identifying the header row based on content and maximum column criteria.
-    
-    :param filepath: Path to the Excel file.
-    :param search_limit_rows: The maximum number of rows to search for the header.
-    :return: A pandas DataFrame with the correct headers.
-    """
-    # Step 1: Open the Excel file without headers
-    if sheet:
-        df = pd.read_excel(filepath, header=None, sheet_name=sheet)
-    else:
-        df = pd.read_excel(filepath, header=None)
-    # Step 2: Identify the maximum number of content columns
-    max_content_columns = df.apply(lambda x: x.count(), axis=1).max()
-    
-    # Step 3: Iterate through rows to find the header
-    header_row_idx = None
-    for i, row in df.iterrows():
-        if row.isna().all():
-            continue  # Skip completely NaN rows
-        elif row.count() == max_content_columns:
-            # Found a row that matches the maximum number of content columns
-            header_row_idx = i
-            break
-        elif i >= search_limit_rows:
-            break
-    
-    if header_row_idx is not None:
-        # Step 4: Re-read the Excel file with the identified header row
-        if sheet:
-            df = pd.read_excel(filepath, header=header_row_idx, sheet_name=sheet)
-        else:
-            df = pd.read_excel(filepath, header=header_row_idx)
-    
-    return df
-
 def read_additional_documentation(narrative_path: str, case: str) -> Dict[str, str]:
     files = get_files_in_folder_recursive(os.path.join(narrative_path, case))
     files_content = {}
@@ -245,7 +159,7 @@ def render_graph(response: str, case: str) -> bool:
             dot_string = response[6:-3]
             graph = Source(dot_string, filename=f"tmp/graphs/{case}.gv", format="png")
             st.image(graph.render(), use_container_width=True, caption=f"Relaciones entre los intervinientes del caso «{case}» para los principales abonos y cargos.")
-        except Exception as e:
+        except Exception:
             pass
             # st.error(f"Error al renderizar el grafo de los intervinientes: {e}")
         return True
@@ -253,8 +167,6 @@ def render_graph(response: str, case: str) -> bool:
 
 ### NARRATIVE & DOCUMENT UTILITIES ###
 
-from datetime import datetime
-
 def get_narrative_header(case: str, timestamp: Optional[datetime], model: str, temperature: float) -> str:
     """
     Generate a narrative header with case details, timestamp, model, and temperature.
@@ -385,8 +297,7 @@ def save_to_docx(response: str, header_image_path: str = "code/images/logo.png")
 
 ### TOKEN UTILITIES ### 
 
-def num_tokens_from_string(string: str, encoding_name: str = "cl100k_base") -> int:
-    """Returns the number of tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
\ No newline at end of file
+def num_tokens_from_string(string: str, encoding_name: Optional[str] = None) -> int:
+    """Returns the number of tokens in a text string (with the encoding of the configured model by default)."""
+    encoding = tokenizer.get_encoding(encoding_name) if encoding_name else None
+    return tokenizer.count_tokens(string, encoding=encoding)
\ No newline at end of file